@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+
+"""Benchmarks of the derp-me operations.
+
+Drives get/set/mget/mset/lget/lset/flush through DerpMeClient and reports
+throughput and latency percentiles for every combination of the given
+parameters, as JSON lines.
+
+By default client and server run in this process and the broker hop is
+replaced by a loopback that JSON-serializes requests and responses the way
+the transports do, so the benchmarks run offline. Use --broker to go
+through a real broker against a running derp-me instead.
+
+With --workers N, the cases run in N processes, each one with its own
+loopback DerpMe, sharing the in-process memories through a SharedStore
+the way the workers of a Supervisor do. The throughput reported is the
+aggregate of the N processes, which shows how far multi-process mode
+scales on top of the single store process.
+
+Examples:
+    # In-process memories only, no Redis needed
+    python benchmarks/bench_derpme.py --runtime inprocess --persistent file
+
+    # Scaling of multi-process mode over a SharedStore
+    python benchmarks/bench_derpme.py --ops get set --workers 1 2 4 \
+        --concurrency 4
+
+    # Save results and compare them with a previous run
+    python benchmarks/bench_derpme.py -o after.jsonl
+    python benchmarks/bench_derpme.py --compare before.jsonl after.jsonl
+"""
+
+import argparse
+import inspect
+import itertools
+import json
+import logging
+import multiprocessing as mp
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from derp_me.client import DerpMeClient  # noqa: E402
+from derp_me.derp_me import DerpMe, LocalMemType  # noqa: E402
+from derp_me.supervisor import SharedStore, start_shared_store  # noqa: E402
+
+
+OPS = ('get', 'set', 'mget', 'mset', 'lget', 'lset', 'flush')
+RUNTIME_MEMS = {
+    'redis': LocalMemType.REDIS,
+    'inprocess': LocalMemType.INPROCESS
+}
+PERSISTENT_MEMS = {
+    'redis': LocalMemType.REDIS,
+    'file': LocalMemType.FILE,
+    'mmap': LocalMemType.MMAP
+}
+
+
+class LoopbackDerpMe(DerpMe):
+    """LoopbackDerpMe.
+    DerpMe without a broker. Requests are handed to its RPC callbacks
+    directly through call().
+    """
+
+    def _init_endpoints(self):
+        self.logger = logging.getLogger(self.node_name)
+        self._publish_invalidations = False
+        self._handlers = {
+            'get': self._dispatch(self._callback_get),
+            'set': self._dispatch(self._callback_set),
+            'mget': self._dispatch(self._callback_mget),
+            'mset': self._dispatch(self._callback_mset),
+            'lget': self._dispatch(self._callback_lget),
+            'lset': self._dispatch(self._callback_lset),
+            'lscan': self._dispatch(self._callback_lscan),
+            'scan': self._dispatch(self._callback_scan),
+            'mget_prefix': self._dispatch(self._callback_mget_prefix),
+            'flush': self._dispatch(self._callback_flush),
+            'batch': self._dispatch(self._callback_batch),
+            'expire': self._dispatch(self._callback_expire),
+            'ttl': self._dispatch(self._callback_ttl),
+            'persist': self._dispatch(self._callback_persist),
+            'stats': self._dispatch(self._callback_stats)
+        }
+
+    def call(self, name: str, msg: dict) -> dict:
+        return self._handlers[name](msg, None)
+
+
+class _LoopbackRPC(object):
+    def __init__(self, server: LoopbackDerpMe, name: str):
+        self._server = server
+        self._name = name
+
+    def call(self, msg: dict) -> dict:
+        # Same serialization work as a broker round trip
+        msg = json.loads(json.dumps(msg))
+        return json.loads(json.dumps(self._server.call(self._name, msg)))
+
+
+class LoopbackClient(DerpMeClient):
+    """LoopbackClient.
+    DerpMeClient whose RPC clients call a LoopbackDerpMe in-process.
+    """
+
+    def __init__(self, server: LoopbackDerpMe, encoding: str = None):
+        self.namespace = server.namespace
+        self.timeout = None
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._encoding = encoding
+        self._peer_encoding = None
+        self._cache = None
+        self._rpcs = {
+            name: _LoopbackRPC(server, name)
+            for name in OPS + ('batch', 'lscan', 'scan', 'mget_prefix',
+                               'expire', 'ttl', 'persist', 'stats')
+        }
+
+
+def percentile(samples: list, pct: float) -> float:
+    """percentile.
+    Nearest-rank percentile of sorted samples.
+    """
+    if not samples:
+        return 0.0
+    idx = min(int(round(pct / 100.0 * len(samples) + 0.5)) - 1,
+              len(samples) - 1)
+    return samples[max(idx, 0)]
+
+
+def make_request(op: str, args, i: int):
+    """make_request.
+    Returns a callable performing one operation on a client.
+    """
+    keys = ['bench.k{}'.format(n) for n in range(args.keys)]
+    val = 'x' * args.value_size
+    vals = [val] * len(keys)
+    items = list(range(args.list_length))
+    persistent = args.persistent_flag
+    key = keys[i % len(keys)]
+    if op == 'get':
+        return lambda c: c.get(key, persistent)
+    elif op == 'set':
+        return lambda c: c.set(key, val, persistent)
+    elif op == 'mget':
+        return lambda c: c.mget(keys, persistent)
+    elif op == 'mset':
+        return lambda c: c.mset(keys, vals, persistent)
+    elif op == 'lget':
+        return lambda c: c.lget('bench.l', 0, -(args.list_length - 1),
+                                persistent)
+    elif op == 'lset':
+        return lambda c: c.lset('bench.l', items, persistent)
+    return lambda c: c.flush()
+
+
+def prepare(client, args) -> None:
+    keys = ['bench.k{}'.format(n) for n in range(args.keys)]
+    client.mset(keys, ['x' * args.value_size] * len(keys),
+                args.persistent_flag)
+    client.lset('bench.l', list(range(args.list_length)),
+                args.persistent_flag)
+
+
+def measure(make_client, op: str, args, ready=None) -> tuple:
+    """measure.
+    Run one operation from args.concurrency threads for args.requests
+    requests in total. Returns the sorted latencies, the number of errors
+    and the elapsed time.
+
+    Args:
+        ready: Barrier waited for once prepared, to start the processes
+            of a multi-process case together
+    """
+    per_thread = max(args.requests // args.concurrency, 1)
+    latencies = [[] for _ in range(args.concurrency)]
+    errors = [0] * args.concurrency
+    clients = [make_client() for _ in range(args.concurrency)]
+    prepare(clients[0], args)
+    if ready is not None:
+        ready.wait()
+    barrier = threading.Barrier(args.concurrency + 1)
+
+    def _worker(n):
+        client = clients[n]
+        reqs = [make_request(op, args, n * per_thread + i)
+                for i in range(min(per_thread, 64))]
+        lat = latencies[n]
+        barrier.wait()
+        for i in range(per_thread):
+            t0 = time.perf_counter()
+            resp = reqs[i % len(reqs)](client)
+            lat.append(time.perf_counter() - t0)
+            if not resp.get('status', 0):
+                errors[n] += 1
+
+    threads = [threading.Thread(target=_worker, args=(n,))
+               for n in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    t_start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t_start
+    samples = sorted(itertools.chain.from_iterable(latencies))
+    return samples, sum(errors), elapsed
+
+
+def summarize(samples: list, errors: int, elapsed: float) -> dict:
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'elapsed_s': round(elapsed, 6),
+        'ops_per_s': round(len(samples) / elapsed, 1),
+        'p50_us': round(percentile(samples, 50) * 1e6, 1),
+        'p99_us': round(percentile(samples, 99) * 1e6, 1),
+        'p999_us': round(percentile(samples, 99.9) * 1e6, 1),
+        'max_us': round(samples[-1] * 1e6, 1) if samples else 0.0
+    }
+
+
+def run_case(make_client, op: str, args) -> dict:
+    return summarize(*measure(make_client, op, args))
+
+
+def _run_worker(address, server_kwargs: dict, op: str, args, ready,
+                results) -> None:
+    server = None
+    try:
+        store = SharedStore(address=address)
+        store.connect()
+        server = LoopbackDerpMe(shared_store=store, **server_kwargs)
+        results.put(measure(
+            lambda: LoopbackClient(server, encoding=args.encoding), op,
+            args, ready))
+    except Exception as exc:
+        # Release the other processes waiting to start
+        ready.abort()
+        results.put('{}: {}'.format(exc.__class__.__name__, exc))
+    finally:
+        if server is not None:
+            server.stop()
+
+
+def run_workers(server_kwargs: dict, op: str, args, workers: int) -> dict:
+    """run_workers.
+    Run one operation from `workers` processes sharing the memories of a
+    SharedStore, args.requests requests in total. Latencies are those of
+    all the processes, throughput is their aggregate.
+    """
+    ctx = mp.get_context('fork')
+    params = inspect.signature(DerpMe).bind_partial(**server_kwargs)
+    params.apply_defaults()
+    store = start_shared_store(params.arguments, ctx)
+    args = argparse.Namespace(**vars(args))
+    args.requests = max(args.requests // workers, 1)
+    ready = ctx.Barrier(workers)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_run_worker,
+                         args=(store.address, server_kwargs, op, args,
+                               ready, results), daemon=True)
+             for _ in range(workers)]
+    try:
+        for proc in procs:
+            proc.start()
+        measured = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+    finally:
+        store.store().close()
+        store.shutdown()
+    errors = [m for m in measured if isinstance(m, str)]
+    if errors:
+        raise RuntimeError(errors[0])
+    samples = sorted(itertools.chain.from_iterable(m[0] for m in measured))
+    # The processes start together, the slowest one ends the case
+    return summarize(samples, sum(m[1] for m in measured),
+                     max(m[2] for m in measured))
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ''
+
+
+def compare(baseline_path: str, current_path: str,
+            threshold: float) -> int:
+    """compare.
+    Print the throughput and p99 change of every case found in both
+    result files. Returns the number of regressions beyond threshold %.
+    """
+    def _load(path):
+        with open(path) as f:
+            res = {}
+            for line in f:
+                if line.strip():
+                    rec = json.loads(line)
+                    res[json.dumps(rec['case'], sort_keys=True)] = rec
+            return res
+
+    base = _load(baseline_path)
+    cur = _load(current_path)
+    regressions = 0
+    for case_id in sorted(set(base) & set(cur)):
+        b, c = base[case_id]['result'], cur[case_id]['result']
+        if 'error' in b or 'error' in c:
+            continue
+        d_ops = (c['ops_per_s'] / b['ops_per_s'] - 1) * 100 \
+            if b['ops_per_s'] else 0.0
+        d_p99 = (c['p99_us'] / b['p99_us'] - 1) * 100 \
+            if b['p99_us'] else 0.0
+        flag = ''
+        if d_ops < -threshold or d_p99 > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('{:<90} ops/s {:+7.1f}%  p99 {:+7.1f}%{}'.format(
+            case_id, d_ops, d_p99, flag))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark derp-me operations')
+    parser.add_argument('--ops', nargs='+', default=list(OPS),
+                        choices=OPS)
+    parser.add_argument('--runtime', nargs='+', default=['inprocess'],
+                        choices=list(RUNTIME_MEMS))
+    parser.add_argument('--persistent', nargs='+', default=['file'],
+                        choices=list(PERSISTENT_MEMS))
+    parser.add_argument('--tier', nargs='+', default=['runtime'],
+                        choices=['runtime', 'persistent'],
+                        help='Memory targeted by the requests')
+    parser.add_argument('--value-size', nargs='+', type=int, default=[16])
+    parser.add_argument('--keys', nargs='+', type=int, default=[10])
+    parser.add_argument('--list-length', nargs='+', type=int, default=[10])
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1])
+    parser.add_argument('--workers', nargs='+', type=int, default=[0],
+                        help='Server processes sharing a SharedStore, '
+                             '0 to keep the memories in this process')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='Requests per case')
+    parser.add_argument('--encoding', default=None,
+                        help='Wire encoding to negotiate (e.g. msgpack)')
+    parser.add_argument('--broker', default=None, choices=['redis', 'amqp'],
+                        help='Go through a broker to a running derp-me '
+                             'instead of the in-process loopback')
+    parser.add_argument('--namespace', default='device',
+                        help='Client namespace, with --broker')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Append JSON lines results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='Compare two result files and exit')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Regression threshold in percent, '
+                             'with --compare')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1],
+                            args.threshold) else 0
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    revision = git_revision()
+    tmp_dir = tempfile.mkdtemp(prefix='derpme-bench-')
+    servers = {}
+
+    def _server_kwargs(runtime, persistent, list_length, workers=0):
+        return {
+            'runtime_mem': RUNTIME_MEMS[runtime],
+            'persistent_mem': PERSISTENT_MEMS[persistent],
+            'list_size': list_length,
+            'storage_path': os.path.join(
+                tmp_dir, '{}-{}-{}.db'.format(persistent, list_length,
+                                              workers)),
+            'series_size': list_length
+        }
+
+    def _server(runtime, persistent, list_length):
+        key = (runtime, persistent, list_length)
+        if key not in servers:
+            servers[key] = LoopbackDerpMe(
+                **_server_kwargs(runtime, persistent, list_length))
+        return servers[key]
+
+    backends = [('broker', args.broker)] if args.broker else \
+        list(itertools.product(args.runtime, args.persistent))
+    workers_grid = [0] if args.broker else args.workers
+    grid = itertools.product(backends, args.tier, args.ops, args.value_size,
+                             args.keys, args.list_length, args.concurrency,
+                             workers_grid)
+    for (runtime, persistent), tier, op, value_size, keys, list_length, \
+            concurrency, workers in grid:
+        case = {
+            'op': op,
+            'runtime': runtime,
+            'persistent': persistent,
+            'tier': tier,
+            'value_size': value_size,
+            'keys': keys,
+            'list_length': list_length,
+            'concurrency': concurrency,
+            'encoding': args.encoding
+        }
+        if workers:
+            case['workers'] = workers
+        run_args = argparse.Namespace(
+            value_size=value_size, keys=keys, list_length=list_length,
+            concurrency=concurrency, requests=args.requests,
+            persistent_flag=(tier == 'persistent'), encoding=args.encoding)
+        try:
+            if args.broker:
+                from commlib.endpoints import TransportType
+                iface = TransportType[args.broker.upper()]
+
+                def make_client():
+                    return DerpMeClient(iface_protocol=iface,
+                                        namespace=args.namespace,
+                                        encoding=args.encoding)
+                result = run_case(make_client, op, run_args)
+            elif workers:
+                result = run_workers(
+                    _server_kwargs(runtime, persistent, list_length,
+                                   workers), op, run_args, workers)
+            else:
+                server = _server(runtime, persistent, list_length)
+
+                def make_client():
+                    return LoopbackClient(server, encoding=args.encoding)
+                result = run_case(make_client, op, run_args)
+        except Exception as exc:
+            result = {'error': '{}: {}'.format(exc.__class__.__name__, exc)}
+        out.write(json.dumps({
+            'revision': revision,
+            'timestamp': time.time(),
+            'case': case,
+            'result': result
+        }) + '\n')
+        out.flush()
+    for server in servers.values():
+        server.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,13 +3,14 @@
 """Main module."""
 
 import os
-import redis
 import json
 import time
 import re
 from enum import Enum
 
 from derp_me import DerpMe
+from derp_me.eviction import EvictionPolicy
+from derp_me.supervisor import Supervisor
 
 
 if __name__ == '__main__':
@@ -33,6 +34,27 @@ if __name__ == '__main__':
         broker_password = os.environ['DERPME_BROKER_PASSWORD']
     except KeyError as e:
         broker_password = ''
+    try:
+        max_memory = int(os.environ['DERPME_RUNTIME_MAX_MEMORY'])
+    except KeyError as e:
+        max_memory = None
+    try:
+        eviction_policy = EvictionPolicy[
+            os.environ['DERPME_EVICTION_POLICY'].upper()]
+    except KeyError as e:
+        eviction_policy = EvictionPolicy.LRU
+    try:
+        startup_workers = int(os.environ['DERPME_STARTUP_WORKERS'])
+    except KeyError as e:
+        startup_workers = 8
+    try:
+        preload = [k for k in os.environ['DERPME_PRELOAD'].split(',') if k]
+    except KeyError as e:
+        preload = None
+    try:
+        workers = int(os.environ['DERPME_WORKERS'])
+    except KeyError as e:
+        workers = 1
 
     if broker_type in ('redis', 'REDIS', 'Redis'):
         import commlib.transports.redis as comm
@@ -52,5 +74,19 @@ if __name__ == '__main__':
         port=broker_port
     )
 
-    derp = DerpMe(broker_params=bparams, debug=True)
-    derp.run_forever()
+    if workers > 1:
+        supervisor = Supervisor(workers=workers,
+                                broker_params=bparams,
+                                runtime_max_memory=max_memory,
+                                eviction_policy=eviction_policy,
+                                startup_workers=startup_workers,
+                                preload=preload)
+        supervisor.run_forever()
+    else:
+        derp = DerpMe(broker_params=bparams,
+                      runtime_max_memory=max_memory,
+                      eviction_policy=eviction_policy,
+                      startup_workers=startup_workers,
+                      preload=preload,
+                      debug=True)
+        derp.run_forever()
@@ -0,0 +1,180 @@
+"""Change events of the keys of derp-me."""
+
+import threading
+import time
+from collections import OrderedDict
+
+from commlib.logger import Logger
+
+
+class ChangeFeed(object):
+    """ChangeFeed.
+    Publishes an event for every key changed by a write, on the topic
+    {prefix}.<key>, so that watchers can subscribe to glob patterns of keys.
+
+    Events are not published by the request that produced them. They are
+    queued and published every `interval` seconds by a background thread,
+    and events of the same key within an interval are coalesced: the last
+    value of a key wins, while consecutive lset deltas are concatenated.
+    When more than `max_events` keys changed within an interval, their
+    events are published in chunks of `max_events` on the {prefix} topic
+    instead, so that a large mset produces a bounded number of messages.
+    Flush events are always published on the {prefix} topic.
+
+    An event is a dict with the following fields:
+        - op: 'set', 'lset' or 'flush'
+        - key: The changed key (not set for flush)
+        - persistent: Whether the key lives in persistent memory
+        - val: The new value (set)
+        - vals: The pushed items, oldest first (lset)
+        - ttl: Time to live of the write, if any
+        - ts: Timestamp of the write
+    """
+
+    def __init__(self, publish, prefix: str, interval: float = 0.05,
+                 max_events: int = 100, logger=None):
+        """__init__.
+
+        Args:
+            publish: Called with (msg, topic) to publish a message
+            prefix (str): Topic prefix of the events
+            interval (float): Seconds between two publishing rounds
+            max_events (int): Max events published on their own topic per
+                round, and max events per chunk
+            logger: Logger of the publishing errors
+        """
+        self._publish = publish
+        self.prefix = prefix
+        self.interval = interval
+        self.max_events = max_events
+        self.logger = logger if logger is not None else \
+            Logger(namespace=self.__class__.__name__)
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.events = 0
+        self.messages = 0
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """stop.
+        Stop the publishing thread, publishing the events still queued.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.publish_pending()
+
+    def stats(self) -> dict:
+        return {
+            'events': self.events,
+            'messages': self.messages,
+            'pending': len(self._pending)
+        }
+
+    def _add(self, event: dict) -> None:
+        slot = (event['persistent'], event['key'])
+        with self._lock:
+            self.events += 1
+            prev = self._pending.get(slot)
+            if prev is not None and prev['op'] == 'lset' and \
+                    event['op'] == 'lset' and \
+                    prev.get('dtype') == event.get('dtype'):
+                prev['vals'] = prev['vals'] + event['vals']
+                prev['ttl'] = event['ttl']
+                prev['ts'] = event['ts']
+                return
+            self._pending.pop(slot, None)
+            self._pending[slot] = event
+
+    def set(self, key: str, val, persistent: bool = False,
+            ttl: float = None) -> None:
+        self._add({
+            'op': 'set',
+            'key': key,
+            'persistent': persistent,
+            'val': val,
+            'ttl': ttl,
+            'ts': time.time()
+        })
+
+    def mset(self, keys: list, vals: list, persistent: bool = False,
+             ttl: float = None) -> None:
+        for key, val in zip(keys, vals):
+            self.set(key, val, persistent, ttl)
+
+    def lset(self, key: str, vals: list, persistent: bool = False,
+             ttl: float = None, dtype: str = None) -> None:
+        """lset.
+
+        Args:
+            key (str): List key
+            vals (list): Pushed items, oldest first
+            persistent (bool): persistent
+            ttl (float): ttl
+            dtype (str): dtype of a typed series
+        """
+        event = {
+            'op': 'lset',
+            'key': key,
+            'persistent': persistent,
+            'vals': list(vals),
+            'ttl': ttl,
+            'ts': time.time()
+        }
+        if dtype is not None:
+            event['dtype'] = dtype
+        self._add(event)
+
+    def flush(self) -> None:
+        """flush.
+        The runtime memory was flushed. Queued events of runtime keys are
+        dropped, since the flush event supersedes them.
+        """
+        with self._lock:
+            self.events += 1
+            for slot in [s for s in self._pending if not s[0]]:
+                del self._pending[slot]
+            self._pending[(False, None)] = {
+                'op': 'flush',
+                'persistent': False,
+                'ts': time.time()
+            }
+
+    def publish_pending(self) -> int:
+        """publish_pending.
+        Publish the queued events. Returns the number of messages sent.
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+            events = list(self._pending.values())
+            self._pending = OrderedDict()
+        if len(events) > self.max_events:
+            msgs = [({'events': events[i:i + self.max_events]}, self.prefix)
+                    for i in range(0, len(events), self.max_events)]
+        else:
+            msgs = []
+            for event in events:
+                if event['op'] == 'flush':
+                    msgs.append(({'events': [event]}, self.prefix))
+                else:
+                    msgs.append((event, '{}.{}'.format(self.prefix,
+                                                       event['key'])))
+        for msg, topic in msgs:
+            try:
+                self._publish(msg, topic)
+            except Exception as exc:
+                self.logger.error('Failed to publish change events on '
+                                  '<{}>: {}'.format(topic, exc))
+        self.messages += len(msgs)
+        return len(msgs)
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.publish_pending()
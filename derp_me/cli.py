@@ -1,14 +1,130 @@
 """Console script for derp_me."""
 import sys
+import time
+
 import click
 
+from . import snapshot
+
+
+# --tier -> memory tiers (0: runtime, 1: persistent)
+_TIERS = {
+    'runtime': (0,),
+    'persistent': (1,),
+    'all': (0, 1)
+}
+
+
+def _open_memories(tiers: tuple, persistent_mem: str, storage_path: str,
+                   list_size: int) -> dict:
+    """_open_memories.
+    Open the memories of a derp-me store, as {tier: Memory}. The runtime
+    memory is the Redis one, the INPROCESS memory only lives in the server.
+    Redis settings are read from config.ini and the environment.
+    """
+    from .derp_me import RedisPersistentMem, RedisRuntimeMem
+    from .redis_pool import RedisPool, load_redis_settings
+    mems = {}
+    pool = None
+    if 0 in tiers or persistent_mem == 'REDIS':
+        settings = load_redis_settings()
+        pool = RedisPool(**settings)
+    if 0 in tiers:
+        mems[0] = RedisRuntimeMem(db=settings.get('database_runtime', 1),
+                                  list_size=list_size, pool=pool)
+    if 1 in tiers:
+        if persistent_mem == 'REDIS':
+            mems[1] = RedisPersistentMem(
+                db=settings.get('database_persistent', 2),
+                list_size=list_size, pool=pool)
+        elif persistent_mem == 'FILE':
+            from .file_mem import FilePersistentMem
+            mems[1] = FilePersistentMem(path=storage_path,
+                                        list_size=list_size)
+        else:
+            from .mmap_mem import MmapPersistentMem
+            mems[1] = MmapPersistentMem(path=storage_path,
+                                        list_size=list_size)
+    return mems
+
+
+def _close(mems: dict) -> None:
+    for mem in mems.values():
+        if hasattr(mem, 'close'):
+            mem.close()
+
 
-@click.command()
+def _memory_options(func):
+    func = click.option('--tier', type=click.Choice(list(_TIERS)),
+                        default='all', show_default=True,
+                        help='Memories to dump or load.')(func)
+    func = click.option('--persistent-mem',
+                        type=click.Choice(['REDIS', 'FILE', 'MMAP']),
+                        default='REDIS', show_default=True,
+                        help='Persistent memory backend.')(func)
+    func = click.option('--storage-path', default='derpme.log',
+                        show_default=True,
+                        help='Data file of the FILE/MMAP memory. Stop the '
+                             'server before using it.')(func)
+    return func
+
+
+@click.group()
 def main(args=None):
     """Console script for derp_me."""
-    click.echo("Replace this message by putting your code into "
-               "derp_me.cli.main")
-    click.echo("See click documentation at https://click.palletsprojects.com/")
+
+
+@main.command()
+@click.argument('path', type=click.Path(dir_okay=False))
+@_memory_options
+@click.option('--match', default=None, help='Glob pattern of the keys.')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Keys per compressed chunk.')
+@click.option('--list-size', default=10, show_default=True,
+              help='Max size of lists, recorded in the snapshot.')
+def dump(path, tier, persistent_mem, storage_path, match, chunk_size,
+         list_size):
+    """Dump the memories to a snapshot file."""
+    t0 = time.perf_counter()
+    mems = _open_memories(_TIERS[tier], persistent_mem, storage_path,
+                          list_size)
+    try:
+        with open(path, 'wb') as fp:
+            count = snapshot.dump(mems, fp, match=match, count=chunk_size,
+                                  header={'list_size': list_size})
+    finally:
+        _close(mems)
+    click.echo('Dumped {} keys to {} in {:.2f}s'.format(
+        count, path, time.perf_counter() - t0))
+    return 0
+
+
+@main.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@_memory_options
+@click.option('--flush', is_flag=True,
+              help='Delete the keys of the memories first.')
+@click.option('--list-size', default=None, type=int,
+              help='Max size of lists. Defaults to the one of the '
+                   'snapshot.')
+def load(path, tier, persistent_mem, storage_path, flush, list_size):
+    """Load a snapshot file into the memories."""
+    t0 = time.perf_counter()
+    with open(path, 'rb') as fp:
+        try:
+            reader = snapshot.SnapshotReader(fp)
+        except snapshot.SnapshotError as exc:
+            raise click.ClickException(str(exc))
+        if list_size is None:
+            list_size = reader.header.get('list_size', 10)
+        mems = _open_memories(_TIERS[tier], persistent_mem, storage_path,
+                              list_size)
+        try:
+            count = snapshot.load(mems, reader, flush=flush)
+        finally:
+            _close(mems)
+    click.echo('Loaded {} keys from {} in {:.2f}s'.format(
+        count, path, time.perf_counter() - t0))
     return 0
 
 
@@ -1,24 +1,379 @@
+import asyncio
+import base64
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
 from commlib.logger import Logger
 
 from commlib.endpoints import TransportType
 
+from . import codec
+from . import series
+from .keyindex import glob_match
+
+
+def _typed_response(resp: dict) -> dict:
+    """_typed_response.
+    Unpack the typed series of an lget response in place (see
+    DerpMeClient.lget).
+    """
+    if resp.get('status', 0):
+        val = resp['val']
+        resp['dtype'] = val['dtype']
+        resp['val'] = series.view(base64.b64decode(val['data']),
+                                  val['dtype'])
+        resp['timestamps'] = None if not val['timestamps'] else \
+            series.view(base64.b64decode(val['timestamps']), 'float64')
+    return resp
+
+
+class ReadCache(object):
+    """ReadCache.
+    LRU cache with optional TTL expiration, used by DerpMeClient to serve
+    repeated reads locally.
+    To avoid caching a value that was invalidated while its request was in
+    flight, readers take a token(key) before the request and hand it to
+    put(), which drops the value if its key was invalidated in between.
+    Keys are versioned in hash buckets, so writes to other keys seldom
+    prevent caching a response.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = None,
+                 buckets: int = 4096):
+        """__init__.
+
+        Args:
+            max_size (int): Max number of cached entries
+            ttl (float): Seconds an entry stays valid. None for no expiration
+            buckets (int): Number of invalidation version counters
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._versions = [0] * buckets
+        # Bumped by invalidate_if(), which may drop any key
+        self._epoch = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _bucket(self, key) -> int:
+        return hash(key) % len(self._versions)
+
+    def token(self, key) -> tuple:
+        return self._epoch, self._versions[self._bucket(key)]
+
+    def get(self, key):
+        """get.
+        Returns the cached value or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                val, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return val
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, val, token: int = None) -> None:
+        with self._lock:
+            if token is not None and token != self.token(key):
+                return
+            expires = None if self.ttl is None else \
+                time.monotonic() + self.ttl
+            self._entries[key] = (val, expires)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys) -> None:
+        with self._lock:
+            self.invalidations += 1
+            versions = self._versions
+            for key in keys:
+                versions[self._bucket(key)] += 1
+                self._entries.pop(key, None)
+
+    def invalidate_if(self, predicate) -> None:
+        with self._lock:
+            self.invalidations += 1
+            self._epoch += 1
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        self.invalidate_if(lambda key: True)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+
+class DerpMePipeline(object):
+    """DerpMePipeline.
+    Buffers operations and sends them to derp-me as a single batch request.
+    Results are returned by execute(), in the order the operations were
+    issued, each one being the response of the corresponding endpoint.
+
+        with client.pipeline() as pipe:
+            pipe.get('k1')
+            pipe.lset('k2', [1, 2])
+        print(pipe.results)
+    """
+
+    def __init__(self, client):
+        """__init__.
+
+        Args:
+            client (DerpMeClient): Client used to send the batch
+        """
+        self._client = client
+        self._ops = []
+        self.results = []
+
+    def __len__(self):
+        return len(self._ops)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.reset()
+
+    def reset(self):
+        """reset.
+        Discard the buffered operations.
+        """
+        self._ops = []
+
+    def execute(self) -> list:
+        """execute.
+        Send the buffered operations and return their results.
+        """
+        if not self._ops:
+            return []
+        ops = self._ops
+        self.reset()
+        for op in ops:
+            if op['op'] == 'flush':
+                self._client._invalidate_local([], flush=True)
+            elif op['op'] in ('set', 'lset'):
+                self._client._invalidate_local([op['key']], op['persistent'])
+            elif op['op'] == 'mset':
+                self._client._invalidate_local(op['keys'], op['persistent'])
+        resp = self._client._call(self._client._rpc('batch'),
+                                  {'ops': ops})
+        if not resp.get('status', 0):
+            raise RuntimeError(resp.get('error', 'Batch request failed'))
+        self.results = resp['results']
+        for op, result in zip(ops, self.results):
+            if op.get('typed'):
+                _typed_response(result)
+        return self.results
+
+    def get(self, key: str, persistent: bool = False):
+        self._ops.append({
+            'op': 'get',
+            'key': key,
+            'persistent': persistent
+        })
+        return self
+
+    def set(self, key: str, val: Any, persistent: bool = False,
+            ttl: float = None):
+        self._ops.append({
+            'op': 'set',
+            'key': key,
+            'val': val,
+            'persistent': persistent,
+            'ttl': ttl
+        })
+        return self
+
+    def mget(self, keys: list, persistent: bool = False):
+        self._ops.append({
+            'op': 'mget',
+            'keys': keys,
+            'persistent': persistent
+        })
+        return self
+
+    def mset(self, keys: list, vals: list, persistent: bool = False,
+             ttl: float = None):
+        self._ops.append({
+            'op': 'mset',
+            'keys': keys,
+            'vals': vals,
+            'persistent': persistent,
+            'ttl': ttl
+        })
+        return self
+
+    def lget(self, key: str, l_from: int, l_to: int, persistent: bool = False,
+             typed: bool = False):
+        op = {
+            'op': 'lget',
+            'key': key,
+            'l_from': l_from,
+            'l_to': l_to,
+            'persistent': persistent
+        }
+        if typed:
+            op['typed'] = True
+        self._ops.append(op)
+        return self
+
+    def lset(self, key: str, vals: list, persistent: bool = False,
+             ttl: float = None, dtype: str = None, timestamps: list = None):
+        op = {
+            'op': 'lset',
+            'key': key,
+            'vals': vals,
+            'persistent': persistent,
+            'ttl': ttl
+        }
+        if dtype is not None:
+            op['dtype'] = dtype
+            if timestamps is not None:
+                op['timestamps'] = timestamps
+        self._ops.append(op)
+        return self
+
+    def expire(self, key: str, ttl: float, persistent: bool = False):
+        self._ops.append({
+            'op': 'expire',
+            'key': key,
+            'ttl': ttl,
+            'persistent': persistent
+        })
+        return self
+
+    def ttl(self, key: str, persistent: bool = False):
+        self._ops.append({
+            'op': 'ttl',
+            'key': key,
+            'persistent': persistent
+        })
+        return self
+
+    def persist(self, key: str, persistent: bool = False):
+        self._ops.append({
+            'op': 'persist',
+            'key': key,
+            'persistent': persistent
+        })
+        return self
+
+    def flush(self):
+        self._ops.append({'op': 'flush'})
+        return self
+
+
+class ChangeWatch(object):
+    """ChangeWatch.
+    Subscription to the change events of the keys matching a glob pattern
+    (see derp_me.changes.ChangeFeed). Events published on the topic of
+    their key are filtered by the broker, those published in chunks are
+    filtered locally. Flush events are delivered to every watch.
+    """
+
+    def __init__(self, comm, conn_params, prefix: str, pattern: str,
+                 callback):
+        """__init__.
+
+        Args:
+            comm: commlib transport module
+            conn_params: Broker Connection Parameters
+            prefix (str): Topic prefix of the change events
+            pattern (str): Glob pattern of the watched keys
+            callback: Called with each change event
+        """
+        self.pattern = pattern
+        self._callback = callback
+        self._key_sub = comm.PSubscriber(
+            conn_params=conn_params,
+            topic='{}.{}'.format(prefix, pattern),
+            on_message=self._on_event)
+        self._chunk_sub = comm.Subscriber(
+            conn_params=conn_params,
+            topic=prefix,
+            on_message=self._on_events)
+
+    def run(self) -> None:
+        self._key_sub.run()
+        self._chunk_sub.run()
+
+    def stop(self) -> None:
+        self._key_sub.stop()
+        self._chunk_sub.stop()
+
+    def _on_event(self, msg, *args):
+        if glob_match(self.pattern, msg.get('key', '')):
+            self._callback(msg)
+
+    def _on_events(self, msg, *args):
+        for event in msg.get('events', []):
+            if event['op'] == 'flush' or \
+                    glob_match(self.pattern, event['key']):
+                self._callback(event)
+
 
 class DerpMeClient(object):
     def __init__(self,
                  iface_protocol: TransportType = TransportType.REDIS,
                  conn_params: Any = None,
-                 namespace: str = 'device'):
+                 namespace: str = 'device',
+                 cache_size: int = 0,
+                 cache_ttl: float = None,
+                 encoding: str = None,
+                 timeout: float = None):
         """__init__.
 
         Args:
             iface_protocol: Interface protocol (REDIS/AMQP)
             conn_params: Broker Connection Parameters
             namespace: Global namespace
+            cache_size: Number of get() responses to cache locally. The
+                cache is disabled when 0
+            cache_ttl: Seconds a cached response stays valid. None to rely
+                only on the invalidation events of derp-me
+            encoding: Compact encoding to negotiate for values on the wire
+                (e.g. 'msgpack'). Plain JSON is used until derp-me answers
+                with the same encoding, so old servers keep working
+            timeout: Seconds to wait for each response. None for the
+                default of the transport
         """
         self.namespace = namespace
+        self.timeout = timeout
         self.logger = Logger(namespace=self.__class__.__name__)
+        if encoding is not None and \
+                encoding not in codec.available_encodings():
+            raise ValueError('Unsupported encoding <{}>'.format(encoding))
+        self._encoding = encoding
+        self._peer_encoding = None
 
         if iface_protocol == TransportType.AMQP:
             import commlib.transports.amqp as comm
@@ -26,6 +381,7 @@ class DerpMeClient(object):
             import commlib.transports.redis as comm
         else:
             raise TypeError()
+        self._comm = comm
         self._conn_params = conn_params if conn_params \
             is not None else comm.ConnectionParameters()
 
@@ -35,26 +391,98 @@ class DerpMeClient(object):
         self._mset_uri = '{}.{}.{}'.format(self.namespace, 'derpme', 'mset')
         self._lget_uri = '{}.{}.{}'.format(self.namespace, 'derpme', 'lget')
         self._lset_uri = '{}.{}.{}'.format(self.namespace, 'derpme', 'lset')
+        self._lscan_uri = '{}.{}.{}'.format(self.namespace, 'derpme', 'lscan')
+        self._scan_uri = '{}.{}.{}'.format(self.namespace, 'derpme', 'scan')
+        self._mget_prefix_uri = '{}.{}.{}'.format(self.namespace, 'derpme',
+                                                  'mget_prefix')
         self._flush_uri = '{}.{}.{}'.format(self.namespace, 'derpme', 'flush')
+        self._batch_uri = '{}.{}.{}'.format(self.namespace, 'derpme', 'batch')
+        self._expire_uri = '{}.{}.{}'.format(self.namespace, 'derpme',
+                                             'expire')
+        self._ttl_uri = '{}.{}.{}'.format(self.namespace, 'derpme', 'ttl')
+        self._persist_uri = '{}.{}.{}'.format(self.namespace, 'derpme',
+                                              'persist')
+        self._stats_uri = '{}.{}.{}'.format(self.namespace, 'derpme', 'stats')
+        self._changes_uri = '{}.{}.{}'.format(self.namespace, 'derpme',
+                                              'changes')
 
-        self._get_rpc = comm.RPCClient(conn_params=self._conn_params,
-                                       rpc_name=self._get_uri)
-        self._set_rpc = comm.RPCClient(conn_params=self._conn_params,
-                                       rpc_name=self._set_uri)
-        self._mget_rpc = comm.RPCClient(conn_params=self._conn_params,
-                                        rpc_name=self._mget_uri)
-        self._mset_rpc = comm.RPCClient(conn_params=self._conn_params,
-                                        rpc_name=self._mset_uri)
-        self._lget_rpc = comm.RPCClient(conn_params=self._conn_params,
-                                        rpc_name=self._lget_uri)
-        self._lset_rpc = comm.RPCClient(conn_params=self._conn_params,
-                                        rpc_name=self._lset_uri)
-        self._flush_rpc = comm.RPCClient(conn_params=self._conn_params,
-                                         rpc_name=self._flush_uri)
+        # RPC clients are created by _rpc() on first use, so that every
+        # client only connects to the services it calls
+        self._rpcs = {}
+        self._rpcs_lock = threading.Lock()
+
+        self._cache = None
+        if cache_size > 0:
+            self._cache = ReadCache(max_size=cache_size, ttl=cache_ttl)
+            self._invalidate_uri = '{}.{}.{}'.format(
+                self.namespace, 'derpme', 'invalidate')
+            self._invalidate_sub = comm.Subscriber(
+                conn_params=self._conn_params,
+                topic=self._invalidate_uri,
+                on_message=self._on_invalidate)
+            self._invalidate_sub.run()
+
+    def _rpc(self, name: str):
+        """_rpc.
+        The RPC client of a service (get, set, ...), created on first use.
+        """
+        rpc = self._rpcs.get(name)
+        if rpc is None:
+            with self._rpcs_lock:
+                rpc = self._rpcs.get(name)
+                if rpc is None:
+                    rpc = self._comm.RPCClient(
+                        conn_params=self._conn_params,
+                        rpc_name=getattr(self, '_{}_uri'.format(name)))
+                    self._rpcs[name] = rpc
+        return rpc
+
+    def _call(self, rpc, req: dict) -> dict:
+        """_call.
+        Call an RPC, encoding the request values once derp-me is known to
+        support the configured encoding.
+        """
+        if self._encoding is not None:
+            req['accept'] = self._encoding
+            if self._peer_encoding == self._encoding:
+                req = codec.encode_message(req, self._encoding)
+        if self.timeout is None:
+            resp = rpc.call(req)
+        else:
+            resp = rpc.call(req, timeout=self.timeout)
+        if self._encoding is not None and 'encoding' in resp:
+            self._peer_encoding = resp['encoding']
+        return codec.decode_message(resp)
+
+    def _on_invalidate(self, msg, meta=None):
+        """_on_invalidate.
+        Invalidation events published by derp-me on every write.
+        """
+        self._invalidate_local(msg.get('keys', []),
+                               msg.get('persistent', False),
+                               msg.get('flush', False))
+
+    def _invalidate_local(self, keys: list, persistent: bool = False,
+                          flush: bool = False):
+        if self._cache is None:
+            return
+        if flush:
+            # Flush only drops the runtime memory
+            self._cache.invalidate_if(lambda key: not key[1])
+        else:
+            self._cache.invalidate([(key, bool(persistent)) for key in keys])
+
+    def cache_stats(self) -> dict:
+        """cache_stats.
+        Returns the hit/miss counters of the local read cache.
+        """
+        if self._cache is None:
+            return {}
+        return self._cache.stats()
 
     def get(self, key: str, persistent: bool = False):
         """get.
-        Get value of a key.
+        Get value of a key. Served from the local cache when enabled.
 
         Args:
             key (str): key
@@ -64,52 +492,134 @@ class DerpMeClient(object):
             'key': key,
             'persistent': persistent
         }
-        return self._get_rpc.call(req)
+        if self._cache is None:
+            return self._call(self._rpc('get'), req)
+        cache_key = (key, bool(persistent))
+        resp = self._cache.get(cache_key)
+        if resp is not None:
+            return dict(resp)
+        token = self._cache.token(cache_key)
+        resp = self._call(self._rpc('get'), req)
+        if resp.get('status', 0):
+            self._cache.put(cache_key, dict(resp), token)
+        return resp
 
-    def set(self, key: str, val: Any, persistent: bool = False):
+    def set(self, key: str, val: Any, persistent: bool = False,
+            ttl: float = None):
         """set.
         Set the value of a key.
 
         Args:
             key:
             val:
+            ttl: Seconds until the key expires
         """
         req = {
             'key': key,
             'val': val,
             'persistent': persistent
         }
-        return self._set_rpc.call(req)
+        if ttl is not None:
+            req['ttl'] = ttl
+        self._invalidate_local([key], persistent)
+        return self._call(self._rpc('set'), req)
 
-    def mget(self, key: str, persistent: bool = False):
+    def mget(self, keys: list, persistent: bool = False):
         """mget.
 
         Args:
-            key (str): key
+            keys (list): keys
             persistent (bool): persistent
         """
         req = {
-            'key': key,
+            'keys': keys,
             'persistent': persistent
         }
-        return self._mget_rpc.call(req)
+        return self._call(self._rpc('mget'), req)
 
-    def mset(self, keys: list, vals: list, persistent: bool = False):
+    def mset(self, keys: list, vals: list, persistent: bool = False,
+             ttl: float = None):
         """mset.
 
         Args:
             keys (list): keys
             vals (list): vals
             persistent (bool): persistent
+            ttl (float): Seconds until the keys expire
         """
         req = {
             'keys': keys,
             'vals': vals,
             'persistent': persistent
         }
-        return self._mset_rpc.call(req)
+        if ttl is not None:
+            req['ttl'] = ttl
+        self._invalidate_local(keys, persistent)
+        return self._call(self._rpc('mset'), req)
+
+    def scan(self, match: str = None, cursor=0, count: int = 100,
+             persistent: bool = False):
+        """scan.
+        One step of an incremental iteration over the keys. Returns the
+        matching keys in <keys> and the cursor of the next step in
+        <cursor>, 0 once the iteration is complete.
 
-    def lget(self, key: str, l_from: int, l_to: int, persistent: bool = False):
+        Args:
+            match (str): Glob pattern of the keys, e.g. 'robot1.sensors.*'
+            cursor: 0 to start, otherwise the cursor of the previous step
+            count (int): Approximate number of keys visited
+            persistent (bool): persistent
+        """
+        req = {
+            'cursor': cursor,
+            'count': count,
+            'persistent': persistent
+        }
+        if match is not None:
+            req['match'] = match
+        return self._call(self._rpc('scan'), req)
+
+    def scan_iter(self, match: str = None, count: int = 100,
+                  persistent: bool = False):
+        """scan_iter.
+        Iterate over the keys matching a glob pattern, one scan request at
+        a time. A key may be returned more than once.
+
+        Raises:
+            RuntimeError: A request failed
+        """
+        cursor = 0
+        while True:
+            resp = self.scan(match, cursor, count, persistent)
+            if not resp.get('status', 0):
+                raise RuntimeError(resp.get('error', 'scan failed'))
+            for key in resp['keys']:
+                yield key
+            cursor = resp['cursor']
+            if not cursor:
+                return
+
+    def mget_prefix(self, prefix: str, limit: int = 1000,
+                    persistent: bool = False):
+        """mget_prefix.
+        Get the values of the keys starting with prefix, in one request.
+        Returns a {key: value} dict in <val>. <truncated> is set if more
+        than limit keys matched.
+
+        Args:
+            prefix (str): Key prefix, e.g. 'robot1.sensors.'
+            limit (int): Max number of keys
+            persistent (bool): persistent
+        """
+        req = {
+            'prefix': prefix,
+            'limit': limit,
+            'persistent': persistent
+        }
+        return self._call(self._rpc('mget_prefix'), req)
+
+    def lget(self, key: str, l_from: int, l_to: int, persistent: bool = False,
+             typed: bool = False):
         """lget.
 
         Args:
@@ -117,6 +627,10 @@ class DerpMeClient(object):
             l_from (int): l_from
             l_to (int): l_to
             persistent (bool): persistent
+            typed (bool): Read a typed series (see lset). The samples are
+                returned oldest first, in <val>, as a memoryview over the
+                packed buffer that numpy.frombuffer() can wrap without a
+                copy. Timestamps, if any, are returned in <timestamps>
         """
         req = {
             'key': key,
@@ -124,25 +638,323 @@ class DerpMeClient(object):
             'l_to': l_to,
             'persistent': persistent
         }
-        return self._lget_rpc.call(req)
+        if typed:
+            req['typed'] = True
+        resp = self._call(self._rpc('lget'), req)
+        if typed:
+            _typed_response(resp)
+        return resp
 
-    def lset(self, key: str, vals: list, persistent: bool = False):
+    def lscan(self, key: str, count: int = 100, persistent: bool = False):
+        """lscan.
+        Iterate over a list, newest items first, fetching <count> items per
+        request, so that memory use does not depend on the list length.
+
+        Args:
+            key (str): key
+            count (int): Items fetched per request
+            persistent (bool): persistent
+
+        Raises:
+            RuntimeError: The list does not exist or a request failed
+        """
+        cursor = 0
+        while True:
+            resp = self._call(self._rpc('lscan'), {
+                'key': key,
+                'cursor': cursor,
+                'count': count,
+                'persistent': persistent
+            })
+            if not resp.get('status', 0):
+                raise RuntimeError(resp.get('error', 'lscan failed'))
+            for item in resp['val']:
+                yield item
+            cursor = resp['cursor']
+            if cursor == 0:
+                return
+
+    def lset(self, key: str, vals: list, persistent: bool = False,
+             dtype: str = None, timestamps: list = None, ttl: float = None):
         """lset.
 
         Args:
             key (str): key
             vals (list): vals
             persistent (bool): persistent
+            dtype (str): Store vals in a typed series of this dtype
+                (float32, float64, int, ...) instead of a list
+            timestamps (list): Per-sample timestamps of a typed series
+            ttl (float): Seconds until the list expires
         """
         req = {
             'key': key,
             'vals': vals,
             'persistent': persistent
         }
-        return self._lset_rpc.call(req)
+        if ttl is not None:
+            req['ttl'] = ttl
+        if dtype is not None:
+            req['dtype'] = dtype
+            if timestamps is not None:
+                req['timestamps'] = timestamps
+        self._invalidate_local([key], persistent)
+        return self._call(self._rpc('lset'), req)
+
+    def expire(self, key: str, ttl: float, persistent: bool = False):
+        """expire.
+        Set the time to live of a key. <val> is False if the key does not
+        exist.
+
+        Args:
+            key (str): key
+            ttl (float): Seconds until the key expires
+            persistent (bool): persistent
+        """
+        req = {
+            'key': key,
+            'ttl': ttl,
+            'persistent': persistent
+        }
+        return self._call(self._rpc('expire'), req)
+
+    def ttl(self, key: str, persistent: bool = False):
+        """ttl.
+        <val> holds the seconds until the key expires, -1 if it has no time
+        to live and -2 if it does not exist.
+
+        Args:
+            key (str): key
+            persistent (bool): persistent
+        """
+        req = {
+            'key': key,
+            'persistent': persistent
+        }
+        return self._call(self._rpc('ttl'), req)
+
+    def persist(self, key: str, persistent: bool = False):
+        """persist.
+        Remove the time to live of a key.
+
+        Args:
+            key (str): key
+            persistent (bool): persistent
+        """
+        req = {
+            'key': key,
+            'persistent': persistent
+        }
+        return self._call(self._rpc('persist'), req)
 
     def flush(self):
         """flush.
         Flush data currently stored in db.
         """
-        return self._flush_rpc.call({})
+        self._invalidate_local([], flush=True)
+        return self._call(self._rpc('flush'), {})
+
+    def stats(self, prometheus: bool = False):
+        """stats.
+        Returns runtime statistics and request metrics of derp-me.
+
+        Args:
+            prometheus (bool): Get the metrics in Prometheus text format
+        """
+        req = {'format': 'prometheus'} if prometheus else {}
+        return self._call(self._rpc('stats'), req)
+
+    def watch(self, pattern: str, callback) -> ChangeWatch:
+        """watch.
+        Subscribe to the change events of the keys matching a glob pattern,
+        e.g. 'sensors.*'. Requires derp-me to publish changes.
+
+        Args:
+            pattern (str): Glob pattern of the watched keys
+            callback: Called with each change event, a dict with the <op>,
+                <key>, <persistent> and <val> (set) or <vals> (lset)
+                fields. Flush events have no <key>
+
+        Returns:
+            ChangeWatch: Call stop() to unsubscribe
+        """
+        watch = ChangeWatch(self._comm, self._conn_params, self._changes_uri,
+                            pattern, callback)
+        watch.run()
+        return watch
+
+    def pipeline(self):
+        """pipeline.
+        Returns a pipeline that buffers calls and sends them as one batch
+        request, when execute() is called or the context manager exits.
+        """
+        return DerpMePipeline(self)
+
+
+class AsyncDerpMeClient(object):
+    """AsyncDerpMeClient.
+    asyncio flavour of DerpMeClient: every call is a coroutine, so a
+    coroutine can have many requests in flight without blocking the event
+    loop. It is a wrapper around a thread pool of blocking DerpMeClients,
+    one per worker thread, not asynchronous I/O: commlib RPC clients block
+    until their response, so requests are not multiplexed by id on one
+    connection. Each request occupies a thread until its response arrives
+    or its timeout expires, and every worker opens an RPC client per
+    service it actually calls, on first use. Size `max_concurrency` with
+    that in mind.
+
+    At most `max_concurrency` requests run at the same time, per event
+    loop. A request that times out is passed its timeout by its blocking
+    call too, and keeps its slot until that call returns, so the bound
+    also holds for abandoned requests.
+    """
+
+    def __init__(self,
+                 iface_protocol: TransportType = TransportType.REDIS,
+                 conn_params: Any = None,
+                 namespace: str = 'device',
+                 max_concurrency: int = 16,
+                 timeout: float = 30.0,
+                 encoding: str = None):
+        """__init__.
+
+        Args:
+            iface_protocol: Interface protocol (REDIS/AMQP)
+            conn_params: Broker Connection Parameters
+            namespace: Global namespace
+            max_concurrency: Max number of requests in flight, and of
+                worker threads
+            timeout: Default per-call timeout in seconds
+            encoding: Compact encoding to negotiate (see DerpMeClient)
+        """
+        self.namespace = namespace
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.logger = Logger(namespace=self.__class__.__name__)
+        self._iface_protocol = iface_protocol
+        self._conn_params = conn_params
+        self._encoding = encoding
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix=self.__class__.__name__
+        )
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        # One semaphore per event loop, they cannot be shared across loops
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    @property
+    def in_flight(self) -> int:
+        """in_flight.
+        Number of requests holding a worker thread, including the ones
+        that timed out but whose blocking call has not returned yet.
+        """
+        return self._in_flight
+
+    def _thread_client(self) -> DerpMeClient:
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = DerpMeClient(iface_protocol=self._iface_protocol,
+                                  conn_params=self._conn_params,
+                                  namespace=self.namespace,
+                                  encoding=self._encoding)
+            self._local.client = client
+        return client
+
+    def _do_call(self, method: str, args: tuple, timeout: float):
+        client = self._thread_client()
+        client.timeout = timeout
+        return getattr(client, method)(*args)
+
+    def _release(self, loop, semaphore) -> None:
+        with self._lock:
+            self._in_flight -= 1
+        try:
+            loop.call_soon_threadsafe(semaphore.release)
+        except RuntimeError:
+            # The event loop is closed
+            pass
+
+    async def _call(self, method: str, *args, timeout: float = None):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphores[loop] = semaphore
+        timeout = self.timeout if timeout is None else timeout
+        await semaphore.acquire()
+        try:
+            fut = self._executor.submit(self._do_call, method, args,
+                                        timeout)
+        except BaseException:
+            semaphore.release()
+            raise
+        with self._lock:
+            self._in_flight += 1
+        # Released once the thread is done, not when the caller gives up
+        fut.add_done_callback(
+            lambda _: self._release(loop, semaphore))
+        afut = asyncio.wrap_future(fut)
+        # Retrieve the errors of abandoned requests
+        afut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return await asyncio.wait_for(asyncio.shield(afut), timeout)
+
+    async def get(self, key: str, persistent: bool = False,
+                  timeout: float = None):
+        return await self._call('get', key, persistent, timeout=timeout)
+
+    async def set(self, key: str, val: Any, persistent: bool = False,
+                  ttl: float = None, timeout: float = None):
+        return await self._call('set', key, val, persistent, ttl,
+                                timeout=timeout)
+
+    async def mget(self, keys: list, persistent: bool = False,
+                   timeout: float = None):
+        return await self._call('mget', keys, persistent, timeout=timeout)
+
+    async def mset(self, keys: list, vals: list, persistent: bool = False,
+                   ttl: float = None, timeout: float = None):
+        return await self._call('mset', keys, vals, persistent, ttl,
+                                timeout=timeout)
+
+    async def lget(self, key: str, l_from: int, l_to: int,
+                   persistent: bool = False, typed: bool = False,
+                   timeout: float = None):
+        return await self._call('lget', key, l_from, l_to, persistent,
+                                typed, timeout=timeout)
+
+    async def lset(self, key: str, vals: list, persistent: bool = False,
+                   dtype: str = None, timestamps: list = None,
+                   ttl: float = None, timeout: float = None):
+        return await self._call('lset', key, vals, persistent, dtype,
+                                timestamps, ttl, timeout=timeout)
+
+    async def expire(self, key: str, ttl: float, persistent: bool = False,
+                     timeout: float = None):
+        return await self._call('expire', key, ttl, persistent,
+                                timeout=timeout)
+
+    async def ttl(self, key: str, persistent: bool = False,
+                  timeout: float = None):
+        return await self._call('ttl', key, persistent, timeout=timeout)
+
+    async def persist(self, key: str, persistent: bool = False,
+                      timeout: float = None):
+        return await self._call('persist', key, persistent, timeout=timeout)
+
+    async def flush(self, timeout: float = None):
+        return await self._call('flush', timeout=timeout)
+
+    def close(self):
+        """close.
+        Release the worker threads once their requests are done. Requests
+        in flight are abandoned.
+        """
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
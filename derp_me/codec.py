@@ -0,0 +1,204 @@
+"""Compact encodings of derp-me messages."""
+
+import base64
+import json
+import sys
+from array import array
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+# Message fields that carry user values and get packed into <payload>
+VALUE_FIELDS = ('val', 'vals', 'results', 'ops')
+
+# msgpack extension type of packed homogeneous numeric lists
+_EXT_NUMERIC = 1
+# Shorter numeric lists are not worth packing
+_NUMERIC_MIN_LEN = 8
+
+_json_encode = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def available_encodings() -> list:
+    """available_encodings.
+    Encodings supported in this environment, best first.
+    """
+    if msgpack is not None:
+        return [MSGPACK, JSON]
+    return [JSON]
+
+
+def negotiate(accept) -> str:
+    """negotiate.
+    Pick the encoding of a response given the <accept> field of a request.
+
+    Args:
+        accept: An encoding name or a list of them, in order of preference
+    """
+    if not accept:
+        return JSON
+    if isinstance(accept, str):
+        accept = [accept]
+    supported = available_encodings()
+    for enc in accept:
+        if enc in supported:
+            return enc
+    return JSON
+
+
+# Fixed-size array typecodes of ints, narrowest first, with their range
+_INT_TYPECODES = (
+    ('b', -2**7, 2**7),
+    ('h', -2**15, 2**15),
+    ('i', -2**31, 2**31),
+    ('q', -2**63, 2**63)
+)
+
+
+def _numeric_array(vals: list):
+    """_numeric_array.
+    Returns an array of the narrowest typecode that holds every element of
+    vals without loss, or None if vals is not a homogeneous list of ints or
+    floats.
+    """
+    if len(vals) < _NUMERIC_MIN_LEN:
+        return None
+    first = type(vals[0])
+    if first is float:
+        for v in vals:
+            if type(v) is not float:
+                return None
+        arr = array('f', vals)
+        # float32 only if every value survives the round trip
+        if arr.tolist() == vals:
+            return arr
+        return array('d', vals)
+    if first is int:
+        for v in vals:
+            if type(v) is not int:
+                return None
+        lo, hi = min(vals), max(vals)
+        for typecode, t_min, t_max in _INT_TYPECODES:
+            if t_min <= lo and hi < t_max:
+                return array(typecode, vals)
+    return None
+
+
+def _msgpack_default(obj):
+    raise TypeError('Cannot serialize {}'.format(type(obj)))
+
+
+def _pack_numeric(obj):
+    """_pack_numeric.
+    Recursively replace homogeneous numeric lists with msgpack extension
+    objects holding their raw little-endian array buffer, where that is
+    smaller than the msgpack list.
+    """
+    if isinstance(obj, list):
+        arr = _numeric_array(obj)
+        if arr is not None:
+            if sys.byteorder != 'little':
+                arr.byteswap()
+            data = arr.typecode.encode() + arr.tobytes()
+            # msgpack stores small ints in a single byte
+            if len(data) < len(msgpack.packb(obj)):
+                return msgpack.ExtType(_EXT_NUMERIC, data)
+            return obj
+        return [_pack_numeric(x) for x in obj]
+    if isinstance(obj, dict):
+        return {k: _pack_numeric(v) for k, v in obj.items()}
+    return obj
+
+
+def _ext_hook(code: int, data: bytes):
+    if code == _EXT_NUMERIC:
+        arr = array(chr(data[0]))
+        arr.frombytes(data[1:])
+        if sys.byteorder != 'little':
+            arr.byteswap()
+        return arr.tolist()
+    return msgpack.ExtType(code, data)
+
+
+def dumps(obj, encoding: str = MSGPACK) -> str:
+    """dumps.
+    Serialize obj to a base64 string, so it can travel inside the JSON
+    messages of the transport.
+    """
+    if encoding == MSGPACK:
+        data = msgpack.packb(_pack_numeric(obj), use_bin_type=True,
+                             default=_msgpack_default)
+    elif encoding == JSON:
+        data = _json_encode(obj).encode()
+    else:
+        raise ValueError('Unsupported encoding <{}>'.format(encoding))
+    return base64.b64encode(data).decode('ascii')
+
+
+def loads(payload: str, encoding: str = MSGPACK):
+    """loads.
+    Inverse of dumps().
+    """
+    data = base64.b64decode(payload)
+    if encoding == MSGPACK:
+        if msgpack is None:
+            raise ValueError('Unsupported encoding <{}>'.format(encoding))
+        return msgpack.unpackb(data, raw=False, ext_hook=_ext_hook)
+    elif encoding == JSON:
+        return json.loads(data)
+    raise ValueError('Unsupported encoding <{}>'.format(encoding))
+
+
+def encode_message(msg: dict, encoding: str) -> dict:
+    """encode_message.
+    Move the value fields of msg into an encoded <payload> field, unless
+    the payload is not smaller than the JSON of the values, e.g. floats
+    with few digits. Messages are left untouched for the JSON encoding.
+    """
+    if encoding == JSON:
+        return msg
+    values = {}
+    for field in VALUE_FIELDS:
+        if field in msg:
+            values[field] = msg[field]
+    msg['encoding'] = encoding
+    if values:
+        payload = dumps(values, encoding)
+        if len(payload) < len(_json_encode(values)):
+            for field in values:
+                del msg[field]
+            msg['payload'] = payload
+    return msg
+
+
+def decode_message(msg: dict) -> dict:
+    """decode_message.
+    Inverse of encode_message(). Plain JSON messages are returned as is.
+    """
+    if 'payload' not in msg:
+        return msg
+    msg.update(loads(msg.pop('payload'), msg.get('encoding', MSGPACK)))
+    return msg
+
+
+def encode_elements(vals: list) -> list:
+    """encode_elements.
+    Encode list elements for storage, one JSON document per element.
+    """
+    return [_json_encode(x) for x in vals]
+
+
+def decode_elements(vals: list) -> list:
+    """decode_elements.
+    Decode stored list elements with a single parser pass over all of them,
+    instead of one json.loads() call per element.
+    """
+    if not vals:
+        return []
+    return json.loads('[' + ','.join(vals) + ']')
@@ -1,14 +1,29 @@
 """Main module."""
 
-import redis
-import json
+import base64
+import os
+import socket
 import time
 import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from enum import IntEnum
 
 from commlib.logger import Logger
 from commlib.node import Node, TransportType
 
+from . import series
+from .codec import (decode_elements, decode_message, encode_elements,
+                    encode_message, negotiate)
+from .dispatcher import Dispatcher, DispatcherBusy, DispatchMode
+from .eviction import EvictionPolicy, approx_size, make_tracker
+from .expiry import ExpiryIndex
+from .keyindex import KeyIndex, escape_glob
+from .metrics import MetricsRegistry
+from .redis_pool import RedisPool, import_redis, load_redis_settings
+
 
 def camelcase_to_snakecase(name):
     """camelcase_to_snakecase.
@@ -21,10 +36,51 @@ def camelcase_to_snakecase(name):
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
 
+def sd_notify(state: str) -> bool:
+    """sd_notify.
+    Send a state (e.g. READY=1) to systemd, if it started the process with
+    a notification socket. Returns whether it was sent.
+    """
+    path = os.environ.get('NOTIFY_SOCKET')
+    if not path:
+        return False
+    if path.startswith('@'):
+        # Abstract namespace socket
+        path = '\0' + path[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.connect(path)
+        sock.sendall(state.encode())
+    return True
+
+
 class LocalMemType(IntEnum):
     """LocalMemType.
     """
     REDIS = 1
+    INPROCESS = 2
+    FILE = 3
+    MMAP = 4
+
+
+def _lrange(items, start: int, stop: int) -> list:
+    """_lrange.
+    Redis LRANGE semantics (inclusive stop, negative offsets counted from
+    the tail) over any sized sequence.
+
+    Args:
+        items: Sequence to slice
+        start (int): start
+        stop (int): stop
+    """
+    size = len(items)
+    if start < 0:
+        start = max(size + start, 0)
+    if stop < 0:
+        stop = size + stop
+    stop = min(stop, size - 1)
+    if start > stop:
+        return []
+    return list(islice(items, start, stop + 1))
 
 
 class Memory:
@@ -35,19 +91,19 @@ class Memory:
     def __init__(self, list_size=10):
         self.list_size = list_size
 
-    def set(self, key: str, val: str) -> None:
+    def set(self, key: str, val: str, ttl: float = None) -> None:
         raise NotImplementedError()
 
     def get(self, key: str):
         raise NotImplementedError()
 
-    def mset(self, keys: list, vals: list) -> None:
+    def mset(self, keys: list, vals: list, ttl: float = None) -> None:
         raise NotImplementedError()
 
     def mget(self, keys: list):
         raise NotImplementedError()
 
-    def lset(self, key: str, vals: list) -> None:
+    def lset(self, key: str, vals: list, ttl: float = None) -> None:
         raise NotImplementedError()
 
     def lget(self, key: str, from_idx: int, to_idx: int) -> list:
@@ -56,6 +112,389 @@ class Memory:
     def llen(self, key) -> int:
         raise NotImplementedError()
 
+    def llen_range(self, key: str, from_idx: int, to_idx: int) -> tuple:
+        """llen_range.
+        Returns the length of a list and the items lget() would return.
+        Backends override it to read both atomically.
+
+        Args:
+            key (str): key
+            from_idx (int): from_idx
+            to_idx (int): to_idx
+        """
+        size = self.llen(key)
+        return size, self.lget(key, from_idx, to_idx) if size else []
+
+    def flush(self) -> None:
+        raise NotImplementedError()
+
+    def delete(self, keys: list) -> int:
+        """delete.
+        Delete keys. Returns the number of keys that existed.
+
+        Args:
+            keys (list): keys
+        """
+        raise NotImplementedError()
+
+    def expire(self, key: str, ttl: float) -> bool:
+        """expire.
+        Set the time to live of a key. Returns False if the key does not
+        exist.
+
+        Args:
+            key (str): key
+            ttl (float): Seconds until the key expires
+        """
+        raise NotImplementedError()
+
+    def ttl(self, key: str) -> float:
+        """ttl.
+        Returns the seconds until a key expires, -1 if the key has no time
+        to live and -2 if it does not exist.
+
+        Args:
+            key (str): key
+        """
+        raise NotImplementedError()
+
+    def persist(self, key: str) -> bool:
+        """persist.
+        Remove the time to live of a key. Returns False if the key does not
+        exist or has no time to live.
+
+        Args:
+            key (str): key
+        """
+        raise NotImplementedError()
+
+    def scan(self, cursor=0, match: str = None, count: int = 100) -> tuple:
+        """scan.
+        Incrementally iterate over the keys, like Redis SCAN. Returns the
+        cursor of the next call, 0 once the iteration is complete, and a
+        list of keys. A key may be returned more than once.
+
+        Args:
+            cursor: 0 to start an iteration, otherwise the returned cursor
+            match (str): Glob pattern of the returned keys
+            count (int): Approximate number of keys visited per call
+        """
+        raise NotImplementedError()
+
+    def scan_prefix(self, prefix: str, limit: int) -> list:
+        """scan_prefix.
+        Returns up to limit keys starting with prefix. This default runs a
+        scan until it completes or enough keys are found. Backends with a
+        sorted key index override it.
+
+        Args:
+            prefix (str): Key prefix
+            limit (int): Max number of keys returned
+        """
+        match = escape_glob(prefix) + '*'
+        keys = []
+        seen = set()
+        cursor = 0
+        while True:
+            cursor, found = self.scan(cursor, match, 1000)
+            for key in found:
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+            if cursor == 0 or len(keys) >= limit:
+                return keys[:limit]
+
+    def expire_due(self, limit: int = None) -> list:
+        """expire_due.
+        Active expiration. Delete keys whose time to live has passed and
+        return them. Backends with native expiry have nothing to do.
+
+        Args:
+            limit (int): Max number of keys to expire
+        """
+        return []
+
+    def memory_stats(self) -> dict:
+        """memory_stats.
+        Returns the memory budget, usage and eviction counters, if the
+        backend enforces a budget.
+        """
+        return {}
+
+    def execute(self, ops: list) -> list:
+        """execute.
+        Execute an ordered list of operations and return their results.
+        Backends that support pipelining override this to run the whole
+        list in a single round trip.
+
+        Args:
+            ops (list): List of (method name, args tuple) pairs
+        """
+        return [getattr(self, name)(*args) for name, args in ops]
+
+    def series_append(self, key: str, data: bytes, itemsize: int,
+                      max_len: int) -> None:
+        """series_append.
+        Append packed samples to a typed series, keeping the newest max_len.
+        This default stores the series base64-encoded through get/set.
+        Backends with native byte strings override it.
+
+        Args:
+            key (str): key
+            data (bytes): Packed samples, oldest first
+            itemsize (int): Size of a sample in bytes
+            max_len (int): Max number of samples kept
+        """
+        buf = self.get(key)
+        buf = base64.b64decode(buf) if buf else b''
+        buf = (buf + data)[-max_len * itemsize:]
+        # Appending must not clear the time to live of the series
+        ttl = self.ttl(key)
+        self.set(key, base64.b64encode(buf).decode('ascii'),
+                 ttl if ttl > 0 else None)
+
+    def series_range(self, key: str, from_idx: int, to_idx: int,
+                     itemsize: int, max_len: int) -> bytes:
+        """series_range.
+        Returns the packed samples of a typed series selected by lget()
+        style indices, oldest first.
+
+        Args:
+            key (str): key
+            from_idx (int): from_idx
+            to_idx (int): to_idx
+            itemsize (int): Size of a sample in bytes
+            max_len (int): Max number of samples kept
+        """
+        buf = self.get(key)
+        buf = base64.b64decode(buf) if buf else b''
+        return bytes(_series_slice(buf, from_idx, to_idx, itemsize, max_len))
+
+    def series_len(self, key: str, itemsize: int, max_len: int) -> int:
+        buf = self.get(key)
+        size = len(base64.b64decode(buf)) // itemsize if buf else 0
+        return min(size, max_len)
+
+
+def _series_slice(buf, from_idx: int, to_idx: int, itemsize: int,
+                  max_len: int):
+    """_series_slice.
+    Select the samples of a packed series buffer by lget() style indices.
+    The buffer may hold more than max_len samples, as trimming is amortized.
+    """
+    size = min(len(buf) // itemsize, max_len)
+    offset = len(buf) - size * itemsize
+    win = series.window(size, from_idx, to_idx)
+    if win is None:
+        return b''
+    return buf[offset + win[0] * itemsize:offset + win[1] * itemsize]
+
+
+def _redis_series_append(client, key: str, data: bytes, itemsize: int,
+                         max_len: int) -> None:
+    """_redis_series_append.
+    Append to a series stored as a Redis string. The string is allowed to
+    grow to twice max_len samples before it is trimmed, which amortizes the
+    cost of rewriting it.
+    """
+    max_bytes = max_len * itemsize
+    if client.append(key, data) <= 2 * max_bytes:
+        return
+
+    def _trim(pipe):
+        buf = pipe.getrange(key, -max_bytes, -1)
+        pipe.multi()
+        pipe.set(key, buf)
+    client.transaction(_trim, key)
+
+
+def _redis_series_range(client, key: str, from_idx: int, to_idx: int,
+                        itemsize: int, max_len: int) -> bytes:
+    """_redis_series_range.
+    Read a window of a series stored as a Redis string. Windows anchored at
+    the newest sample (the common case) are read with a single GETRANGE.
+    """
+    start = -1 * from_idx
+    stop = -1 * to_idx
+    if start >= 0 and stop >= 0:
+        stop = min(stop, max_len - 1)
+        if start > stop:
+            return b''
+        buf = client.getrange(key, -(stop + 1) * itemsize, -1)
+        return buf[:max(len(buf) - start * itemsize, 0)]
+    buf = client.getrange(key, -max_len * itemsize, -1)
+    return _series_slice(buf, from_idx, to_idx, itemsize, max_len)
+
+
+def _ttl_ms(ttl):
+    """_ttl_ms.
+    Convert a time to live in seconds to Redis milliseconds.
+    """
+    if ttl is None:
+        return None
+    return max(int(ttl * 1000), 1)
+
+
+def _redis_ttl(client, key: str) -> float:
+    pttl = client.pttl(key)
+    return pttl if pttl < 0 else pttl / 1000.0
+
+
+def _redis_execute(client, list_size: int, ops: list) -> list:
+    """_redis_execute.
+    Memory.execute() for Redis backends, using a single pipeline.
+
+    Args:
+        client: Redis client
+        list_size (int): Max size of lists
+        ops (list): List of (method name, args tuple) pairs
+    """
+    pipe = client.pipeline(transaction=False)
+    n_cmds = []
+    for name, args in ops:
+        start = len(pipe)
+        # set/mset/lset take an optional time to live after their values
+        ttl = _ttl_ms(args[2]) if name in ('set', 'mset', 'lset') and \
+            len(args) > 2 else None
+        if name == 'get':
+            pipe.get(*args)
+        elif name == 'set':
+            pipe.set(args[0], args[1], px=ttl)
+        elif name == 'mget':
+            pipe.mget(*args)
+        elif name == 'mset':
+            if ttl is None:
+                pipe.mset(dict(zip(args[0], args[1])))
+            else:
+                for key, val in zip(args[0], args[1]):
+                    pipe.set(key, val, px=ttl)
+        elif name == 'lset':
+            pipe.lpush(args[0], *args[1])
+            pipe.ltrim(args[0], 0, list_size - 1)
+            if ttl is not None:
+                pipe.pexpire(args[0], ttl)
+        elif name == 'lget':
+            pipe.lrange(args[0], -1 * args[1], -1 * args[2])
+        elif name == 'llen':
+            pipe.llen(*args)
+        elif name == 'expire':
+            pipe.pexpire(args[0], _ttl_ms(args[1]))
+        elif name == 'ttl':
+            pipe.pttl(*args)
+        elif name == 'persist':
+            pipe.persist(*args)
+        elif name == 'flush':
+            pipe.flushdb()
+        elif name == 'delete':
+            pipe.delete(*args[0])
+        else:
+            raise ValueError('Unsupported operation <{}>'.format(name))
+        n_cmds.append(len(pipe) - start)
+    replies = pipe.execute()
+    results = []
+    idx = 0
+    for (name, _), n in zip(ops, n_cmds):
+        reply = replies[idx]
+        if name in ('get', 'mget', 'lget', 'llen', 'delete'):
+            results.append(reply)
+        elif name == 'ttl':
+            results.append(reply if reply < 0 else reply / 1000.0)
+        elif name in ('expire', 'persist'):
+            results.append(bool(reply))
+        else:
+            results.append(None)
+        idx += n
+    return results
+
+
+# Push items to the head of a list, trim it and set its time to live.
+# ARGV: max length, time to live in ms (0 for none), items...
+_LPUSH_TRIM_LUA = """
+redis.call('LPUSH', KEYS[1], unpack(ARGV, 3))
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if tonumber(ARGV[2]) > 0 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+# Length of a list and a range of it. ARGV: start, stop
+_LLEN_RANGE_LUA = """
+local n = redis.call('LLEN', KEYS[1])
+if n == 0 then
+    return {0, {}}
+end
+return {n, redis.call('LRANGE', KEYS[1], ARGV[1], ARGV[2])}
+"""
+
+
+class RedisListOps(object):
+    """RedisListOps.
+    Compound list operations of the Redis memories, each executed in one
+    atomic round trip: as a Lua script, sent once and then called by its
+    SHA (EVALSHA), or as a MULTI/EXEC transaction where scripting is not
+    available. The first error meaning that the server does not run
+    scripts (unknown or disabled command, missing permission) switches to
+    transactions. Other errors are raised.
+    """
+
+    # Max items pushed by a script call, bounded by the Lua stack
+    MAX_SCRIPT_ITEMS = 1000
+    # Error messages of servers that do not run scripts, lowercase
+    NO_SCRIPTING_ERRORS = ('unknown command', 'disabled', 'noperm')
+
+    def __init__(self, client, list_size: int):
+        """__init__.
+
+        Args:
+            client: Redis client
+            list_size (int): Max size of lists
+        """
+        self._client = client
+        self.list_size = list_size
+        self.scripting = True
+        self._lpush_trim = client.register_script(_LPUSH_TRIM_LUA)
+        self._llen_range = client.register_script(_LLEN_RANGE_LUA)
+
+    def _script_failed(self, exc: Exception) -> None:
+        msg = str(exc).lower()
+        if not any(err in msg for err in self.NO_SCRIPTING_ERRORS):
+            raise exc
+        self.scripting = False
+
+    def lpush_trim(self, key: str, vals: list, ttl: float = None) -> None:
+        ttl_ms = _ttl_ms(ttl) or 0
+        if self.scripting and len(vals) <= self.MAX_SCRIPT_ITEMS:
+            try:
+                self._lpush_trim(keys=[key],
+                                 args=[self.list_size, ttl_ms] + list(vals))
+                return
+            except import_redis().ResponseError as exc:
+                self._script_failed(exc)
+        pipe = self._client.pipeline(transaction=True)
+        pipe.lpush(key, *vals)
+        pipe.ltrim(key, 0, self.list_size - 1)
+        if ttl_ms:
+            pipe.pexpire(key, ttl_ms)
+        pipe.execute()
+
+    def llen_range(self, key: str, start: int, stop: int) -> tuple:
+        """llen_range.
+        Returns the length of a list and its LRANGE start stop.
+        """
+        if self.scripting:
+            try:
+                size, items = self._llen_range(keys=[key],
+                                               args=[start, stop])
+                return size, items
+            except import_redis().ResponseError as exc:
+                self._script_failed(exc)
+        pipe = self._client.pipeline(transaction=True)
+        pipe.llen(key)
+        pipe.lrange(key, start, stop)
+        size, items = pipe.execute()
+        return size, items
+
 
 class RuntimeMemory(Memory):
     def __init__(self, *args, **kwargs):
@@ -66,30 +505,182 @@ class PersistentMemory(Memory):
     def __init__(self, *args, **kwargs):
         super(PersistentMemory, self).__init__(*args, **kwargs)
 
+    def sync(self) -> None:
+        """sync.
+        Block until every write so far has been made durable.
+        """
+        raise NotImplementedError()
+
+
+class PersistenceScheduler(object):
+    """PersistenceScheduler.
+    Coalesces the snapshots of a persistent memory. Writes only mark the
+    store dirty and a background thread takes a snapshot once `interval`
+    seconds have passed since the previous one, or earlier if `max_dirty`
+    writes have piled up.
+    The snapshot function returns False when it could not run (e.g. another
+    snapshot is still in progress); the dirty writes are then retried on the
+    next interval.
+    """
+
+    def __init__(self,
+                 snapshot_fn,
+                 interval: float = 1.0,
+                 max_dirty: int = 100):
+        """__init__.
+
+        Args:
+            snapshot_fn: Callable taking no arguments that triggers a snapshot
+            interval (float): Minimum seconds between two snapshots
+            max_dirty (int): Number of dirty writes that forces a snapshot
+        """
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self._snapshot_fn = snapshot_fn
+        self._dirty = 0
+        self._last_snapshot = time.monotonic()
+        self._retry_at = 0.0
+        self._running = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    @property
+    def dirty(self) -> int:
+        return self._dirty
+
+    def start(self) -> None:
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def mark_dirty(self, count: int = 1) -> None:
+        """mark_dirty.
+
+        Args:
+            count (int): Number of writes to account for
+        """
+        with self._cond:
+            self._dirty += count
+            # Wake the snapshot thread when it has to re-arm its timer
+            if self._dirty == count or self._dirty >= self.max_dirty:
+                self._cond.notify()
+
+    def reset(self, count: int = None) -> int:
+        """reset.
+        Clear the dirty counter, e.g. after a synchronous snapshot taken by
+        the caller. Returns the number of writes that were pending.
+
+        Args:
+            count (int): Number of writes covered by the snapshot, read
+                from `dirty` before taking it. Writes made since are kept.
+                None to clear them all
+        """
+        with self._cond:
+            dirty = self._dirty
+            self._dirty = 0 if count is None else max(dirty - count, 0)
+            self._last_snapshot = time.monotonic()
+            return dirty
+
+    def _next_wait(self):
+        if self._dirty == 0:
+            return None
+        if self._dirty >= self.max_dirty:
+            due = self._retry_at
+        else:
+            due = max(self._last_snapshot + self.interval, self._retry_at)
+        return due - time.monotonic()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                timeout = self._next_wait()
+                while self._running and (timeout is None or timeout > 0):
+                    self._cond.wait(timeout)
+                    timeout = self._next_wait()
+                if not self._running:
+                    return
+                dirty = self._dirty
+                self._dirty = 0
+            try:
+                done = self._snapshot_fn()
+            except Exception as exc:
+                print(exc)
+                done = False
+            with self._cond:
+                self._last_snapshot = time.monotonic()
+                if done is False:
+                    self._dirty += dirty
+                    self._retry_at = self._last_snapshot + self.interval
+
 
 class RedisRuntimeMem(RuntimeMemory):
+    # EvictionPolicy -> Redis maxmemory-policy
+    _MAXMEMORY_POLICIES = {
+        EvictionPolicy.LRU: 'allkeys-lru',
+        EvictionPolicy.LFU: 'allkeys-lfu',
+        EvictionPolicy.TTL: 'volatile-ttl'
+    }
+
     def __init__(self,
                  host='localhost',
                  port=6379,
                  db=1,
+                 max_memory: int = None,
+                 eviction_policy: EvictionPolicy = EvictionPolicy.LRU,
+                 pool: RedisPool = None,
                  *args,
                  **kwargs) -> None:
-        super(RedisRuntimeMem, self).__init__(*args, **kwargs)
-        self._redis = redis.Redis(
-            host=host,
-            port=port,
-            db=db,
-            decode_responses=True
-        )
+        """__init__.
 
-    def set(self, key: str, val: str) -> None:
-        self._redis.set(key, val)
+        Args:
+            host: Redis host
+            port: Redis port
+            db: Redis database
+            max_memory (int): Sets the maxmemory of the Redis server, which
+                applies to all of its databases. Left untouched if None
+            eviction_policy (EvictionPolicy): Sets the maxmemory-policy of
+                the Redis server, along with max_memory
+            pool (RedisPool): Shared connection pools. host and port are
+                ignored if given
+        """
+        super(RedisRuntimeMem, self).__init__(*args, **kwargs)
+        if pool is None:
+            pool = RedisPool(host=host, port=port)
+        self._pool = pool
+        self._redis = pool.client(db, decode_responses=True)
+        # Typed series are binary strings
+        self._raw = pool.client(db)
+        self._list_ops = RedisListOps(self._redis, self.list_size)
+        self.max_memory = max_memory
+        self.eviction_policy = eviction_policy
+        if max_memory is not None:
+            self._redis.config_set('maxmemory', max_memory)
+            self._redis.config_set(
+                'maxmemory-policy',
+                self._MAXMEMORY_POLICIES[eviction_policy])
+
+    def set(self, key: str, val: str, ttl: float = None) -> None:
+        self._redis.set(key, val, px=_ttl_ms(ttl))
 
     def get(self, key: str):
         val = self._redis.get(key)
         return val
 
-    def mset(self, keys: list, vals: list) -> None:
+    def mset(self, keys: list, vals: list, ttl: float = None) -> None:
+        if ttl is not None:
+            self.execute([('mset', (keys, vals, ttl))])
+            return
         _d = {}
         for i in range(len(keys)):
             _d[keys[i]] = vals[i]
@@ -99,9 +690,8 @@ class RedisRuntimeMem(RuntimeMemory):
         vals = self._redis.mget(keys)
         return vals
 
-    def lset(self, key: str, vals: list) -> None:
-        self._redis.lpush(key, *vals)
-        self._redis.ltrim(key, 0, self.list_size - 1)
+    def lset(self, key: str, vals: list, ttl: float = None) -> None:
+        self._list_ops.lpush_trim(key, vals, ttl)
 
     def lget(self, key: str, from_idx: int, to_idx: int) -> list:
         r_start = -1 * from_idx
@@ -112,9 +702,379 @@ class RedisRuntimeMem(RuntimeMemory):
     def llen(self, key: str) -> int:
         return self._redis.llen(key)
 
+    def llen_range(self, key: str, from_idx: int, to_idx: int) -> tuple:
+        return self._list_ops.llen_range(key, -1 * from_idx, -1 * to_idx)
+
     def flush(self) -> None:
         self._redis.flushdb()
 
+    def delete(self, keys: list) -> int:
+        return self._redis.delete(*keys) if keys else 0
+
+    def scan(self, cursor=0, match: str = None, count: int = 100) -> tuple:
+        return self._redis.scan(cursor=cursor, match=match, count=count)
+
+    def expire(self, key: str, ttl: float) -> bool:
+        return bool(self._redis.pexpire(key, _ttl_ms(ttl)))
+
+    def ttl(self, key: str) -> float:
+        return _redis_ttl(self._redis, key)
+
+    def persist(self, key: str) -> bool:
+        return bool(self._redis.persist(key))
+
+    def memory_stats(self) -> dict:
+        if self.max_memory is None:
+            return {}
+        info = self._redis.info('memory')
+        return {
+            'max_memory': self.max_memory,
+            'used_memory': info.get('used_memory'),
+            'eviction_policy': self.eviction_policy.name,
+            'keys': self._redis.dbsize(),
+            'evictions': self._redis.info('stats').get('evicted_keys', 0)
+        }
+
+    def execute(self, ops: list) -> list:
+        return _redis_execute(self._redis, self.list_size, ops)
+
+    def series_append(self, key: str, data: bytes, itemsize: int,
+                      max_len: int) -> None:
+        _redis_series_append(self._raw, key, data, itemsize, max_len)
+
+    def series_range(self, key: str, from_idx: int, to_idx: int,
+                     itemsize: int, max_len: int) -> bytes:
+        return _redis_series_range(self._raw, key, from_idx, to_idx,
+                                   itemsize, max_len)
+
+    def series_len(self, key: str, itemsize: int, max_len: int) -> int:
+        return min(self._raw.strlen(key) // itemsize, max_len)
+
+
+class InProcessRuntimeMem(RuntimeMemory):
+    """InProcessRuntimeMem.
+    Runtime memory living in the DerpMe process itself. Scalars are kept in
+    a dict and lists in bounded deques, so requests are served without a
+    round trip to Redis.
+    Keys with a time to live are tracked by an ExpiryIndex. Expired keys
+    are dropped lazily when read, and actively through expire_due().
+    With a max_memory budget, the approximate size of every key is
+    accounted on writes, and keys are evicted by the eviction policy before
+    a write that would exceed the budget. Evicted keys are handed to
+    on_evict, e.g. to spill them to persistent memory.
+    """
+
+    # Approximate per-key bookkeeping overhead in bytes
+    KEY_OVERHEAD = 64
+
+    def __init__(self,
+                 max_memory: int = None,
+                 eviction_policy: EvictionPolicy = EvictionPolicy.LRU,
+                 on_evict=None,
+                 *args, **kwargs) -> None:
+        """__init__.
+
+        Args:
+            max_memory (int): Memory budget in bytes. Unbounded if None
+            eviction_policy (EvictionPolicy): Keys evicted first
+            on_evict: Callable receiving a list of evicted
+                (key, kind, value, ttl) entries, where kind is 'val', 'list'
+                (items oldest first) or 'series' (packed bytes)
+        """
+        super(InProcessRuntimeMem, self).__init__(*args, **kwargs)
+        self._vals = {}
+        self._lists = {}
+        self._series = {}
+        self._expiry = ExpiryIndex()
+        self._index = KeyIndex()
+        self._lock = threading.Lock()
+        self.max_memory = max_memory
+        self.eviction_policy = eviction_policy
+        self._on_evict = on_evict
+        self._tracker = None if max_memory is None else \
+            make_tracker(eviction_policy, self._expiry)
+        self._sizes = {}
+        self._used = 0
+        self.evictions = 0
+
+    def _exists(self, key: str) -> bool:
+        return key in self._vals or key in self._lists or \
+            key in self._series
+
+    def _delete(self, key: str) -> None:
+        self._vals.pop(key, None)
+        self._lists.pop(key, None)
+        self._series.pop(key, None)
+        self._expiry.remove(key)
+        self._index.discard(key)
+        if self._tracker is not None:
+            self._used -= self._sizes.pop(key, 0)
+            self._tracker.remove(key)
+
+    def _account(self, key: str, delta: int) -> None:
+        """_account.
+        Add delta bytes to the accounted size of a key, marking it as
+        accessed.
+        """
+        size = self._sizes.get(key)
+        if size is None:
+            size = self.KEY_OVERHEAD + len(key)
+            self._used += size
+        self._sizes[key] = size + delta
+        self._used += delta
+        self._tracker.add(key)
+
+    def _touch(self, key: str) -> None:
+        if self._tracker is not None:
+            with self._lock:
+                self._tracker.touch(key)
+
+    def _make_room(self, key: str, delta: int) -> list:
+        """_make_room.
+        Evict keys other than key until its size can grow by delta bytes
+        within the budget. Returns the evicted entries, to be passed to
+        on_evict once the lock is released.
+        """
+        evicted = []
+        if key not in self._sizes:
+            delta += self.KEY_OVERHEAD + len(key)
+        while self._used + delta > self.max_memory:
+            victim = self._tracker.victim(key)
+            if victim is None:
+                break
+            if self._on_evict is not None:
+                ttl = self._expiry.ttl(victim)
+                ttl = ttl if ttl > 0 else None
+                if victim in self._vals:
+                    evicted.append((victim, 'val', self._vals[victim], ttl))
+                if victim in self._lists:
+                    evicted.append((victim, 'list',
+                                    list(reversed(self._lists[victim])),
+                                    ttl))
+                if victim in self._series:
+                    evicted.append((victim, 'series',
+                                    bytes(self._series[victim]), ttl))
+            self._delete(victim)
+            self.evictions += 1
+        return evicted
+
+    def _evicted(self, evicted: list) -> None:
+        if evicted:
+            self._on_evict(evicted)
+
+    def _check_expired(self, key: str) -> None:
+        """_check_expired.
+        Lazy expiration of a key about to be accessed.
+        """
+        if self._expiry and self._expiry.expired(key):
+            with self._lock:
+                if self._expiry.expired(key):
+                    self._delete(key)
+
+    def _set_ttl(self, key: str, ttl: float) -> None:
+        if ttl is None:
+            self._expiry.remove(key)
+        else:
+            self._expiry.set(key, time.time() + ttl)
+
+    def _set(self, key: str, val, ttl: float) -> list:
+        evicted = []
+        if self._tracker is not None:
+            old = self._vals.get(key)
+            _list = self._lists.get(key)
+            delta = approx_size(val) - \
+                (0 if old is None else approx_size(old)) - \
+                (0 if _list is None else sum(len(x) for x in _list))
+            evicted = self._make_room(key, delta)
+            self._account(key, delta)
+        self._lists.pop(key, None)
+        self._vals[key] = val
+        self._index.add(key)
+        self._set_ttl(key, ttl)
+        return evicted
+
+    def set(self, key: str, val: str, ttl: float = None) -> None:
+        with self._lock:
+            evicted = self._set(key, val, ttl)
+        self._evicted(evicted)
+
+    def get(self, key: str):
+        self._check_expired(key)
+        self._touch(key)
+        return self._vals.get(key)
+
+    def mset(self, keys: list, vals: list, ttl: float = None) -> None:
+        evicted = []
+        with self._lock:
+            for i in range(len(keys)):
+                evicted.extend(self._set(keys[i], vals[i], ttl))
+        self._evicted(evicted)
+
+    def mget(self, keys: list):
+        if self._expiry:
+            for key in keys:
+                self._check_expired(key)
+        if self._tracker is not None:
+            with self._lock:
+                for key in keys:
+                    self._tracker.touch(key)
+        _vals = self._vals
+        return [_vals.get(key) for key in keys]
+
+    def lset(self, key: str, vals: list, ttl: float = None) -> None:
+        evicted = []
+        with self._lock:
+            if self._expiry.expired(key):
+                self._delete(key)
+            _list = self._lists.get(key)
+            if self._tracker is not None:
+                old = None if _list is not None else self._vals.get(key)
+                size = 0 if _list is None else len(_list)
+                # Items pushed out of the tail by the bounded deque
+                overflow = size + len(vals) - self.list_size
+                dropped = 0 if _list is None else \
+                    sum(len(x) for x in
+                        islice(reversed(_list), max(overflow, 0)))
+                if overflow > size:
+                    dropped += sum(len(x) for x in vals[:overflow - size])
+                delta = sum(len(x) for x in vals) - dropped - \
+                    (0 if old is None else approx_size(old))
+                evicted = self._make_room(key, delta)
+            if _list is None:
+                self._vals.pop(key, None)
+                self._expiry.remove(key)
+                _list = deque(maxlen=self.list_size)
+                self._lists[key] = _list
+                self._index.add(key)
+            if self._tracker is not None:
+                self._account(key, delta)
+            # Same ordering as LPUSH followed by LTRIM 0 list_size-1
+            _list.extendleft(vals)
+            if ttl is not None:
+                self._set_ttl(key, ttl)
+        self._evicted(evicted)
+
+    def lget(self, key: str, from_idx: int, to_idx: int) -> list:
+        self._check_expired(key)
+        self._touch(key)
+        with self._lock:
+            _list = self._lists.get(key)
+            if _list is None:
+                return []
+            return _lrange(_list, -1 * from_idx, -1 * to_idx)
+
+    def llen(self, key: str) -> int:
+        self._check_expired(key)
+        _list = self._lists.get(key)
+        return 0 if _list is None else len(_list)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._vals.clear()
+            self._lists.clear()
+            self._series.clear()
+            self._expiry.clear()
+            self._index.clear()
+            self._sizes.clear()
+            self._used = 0
+            if self._tracker is not None:
+                self._tracker.clear()
+
+    def delete(self, keys: list) -> int:
+        count = 0
+        with self._lock:
+            for key in keys:
+                if self._exists(key):
+                    count += 0 if self._expiry.expired(key) else 1
+                    self._delete(key)
+        return count
+
+    def expire(self, key: str, ttl: float) -> bool:
+        self._check_expired(key)
+        with self._lock:
+            if not self._exists(key):
+                return False
+            self._set_ttl(key, ttl)
+            return True
+
+    def ttl(self, key: str) -> float:
+        self._check_expired(key)
+        if not self._exists(key):
+            return -2
+        return self._expiry.ttl(key)
+
+    def persist(self, key: str) -> bool:
+        self._check_expired(key)
+        with self._lock:
+            return self._expiry.remove(key)
+
+    def expire_due(self, limit: int = None) -> list:
+        with self._lock:
+            keys = self._expiry.pop_expired(limit=limit)
+            for key in keys:
+                self._delete(key)
+        return keys
+
+    def scan(self, cursor=0, match: str = None, count: int = 100) -> tuple:
+        with self._lock:
+            cursor, keys = self._index.scan(cursor, match, count)
+        return cursor, [key for key in keys
+                        if not self._expiry.expired(key)]
+
+    def scan_prefix(self, prefix: str, limit: int) -> list:
+        with self._lock:
+            return self._index.prefix(prefix, limit, self._expiry.expired)
+
+    def memory_stats(self) -> dict:
+        return {
+            'max_memory': self.max_memory,
+            'used_memory': self._used if self._tracker is not None else None,
+            'eviction_policy': self.eviction_policy.name,
+            'keys': len(self._vals) + len(self._lists) + len(self._series),
+            'evictions': self.evictions
+        }
+
+    def series_append(self, key: str, data: bytes, itemsize: int,
+                      max_len: int) -> None:
+        evicted = []
+        with self._lock:
+            if self._expiry.expired(key):
+                self._delete(key)
+            buf = self._series.get(key)
+            size = 0 if buf is None else len(buf)
+            # Trimming is amortized over max_len appended samples
+            excess = size + len(data) - max_len * itemsize
+            trim = excess if excess > max_len * itemsize else 0
+            if self._tracker is not None:
+                delta = len(data) - trim
+                evicted = self._make_room(key, delta)
+            if buf is None:
+                buf = bytearray()
+                self._series[key] = buf
+                self._index.add(key)
+            buf += data
+            if trim:
+                del buf[:trim]
+            if self._tracker is not None:
+                self._account(key, delta)
+        self._evicted(evicted)
+
+    def series_range(self, key: str, from_idx: int, to_idx: int,
+                     itemsize: int, max_len: int) -> bytes:
+        self._check_expired(key)
+        self._touch(key)
+        with self._lock:
+            buf = self._series.get(key)
+            if buf is None:
+                return b''
+            return bytes(_series_slice(memoryview(buf), from_idx, to_idx,
+                                       itemsize, max_len))
+
+    def series_len(self, key: str, itemsize: int, max_len: int) -> int:
+        self._check_expired(key)
+        buf = self._series.get(key)
+        return 0 if buf is None else min(len(buf) // itemsize, max_len)
+
 
 class RedisPersistentMem(PersistentMemory):
     """RedisPersistentMem.
@@ -124,30 +1084,94 @@ class RedisPersistentMem(PersistentMemory):
                  host: str = 'localhost',
                  port: int = 6379,
                  db: int = 2,
+                 snapshot_interval: float = 1.0,
+                 snapshot_max_dirty: int = 100,
+                 pool: RedisPool = None,
                  *args, **kwargs):
         super(RedisPersistentMem, self).__init__(*args, **kwargs)
-        self._redis = redis.Redis(
-            host=host,
-            port=port,
-            db=db,
-            decode_responses=True
+        if pool is None:
+            pool = RedisPool(host=host, port=port)
+        self._pool = pool
+        self._redis = pool.client(db, decode_responses=True)
+        # Typed series are binary strings
+        self._raw = pool.client(db)
+        self._list_ops = RedisListOps(self._redis, self.list_size)
+        self._scheduler = PersistenceScheduler(
+            self._bgsave,
+            interval=snapshot_interval,
+            max_dirty=snapshot_max_dirty
         )
+        self._scheduler.start()
+
+    def _bgsave_in_progress(self) -> bool:
+        info = self._redis.info('persistence')
+        return bool(info.get('rdb_bgsave_in_progress', 0))
+
+    def _bgsave(self) -> bool:
+        """_bgsave.
+        Snapshot callback of the persistence scheduler. Skips the snapshot if
+        Redis is still busy with the previous one.
+        """
+        if self._bgsave_in_progress():
+            return False
+        try:
+            self._redis.bgsave()
+        except import_redis().ResponseError:
+            # Lost the race against another BGSAVE/AOF rewrite.
+            return False
+        return True
+
+    def sync(self, retries: int = 5, timeout: float = 60.0) -> None:
+        """sync.
+        Synchronously snapshot the database, waiting for any background
+        snapshot that is already running. Raises the error of SAVE if it
+        fails for another reason (e.g. MISCONF, disk full), or once retries
+        or timeout are exhausted.
+
+        Args:
+            retries (int): SAVE attempts racing a background save
+            timeout (float): Max seconds to wait for background saves
+        """
+        # Cleared once SAVE succeeded, a failed one leaves them pending
+        dirty = self._scheduler.dirty
+        deadline = time.monotonic() + timeout
+        for attempt in range(retries):
+            while self._bgsave_in_progress():
+                if time.monotonic() > deadline:
+                    raise TimeoutError(
+                        'Background save still in progress after '
+                        '{}s'.format(timeout))
+                time.sleep(0.01)
+            try:
+                self._redis.save()
+                self._scheduler.reset(dirty)
+                return
+            except import_redis().ResponseError as exc:
+                if 'in progress' not in str(exc).lower() or \
+                        attempt == retries - 1:
+                    raise
+
+    def close(self) -> None:
+        """close.
+        Stop the persistence scheduler, snapshotting pending writes.
+        """
+        self._scheduler.stop()
+        if self._scheduler.dirty > 0:
+            self.sync()
 
-    def set(self, key: str, val: str) -> None:
+    def set(self, key: str, val: str, ttl: float = None) -> None:
         """set.
 
         Args:
             key (str): key
             val (str): val
+            ttl (float): Seconds until the key expires
 
         Returns:
             None:
         """
-        self._redis.set(key, val)
-        try:
-            self._redis.bgsave()
-        except Exception as exc:
-            print(exc)
+        self._redis.set(key, val, px=_ttl_ms(ttl))
+        self._scheduler.mark_dirty()
 
     def get(self, key: str):
         """get.
@@ -158,24 +1182,26 @@ class RedisPersistentMem(PersistentMemory):
         val = self._redis.get(key)
         return val
 
-    def mset(self, keys: list, vals: list) -> None:
+    def mset(self, keys: list, vals: list, ttl: float = None) -> None:
         """mset.
 
         Args:
             keys (list): keys
             vals (list): vals
+            ttl (float): Seconds until the keys expire
 
         Returns:
             None:
         """
-        _d = {}
-        for i in range(len(keys)):
-            _d[keys[i]] = vals[i]
-        self._redis.mset(_d)
-        try:
-            self._redis.bgsave()
-        except Exception as exc:
-            print(exc)
+        if ttl is not None:
+            _redis_execute(self._redis, self.list_size,
+                           [('mset', (keys, vals, ttl))])
+        else:
+            _d = {}
+            for i in range(len(keys)):
+                _d[keys[i]] = vals[i]
+            self._redis.mset(_d)
+        self._scheduler.mark_dirty(len(keys))
 
     def mget(self, keys: list):
         """mget.
@@ -186,22 +1212,19 @@ class RedisPersistentMem(PersistentMemory):
         vals = self._redis.mget(keys)
         return vals
 
-    def lset(self, key: str, vals: list) -> None:
+    def lset(self, key: str, vals: list, ttl: float = None) -> None:
         """lset.
 
         Args:
             key (str): key
             vals (list): vals
+            ttl (float): Seconds until the list expires
 
         Returns:
             None:
         """
-        self._redis.lpush(key, *vals)
-        self._redis.ltrim(key, 0, self.list_size - 1)
-        try:
-            self._redis.bgsave()
-        except Exception as exc:
-            print(exc)
+        self._list_ops.lpush_trim(key, vals, ttl)
+        self._scheduler.mark_dirty()
 
     def lget(self, key: str, from_idx: int, to_idx: int) -> list:
         """lget.
@@ -230,6 +1253,117 @@ class RedisPersistentMem(PersistentMemory):
         """
         return self._redis.llen(key)
 
+    def llen_range(self, key: str, from_idx: int, to_idx: int) -> tuple:
+        return self._list_ops.llen_range(key, -1 * from_idx, -1 * to_idx)
+
+    def delete(self, keys: list) -> int:
+        count = self._redis.delete(*keys) if keys else 0
+        if count:
+            self._scheduler.mark_dirty(count)
+        return count
+
+    def scan(self, cursor=0, match: str = None, count: int = 100) -> tuple:
+        # Incremental, never KEYS, so that large databases are not blocked
+        return self._redis.scan(cursor=cursor, match=match, count=count)
+
+    def expire(self, key: str, ttl: float) -> bool:
+        """expire.
+
+        Args:
+            key (str): key
+            ttl (float): Seconds until the key expires
+
+        Returns:
+            bool:
+        """
+        res = bool(self._redis.pexpire(key, _ttl_ms(ttl)))
+        self._scheduler.mark_dirty()
+        return res
+
+    def ttl(self, key: str) -> float:
+        """ttl.
+
+        Args:
+            key (str): key
+
+        Returns:
+            float:
+        """
+        return _redis_ttl(self._redis, key)
+
+    def persist(self, key: str) -> bool:
+        """persist.
+
+        Args:
+            key (str): key
+
+        Returns:
+            bool:
+        """
+        res = bool(self._redis.persist(key))
+        self._scheduler.mark_dirty()
+        return res
+
+    def execute(self, ops: list) -> list:
+        """execute.
+        Execute operations in a single pipeline.
+
+        Args:
+            ops (list): List of (method name, args tuple) pairs
+
+        Returns:
+            list:
+        """
+        res = _redis_execute(self._redis, self.list_size, ops)
+        n_writes = sum(1 for name, _ in ops if name in
+                       ('set', 'mset', 'lset', 'expire', 'persist'))
+        if n_writes:
+            self._scheduler.mark_dirty(n_writes)
+        return res
+
+    def series_append(self, key: str, data: bytes, itemsize: int,
+                      max_len: int) -> None:
+        """series_append.
+
+        Args:
+            key (str): key
+            data (bytes): Packed samples, oldest first
+            itemsize (int): Size of a sample in bytes
+            max_len (int): Max number of samples kept
+        """
+        _redis_series_append(self._raw, key, data, itemsize, max_len)
+        self._scheduler.mark_dirty()
+
+    def series_range(self, key: str, from_idx: int, to_idx: int,
+                     itemsize: int, max_len: int) -> bytes:
+        """series_range.
+
+        Args:
+            key (str): key
+            from_idx (int): from_idx
+            to_idx (int): to_idx
+            itemsize (int): Size of a sample in bytes
+            max_len (int): Max number of samples kept
+
+        Returns:
+            bytes:
+        """
+        return _redis_series_range(self._raw, key, from_idx, to_idx,
+                                   itemsize, max_len)
+
+    def series_len(self, key: str, itemsize: int, max_len: int) -> int:
+        """series_len.
+
+        Args:
+            key (str): key
+            itemsize (int): Size of a sample in bytes
+            max_len (int): Max number of samples kept
+
+        Returns:
+            int:
+        """
+        return min(self._raw.strlen(key) // itemsize, max_len)
+
 
 class DerpMe(object):
     """
@@ -240,6 +1374,28 @@ class DerpMe(object):
         - List Key-Val storage. Where key points to a list
     """
 
+    # Required parameters of each operation of a batch request
+    _BATCH_PARAMS = {
+        'get': ('key',),
+        'set': ('key', 'val'),
+        'mget': ('keys',),
+        'mset': ('keys', 'vals'),
+        'lget': ('key', 'l_from', 'l_to'),
+        'lset': ('key', 'vals'),
+        'expire': ('key', 'ttl'),
+        'ttl': ('key',),
+        'persist': ('key',),
+        'flush': ()
+    }
+    # Max keys deleted per memory and round of active expiration
+    _EXPIRE_BATCH = 1000
+    # Max items returned by a single lscan request
+    _LSCAN_MAX_COUNT = 1000
+    # Max keys visited by a single scan request
+    _SCAN_MAX_COUNT = 1000
+    # Max keys returned by a single mget_prefix request
+    _MGET_PREFIX_MAX = 10000
+
     def __init__(self,
                  runtime_mem: LocalMemType = LocalMemType.REDIS,
                  persistent_mem: LocalMemType = LocalMemType.REDIS,
@@ -247,22 +1403,120 @@ class DerpMe(object):
                  broker_params=None,
                  list_size: int = 10,
                  namespace: str = None,
+                 snapshot_interval: float = 1.0,
+                 snapshot_max_dirty: int = 100,
+                 storage_path: str = 'derpme.log',
+                 dispatch_mode: DispatchMode = DispatchMode.DIRECT,
+                 runtime_workers: int = 4,
+                 persistent_workers: int = 2,
+                 queue_size: int = 1000,
+                 publish_invalidations: bool = True,
+                 series_size: int = 10000,
+                 expiry_interval: float = 1.0,
+                 runtime_max_memory: int = None,
+                 eviction_policy: EvictionPolicy = EvictionPolicy.LRU,
+                 spill_evicted: bool = False,
+                 tiered: bool = False,
+                 publish_changes: bool = False,
+                 changes_interval: float = 0.05,
+                 changes_max_events: int = 100,
+                 redis_settings: dict = None,
+                 runtime_nodes: list = None,
+                 persistent_nodes: list = None,
+                 shard_vnodes: int = 100,
+                 shared_store=None,
+                 replication: bool = False,
+                 replication_backlog: int = 100000,
+                 replication_interval: float = 0.05,
+                 replica_of: str = None,
+                 startup_workers: int = 1,
+                 preload: list = None,
                  debug: bool = False):
         """__init__.
 
         Args:
-            local_mem (LocalMemType): local_mem
+            runtime_mem (LocalMemType): Runtime memory backend
+            persistent_mem (LocalMemType): Persistent memory backend
             broker_type (TransportType): broker_type
             broker_params:
             list_size (int): list_size
             namespace (str): namespace
+            snapshot_interval (float): Minimum seconds between two snapshots
+                of the persistent memory
+            snapshot_max_dirty (int): Number of persistent writes that forces
+                a snapshot before snapshot_interval expires
+            storage_path (str): Data file of the FILE/MMAP persistent memory
+            dispatch_mode (DispatchMode): How requests are executed
+            runtime_workers (int): Workers serving runtime memory requests
+            persistent_workers (int): Workers serving persistent memory
+                requests
+            queue_size (int): Max requests per memory waiting for a worker,
+                beyond which requests are rejected (see Dispatcher)
+            publish_invalidations (bool): Publish the keys modified by each
+                write on {namespace}.invalidate, for client-side caches
+            series_size (int): Max number of samples kept per typed series
+            expiry_interval (float): Seconds between two rounds of active
+                expiration of keys with a time to live
+            runtime_max_memory (int): Memory budget of the runtime memory in
+                bytes, beyond which keys are evicted. Unbounded if None
+            eviction_policy (EvictionPolicy): Keys evicted first (LRU, LFU
+                or TTL, closest to expiration)
+            spill_evicted (bool): Move evicted keys to persistent memory
+                instead of dropping them. Requires the INPROCESS runtime
+                memory
+            tiered (bool): Use the runtime memory as a cache of the
+                persistent one (see TieredMemory). Requires the INPROCESS
+                runtime memory
+            publish_changes (bool): Publish change events of written keys
+                on {namespace}.changes.<key> (see ChangeFeed)
+            changes_interval (float): Seconds between two publishing rounds
+                of change events
+            changes_max_events (int): Max change events published per
+                round on their own topic, beyond which they are published in
+                chunks on {namespace}.changes
+            redis_settings (dict): Connection settings of the Redis memories
+                (see load_redis_settings and RedisPool). Read from config.ini
+                and the environment if None
+            runtime_nodes (list): Shard the runtime memory across these
+                nodes by consistent hashing (see ShardedMemory). Each node
+                is a dict of settings overriding redis_settings (host, port,
+                unix_socket, password, db), with an optional stable `name`
+            persistent_nodes (list): Shard the persistent memory across
+                these nodes. FILE/MMAP nodes set their storage_path
+            shard_vnodes (int): Points of each node on the hash ring
+            shared_store (SharedStore): Connected store serving the
+                INPROCESS/FILE/MMAP memories of the workers of a Supervisor.
+                Those memories are created locally if None
+            replication (bool): Publish the writes of the persistent memory
+                as a replication log for replicas (see ReplicationLog)
+            replication_backlog (int): Entries of the replication log kept
+                for replicas to catch up
+            replication_interval (float): Seconds between two published
+                batches of the replication log
+            replica_of (str): Namespace of a primary. Its persistent memory
+                is replicated to the (read-only) persistent memory
+            startup_workers (int): Threads starting the RPC endpoints
+                concurrently. Endpoints are started one by one if 1
+            preload (list): Keys, or glob patterns of keys, copied from
+                persistent to runtime memory before serving requests
             debug (bool): debug
         """
+        t_start = time.perf_counter()
+        self.startup_timings = {}
+        # Before the memories, whose evictions are counted
+        self.metrics = MetricsRegistry()
+        self._preloading = False
+        self.ready = threading.Event()
         self.l_size = list_size
+        self.series_size = series_size
+        self.expiry_interval = expiry_interval
         self.namespace = namespace
         self._debug = debug
         self._broker_type = broker_type
         self._broker_params = broker_params
+        self._publish_invalidations = publish_invalidations
+        self._publish_changes = publish_changes
+        self._startup_workers = startup_workers
         self.node_name = camelcase_to_snakecase(self.__class__.__name__)
 
         if self.namespace is None:
@@ -274,17 +1528,299 @@ class DerpMe(object):
         self._mset_uri = f'{self.namespace}.mset'
         self._lget_uri = f'{self.namespace}.lget'
         self._lset_uri = f'{self.namespace}.lset'
+        self._lscan_uri = f'{self.namespace}.lscan'
+        self._scan_uri = f'{self.namespace}.scan'
+        self._mget_prefix_uri = f'{self.namespace}.mget_prefix'
         self._flush_uri = f'{self.namespace}.flush'
-
-        if runtime_mem == LocalMemType.REDIS:
-            self._runtime_mem = RedisRuntimeMem()
+        self._expire_uri = f'{self.namespace}.expire'
+        self._ttl_uri = f'{self.namespace}.ttl'
+        self._persist_uri = f'{self.namespace}.persist'
+        self._batch_uri = f'{self.namespace}.batch'
+        self._stats_uri = f'{self.namespace}.stats'
+        self._invalidate_uri = f'{self.namespace}.invalidate'
+        self._changes_uri = f'{self.namespace}.changes'
+        self._replication_uri = f'{self.namespace}.replication'
+
+        self.spill_evicted = spill_evicted
+        if runtime_mem == LocalMemType.REDIS and spill_evicted:
+            raise ValueError('Spilling evicted keys requires the '
+                             'INPROCESS runtime memory')
+        if runtime_mem == LocalMemType.REDIS and tiered:
+            # Redis evicts dirty keys without demoting them
+            raise ValueError('Tiered mode requires the INPROCESS runtime '
+                             'memory')
+        if LocalMemType.REDIS in (runtime_mem, persistent_mem) and \
+                redis_settings is None:
+            redis_settings = load_redis_settings()
+        self._shared_store = shared_store
+        self._mem_settings = {
+            'runtime_mem': runtime_mem,
+            'persistent_mem': persistent_mem,
+            'redis': redis_settings or {},
+            'runtime_max_memory': runtime_max_memory,
+            'eviction_policy': eviction_policy,
+            'snapshot_interval': snapshot_interval,
+            'snapshot_max_dirty': snapshot_max_dirty,
+            'storage_path': storage_path
+        }
+        # Memories of the same Redis endpoint share the connections of one
+        # pool
+        self._redis_pools = {}
+        if runtime_nodes:
+            self._runtime_mem = self._create_sharded_memory(
+                False, runtime_nodes, shard_vnodes)
         else:
-            raise ValueError()
-        if persistent_mem == LocalMemType.REDIS:
-            self._persistent_mem = RedisPersistentMem()
+            self._runtime_mem = self._create_memory(False)
+        if persistent_nodes:
+            self._persistent_mem = self._create_sharded_memory(
+                True, persistent_nodes, shard_vnodes)
         else:
-            raise ValueError()
+            self._persistent_mem = self._create_memory(True)
+        self.replica_of = replica_of
+        self._replication = None
+        self._follower = None
+        if replication:
+            from .replication import ReplicatedMemory, ReplicationLog
+            self._replication = ReplicationLog(
+                self._publish_replication,
+                max_entries=replication_backlog,
+                interval=replication_interval)
+            self._persistent_mem = ReplicatedMemory(self._persistent_mem,
+                                                    self._replication,
+                                                    list_size=list_size)
+        if replica_of is not None:
+            if tiered or spill_evicted:
+                raise ValueError('Replicas do not support tiered mode and '
+                                 'spilling')
+            from .replication import ReadOnlyMemory
+            self._persistent_mem = ReadOnlyMemory(self._persistent_mem,
+                                                  list_size=list_size)
+        self.tiered = tiered
+        self._tiers = None
+        if tiered:
+            from .tiered import TieredMemory
+            clean = set()
+            self._tiers = {
+                False: TieredMemory(self._runtime_mem, self._persistent_mem,
+                                    durable=False, clean=clean),
+                True: TieredMemory(self._runtime_mem, self._persistent_mem,
+                                   durable=True, clean=clean)
+            }
+        t_mem = time.perf_counter()
+        self.startup_timings['memories'] = t_mem - t_start
+        if preload:
+            self._preloading = True
+            try:
+                self.startup_timings['preloaded'] = self._preload(preload)
+            finally:
+                self._preloading = False
+        t_preload = time.perf_counter()
+        self.startup_timings['preload'] = t_preload - t_mem
+        self.dispatcher = Dispatcher(
+            mode=dispatch_mode,
+            runtime_workers=runtime_workers,
+            persistent_workers=persistent_workers,
+            queue_size=queue_size
+        )
+        self._stop_event = threading.Event()
+        self.dispatcher.start()
+        self._changes = None
         self._init_endpoints()
+        self.startup_timings['endpoints'] = \
+            time.perf_counter() - t_preload
+        if publish_changes:
+            from .changes import ChangeFeed
+            self._changes = ChangeFeed(self._changes_pub.publish,
+                                       self._changes_uri,
+                                       interval=changes_interval,
+                                       max_events=changes_max_events,
+                                       logger=self.logger)
+            self._changes.start()
+        if self._replication is not None:
+            # Created with the memories, before the logger of the node
+            self._replication.logger = self.logger
+            self._replication.start()
+        if replica_of is not None:
+            from .replication import Follower
+            # Replicated writes bypass the read-only memory
+            self._follower = Follower(self._persistent_mem._mem, self._node,
+                                      replica_of, logger=self.logger)
+            self._follower.start()
+        self._expiry_thread = threading.Thread(target=self._expire_loop,
+                                               daemon=True)
+        self._expiry_thread.start()
+        self.startup_timings['total'] = time.perf_counter() - t_start
+        self._set_ready()
+
+    def _get_redis_pool(self, node: dict) -> RedisPool:
+        settings = dict(self._mem_settings['redis'], **node)
+        endpoint = (settings.get('unix_socket'), settings.get('host'),
+                    settings.get('port'))
+        pool = self._redis_pools.get(endpoint)
+        if pool is None:
+            pool = RedisPool(**settings)
+            self._redis_pools[endpoint] = pool
+        return pool
+
+    def _create_memory(self, persistent: bool, node: dict = None) -> Memory:
+        """_create_memory.
+        Create a runtime or persistent memory.
+
+        Args:
+            persistent (bool): Create the persistent memory
+            node (dict): Settings of a shard, overriding the Redis settings
+                (host, port, unix_socket, password, db) or the
+                storage_path of FILE/MMAP memories
+        """
+        node = node or {}
+        cfg = self._mem_settings
+        local = LocalMemType.FILE, LocalMemType.MMAP
+        if self._shared_store is not None and \
+                (cfg['persistent_mem'] in local if persistent else
+                 cfg['runtime_mem'] == LocalMemType.INPROCESS):
+            return self._shared_store.memory(persistent)
+        if not persistent:
+            mem_type = cfg['runtime_mem']
+            if mem_type == LocalMemType.REDIS:
+                return RedisRuntimeMem(
+                    db=node.get('db', cfg['redis'].get('database_runtime', 1)),
+                    list_size=self.l_size,
+                    max_memory=cfg['runtime_max_memory'],
+                    eviction_policy=cfg['eviction_policy'],
+                    pool=self._get_redis_pool(node)
+                )
+            elif mem_type == LocalMemType.INPROCESS:
+                return InProcessRuntimeMem(
+                    list_size=self.l_size,
+                    max_memory=cfg['runtime_max_memory'],
+                    eviction_policy=cfg['eviction_policy'],
+                    on_evict=self._on_evict
+                )
+            raise ValueError()
+        mem_type = cfg['persistent_mem']
+        storage_path = node.get('storage_path', cfg['storage_path'])
+        if mem_type == LocalMemType.REDIS:
+            return RedisPersistentMem(
+                db=node.get('db', cfg['redis'].get('database_persistent', 2)),
+                list_size=self.l_size,
+                snapshot_interval=cfg['snapshot_interval'],
+                snapshot_max_dirty=cfg['snapshot_max_dirty'],
+                pool=self._get_redis_pool(node)
+            )
+        elif mem_type == LocalMemType.FILE:
+            from .file_mem import FilePersistentMem
+            return FilePersistentMem(
+                path=storage_path,
+                list_size=self.l_size
+            )
+        elif mem_type == LocalMemType.MMAP:
+            from .mmap_mem import MmapPersistentMem
+            return MmapPersistentMem(
+                path=storage_path,
+                list_size=self.l_size,
+                snapshot_interval=cfg['snapshot_interval'],
+                snapshot_max_dirty=cfg['snapshot_max_dirty']
+            )
+        raise ValueError()
+
+    @staticmethod
+    def _node_name(node: dict, idx: int) -> str:
+        """_node_name.
+        Name of a shard on the hash ring: its `name`, or else its endpoint.
+        """
+        if 'name' in node:
+            return node['name']
+        if 'storage_path' in node:
+            return node['storage_path']
+        if 'unix_socket' in node or 'host' in node:
+            return '{}/{}'.format(
+                node.get('unix_socket') or '{}:{}'.format(
+                    node.get('host'), node.get('port', 6379)),
+                node.get('db', ''))
+        return 'node{}'.format(idx)
+
+    def _create_sharded_memory(self, persistent: bool, nodes: list,
+                               vnodes: int) -> Memory:
+        from .sharding import ShardedMemory
+        shards = {}
+        for idx, node in enumerate(nodes):
+            shards[self._node_name(node, idx)] = \
+                self._create_memory(persistent, node)
+        return ShardedMemory(shards, vnodes=vnodes, list_size=self.l_size)
+
+    def add_node(self, node: dict, persistent: bool = False) -> int:
+        """add_node.
+        Add a shard to a sharded memory and move to it the keys it now
+        owns, while serving requests. Returns the number of keys moved.
+
+        Args:
+            node (dict): Settings of the shard (see runtime_nodes)
+            persistent (bool): Add it to the persistent memory
+        """
+        mem = self._persistent_mem if persistent else self._runtime_mem
+        if not hasattr(mem, 'add_shard'):
+            raise ValueError('The {} memory is not sharded'.format(
+                'persistent' if persistent else 'runtime'))
+        name = self._node_name(node, len(mem.shards))
+        return mem.add_shard(name, self._create_memory(persistent, node))
+
+    def _preload(self, keys: list) -> int:
+        """_preload.
+        Copy keys and lists from persistent to runtime memory, with their
+        time to live. Glob patterns are expanded by scanning the persistent
+        memory. Returns the number of keys copied.
+        """
+        from .snapshot import LIST, VALUE, read_records, record_ops
+        mem = self._persistent_mem
+        found = []
+        for key in keys:
+            if not any(ch in key for ch in '*?['):
+                found.append(key)
+                continue
+            cursor = 0
+            while True:
+                cursor, _keys = mem.scan(cursor, key, self._SCAN_MAX_COUNT)
+                found.extend(_keys)
+                if not cursor:
+                    break
+        count = 0
+        for i in range(0, len(found), self._SCAN_MAX_COUNT):
+            records = read_records(mem, found[i:i + self._SCAN_MAX_COUNT])
+            if self._tiers is not None:
+                # Promoted, so that they are clean and never demoted onto
+                # their own persistent copy. Series stay in persistent
+                # memory
+                tier = self._tiers[True]
+                records = [r for r in records if r[0] in (VALUE, LIST)]
+                for kind, key, val, _ in records:
+                    if kind == VALUE:
+                        tier._promote(key, val)
+                    else:
+                        tier._promote_list(key)
+            else:
+                for name, args in record_ops(records):
+                    getattr(self._runtime_mem, name)(*args)
+            count += len(records)
+        return count
+
+    def _set_ready(self) -> None:
+        """_set_ready.
+        Mark the server as ready and notify systemd (Type=notify services)
+        if it started the process.
+        """
+        self.ready.set()
+        self.logger.info('Ready in {:.3f}s: {}'.format(
+            self.startup_timings['total'], self.startup_timings))
+        try:
+            sd_notify('READY=1')
+        except OSError as exc:
+            self.logger.error('Failed to notify systemd: {}'.format(exc))
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        """wait_ready.
+        Block until the server serves requests, up to timeout seconds.
+        """
+        return self.ready.wait(timeout)
 
     def _init_endpoints(self):
         """_init_endpoints.
@@ -298,27 +1834,326 @@ class DerpMe(object):
             debug=self._debug
         )
         self.logger = self._node.get_logger()
-        self._get_rpc = self._node.create_rpc(
-            rpc_name=self._get_uri, on_request=self._callback_get)
-        self._set_rpc = self._node.create_rpc(
-            rpc_name=self._set_uri, on_request=self._callback_set)
-        self._lget_rpc = self._node.create_rpc(
-            rpc_name=self._lget_uri, on_request=self._callback_lget)
-        self._lset_rpc = self._node.create_rpc(
-            rpc_name=self._lset_uri, on_request=self._callback_lset)
-        self._mget_rpc = self._node.create_rpc(
-            rpc_name=self._mget_uri, on_request=self._callback_mget)
-        self._mset_rpc = self._node.create_rpc(
-            rpc_name=self._mset_uri, on_request=self._callback_mset)
-        self._flush_rpc = self._node.create_rpc(
-            rpc_name=self._flush_uri, on_request=self._callback_flush)
-        self._get_rpc.run()
-        self._set_rpc.run()
-        self._lget_rpc.run()
-        self._lset_rpc.run()
-        self._mget_rpc.run()
-        self._mset_rpc.run()
-        self._flush_rpc.run()
+        endpoints = [
+            ('_get_rpc', self._get_uri, self._callback_get),
+            ('_set_rpc', self._set_uri, self._callback_set),
+            ('_lget_rpc', self._lget_uri, self._callback_lget),
+            ('_lset_rpc', self._lset_uri, self._callback_lset),
+            ('_lscan_rpc', self._lscan_uri, self._callback_lscan),
+            ('_scan_rpc', self._scan_uri, self._callback_scan),
+            ('_mget_prefix_rpc', self._mget_prefix_uri,
+             self._callback_mget_prefix),
+            ('_mget_rpc', self._mget_uri, self._callback_mget),
+            ('_mset_rpc', self._mset_uri, self._callback_mset),
+            ('_flush_rpc', self._flush_uri, self._callback_flush),
+            ('_batch_rpc', self._batch_uri, self._callback_batch),
+            ('_expire_rpc', self._expire_uri, self._callback_expire),
+            ('_ttl_rpc', self._ttl_uri, self._callback_ttl),
+            ('_persist_rpc', self._persist_uri, self._callback_persist),
+            ('_stats_rpc', self._stats_uri, self._callback_stats)
+        ]
+        if self._replication is not None:
+            endpoints += [
+                ('_replication_fetch_rpc', f'{self._replication_uri}.fetch',
+                 self._callback_replication_fetch),
+                ('_replication_snapshot_rpc',
+                 f'{self._replication_uri}.snapshot',
+                 self._callback_replication_snapshot)
+            ]
+
+        def _start(endpoint):
+            attr, uri, callback = endpoint
+            rpc = self._node.create_rpc(rpc_name=uri,
+                                        on_request=self._dispatch(callback))
+            rpc.run()
+            setattr(self, attr, rpc)
+
+        if self._startup_workers > 1:
+            # Each RPC server connects to the broker on its own, so
+            # starting them concurrently overlaps the round trips
+            with ThreadPoolExecutor(self._startup_workers) as executor:
+                list(executor.map(_start, endpoints))
+        else:
+            for endpoint in endpoints:
+                _start(endpoint)
+        if self._publish_invalidations:
+            self._invalidate_pub = self._node.create_publisher(
+                topic=self._invalidate_uri)
+        if self._publish_changes:
+            # Change events are published on a topic per key
+            self._changes_pub = self._node.create_mpublisher()
+        if self._replication is not None:
+            self._replication_pub = self._node.create_publisher(
+                topic=self._replication_uri)
+
+    def _dispatch(self, callback):
+        """_dispatch.
+        Wrap an RPC callback so that it is executed by the dispatcher, on
+        the workers of the memory the request targets.
+        Requests may carry their values encoded (see codec), and ask for an
+        encoded response through their <accept> field.
+        Request counts, errors and the latency of each stage (decode of
+        encoded requests, queue wait for a worker, backend execution on the
+        worker, encode) are recorded per operation and memory tier.
+
+        Args:
+            callback: RPC callback
+        """
+        name = callback.__name__.replace('_callback_', '')
+        timers = {}
+        for tier in Dispatcher.TIERS:
+            timers[tier] = [
+                self.metrics.histogram('derpme_request_seconds', op=name,
+                                       tier=tier, stage=stage)
+                for stage in ('decode', 'queue', 'backend', 'encode',
+                              'total')
+            ]
+        requests = {tier: self.metrics.counter('derpme_requests_total',
+                                               op=name, tier=tier)
+                    for tier in Dispatcher.TIERS}
+        errors = {tier: self.metrics.counter('derpme_errors_total',
+                                             op=name, tier=tier)
+                  for tier in Dispatcher.TIERS}
+        exceptions = {tier: self.metrics.counter('derpme_exceptions_total',
+                                                 op=name, tier=tier)
+                      for tier in Dispatcher.TIERS}
+
+        def _timed(stamps, msg, meta):
+            # Runs on the worker, so queue wait and execution are told apart
+            stamps.append(time.perf_counter())
+            try:
+                return callback(msg, meta)
+            finally:
+                stamps.append(time.perf_counter())
+
+        def _on_request(msg, meta):
+            t0 = time.perf_counter()
+            encoded = 'payload' in msg
+            try:
+                msg = decode_message(msg)
+            except Exception as exc:
+                return {
+                    'status': 0,
+                    'error': 'Failed to decode request: {}'.format(exc)
+                }
+            encoding = negotiate(msg.get('accept'))
+            if msg.get('persistent') or \
+                    any(op.get('persistent') for op in msg.get('ops', ())):
+                tier = 'persistent'
+            else:
+                tier = 'runtime'
+            t1 = time.perf_counter()
+            stamps = []
+            try:
+                resp = self.dispatcher.submit(tier, _timed, stamps, msg, meta)
+            except DispatcherBusy:
+                resp = {
+                    'status': 0,
+                    'error': 'Server busy: {} queue is full'.format(tier)
+                }
+            except Exception as exc:
+                exceptions[tier].inc()
+                self.logger.error('{} failed: {}'.format(name, exc))
+                resp = {
+                    'status': 0,
+                    'error': str(exc)
+                }
+            t2 = time.perf_counter()
+            if not resp.get('status', 1):
+                errors[tier].inc()
+            resp = encode_message(resp, encoding)
+            t3 = time.perf_counter()
+            decode_t, queue_t, backend_t, encode_t, total_t = timers[tier]
+            if encoded:
+                decode_t.observe(t1 - t0)
+            if stamps:
+                queue_t.observe(stamps[0] - t1)
+            if len(stamps) == 2:
+                backend_t.observe(stamps[1] - stamps[0])
+            encode_t.observe(t3 - t2)
+            total_t.observe(t3 - t0)
+            requests[tier].inc()
+            return resp
+        return _on_request
+
+    def _invalidate(self, keys: list, persistent: bool = False,
+                    flush: bool = False) -> None:
+        """_invalidate.
+        Publish an invalidation event for keys changed by a write.
+
+        Args:
+            keys (list): Modified keys
+            persistent (bool): Whether the keys live in persistent memory
+            flush (bool): The whole memory was flushed
+        """
+        if not self._publish_invalidations:
+            return
+        msg = {
+            'keys': keys,
+            'persistent': persistent,
+            'flush': flush
+        }
+        try:
+            self._invalidate_pub.publish(msg)
+        except Exception as exc:
+            self.logger.error(
+                'Failed to publish invalidation event: {}'.format(exc))
+
+    def stats(self) -> dict:
+        """stats.
+        Returns runtime statistics of the server.
+        """
+        stats = {
+            'dispatcher': self.dispatcher.stats(),
+            'runtime_memory': self._runtime_mem.memory_stats(),
+            'metrics': self.metrics.to_dict()
+        }
+        stats['startup'] = self.startup_timings
+        if self._changes is not None:
+            stats['changes'] = self._changes.stats()
+        if self._replication is not None:
+            stats['replication'] = self._replication.stats()
+        if self._follower is not None:
+            stats['replica'] = self._follower.stats()
+        if self._redis_pools:
+            stats['redis_pools'] = [pool.stats() for pool in
+                                    self._redis_pools.values()]
+        return stats
+
+    def _mem(self, persistent: bool) -> Memory:
+        """_mem.
+        Returns the memory serving runtime or persistent requests.
+        """
+        if self._tiers is not None:
+            return self._tiers[persistent]
+        return self._persistent_mem if persistent else self._runtime_mem
+
+    def _on_evict(self, entries: list) -> None:
+        """_on_evict.
+        Called by the runtime memory with the keys it evicted to stay
+        within its budget. Spills them to persistent memory if enabled.
+        In tiered mode dirty keys are always spilled (demoted) and clean
+        ones, already in persistent memory, are dropped.
+
+        Args:
+            entries (list): (key, kind, value, ttl) tuples
+        """
+        self.metrics.counter('derpme_evicted_keys_total').inc(len(entries))
+        if self._preloading:
+            # Copies of persistent keys, evicted before any client could
+            # read them
+            if self._tiers is not None:
+                self._tiers[True].clean.difference_update(
+                    entry[0] for entry in entries)
+            return
+        keys = []
+        for key, kind, val, ttl in entries:
+            keys.append(key)
+            if self._tiers is not None:
+                clean = self._tiers[True].clean
+                if key in clean:
+                    clean.discard(key)
+                    continue
+            elif not self.spill_evicted:
+                continue
+            try:
+                if kind == 'val':
+                    self._persistent_mem.set(key, val, ttl)
+                elif kind == 'list':
+                    self._persistent_mem.lset(key, val, ttl)
+                else:
+                    # Appended as raw bytes. Only the newest len(val) bytes
+                    # are guaranteed to be kept
+                    self._persistent_mem.series_append(key, val, 1, len(val))
+                    if ttl is not None:
+                        self._persistent_mem.expire(key, ttl)
+            except Exception as exc:
+                self.logger.error(
+                    'Failed to spill evicted key <{}>: {}'.format(key, exc))
+                continue
+            self.metrics.counter('derpme_spilled_keys_total').inc()
+        self._invalidate(keys)
+
+    def _record_change(self, op: dict, persistent: bool) -> None:
+        """_record_change.
+        Queue the change event of a write operation of a batch.
+        """
+        name = op['op']
+        if name == 'set':
+            self._changes.set(op['key'], op['val'], persistent, op.get('ttl'))
+        elif name == 'mset':
+            self._changes.mset(op['keys'], op['vals'], persistent,
+                               op.get('ttl'))
+        elif name == 'lset':
+            self._changes.lset(op['key'], op['vals'], persistent,
+                               op.get('ttl'))
+
+    def _debug_log(self, fmt: str, *args) -> None:
+        """_debug_log.
+        Log a debug message. The message is only formatted when debugging is
+        enabled, and long arguments are truncated.
+        """
+        if not self._debug:
+            return
+        args = [a if len(a) <= 200 else a[:200] + '...'
+                for a in map(str, args)]
+        self.logger.debug(fmt.format(*args))
+
+    def _expire_loop(self) -> None:
+        """_expire_loop.
+        Active expiration. Periodically delete the keys whose time to live
+        has passed from memories without native expiry, and publish their
+        invalidation.
+        """
+        while not self._stop_event.wait(self.expiry_interval):
+            for mem, persistent in ((self._runtime_mem, False),
+                                    (self._persistent_mem, True)):
+                try:
+                    while True:
+                        keys = mem.expire_due(self._EXPIRE_BATCH)
+                        if keys:
+                            if self._tiers is not None and not persistent:
+                                self._tiers[True].clean.difference_update(
+                                    keys)
+                            self._invalidate(keys, persistent)
+                        if len(keys) < self._EXPIRE_BATCH:
+                            break
+                except Exception as exc:
+                    self.logger.error('Active expiration failed: {}'.format(
+                        exc))
+
+    @staticmethod
+    def _check_ttl(msg: dict, resp: dict) -> bool:
+        """_check_ttl.
+        Validate the optional <ttl> parameter of a request, setting the
+        error of the response if it is invalid.
+        """
+        ttl = msg.get('ttl')
+        if ttl is None or (isinstance(ttl, (int, float)) and
+                           not isinstance(ttl, bool) and ttl > 0):
+            return True
+        resp['status'] = 0
+        resp['error'] = 'Invalid <ttl> parameter'
+        return False
+
+    def _callback_stats(self, msg, meta):
+        """_callback_stats.
+        Returns runtime statistics and metrics of the server. Set <format>
+        to 'prometheus' to get the metrics in Prometheus text format.
+
+        Args:
+            msg: Request Message
+            meta: Message Meta-Information
+        """
+        resp = {
+            'status': 1,
+            'error': ''
+        }
+        if msg.get('format') == 'prometheus':
+            resp['val'] = self.metrics.to_prometheus()
+        else:
+            resp['val'] = self.stats()
+        return resp
 
     def _callback_get(self, msg, meta):
         """_callback_get.
@@ -342,11 +2177,11 @@ class DerpMe(object):
                 persistent = True
         key = msg['key']
         if persistent:
-            self.logger.debug('[Persistent Mem]: GET <{}>'.format(key))
-            val = self._persistent_mem.get(key)
+            self._debug_log('[Persistent Mem]: GET <{}>', key)
+            val = self._mem(True).get(key)
         else:
-            self.logger.debug('[Runtime Mem]: GET <{}>'.format(key))
-            val = self._runtime_mem.get(key)
+            self._debug_log('[Runtime Mem]: GET <{}>', key)
+            val = self._mem(False).get(key)
         resp['val'] = val
         return resp
 
@@ -374,20 +2209,20 @@ class DerpMe(object):
         if 'persistent' in msg:
             if msg['persistent']:
                 persistent = True
+        if not self._check_ttl(msg, resp):
+            return resp
         key = msg['key']
         val = msg['val']
+        ttl = msg.get('ttl')
         if persistent:
-            self.logger.debug('[Persistent Mem]: SET <{},{}>'.format(key, val))
-            self._persistent_mem.set(key, val)
-            try:
-                self._persistent_mem.bgsave()
-            except Exception:
-                pass
+            self._debug_log('[Persistent Mem]: SET <{},{}>', key, val)
+            self._mem(True).set(key, val, ttl)
         else:
-            sval = str(val)
-            sval = sval if len(sval) < 200 else sval[:200] + "..."
-            self.logger.debug('[Runtime Mem]: SET <{},{}>'.format(key, sval))
-            self._runtime_mem.set(key, val)
+            self._debug_log('[Runtime Mem]: SET <{},{}>', key, val)
+            self._mem(False).set(key, val, ttl)
+        self._invalidate([key], persistent)
+        if self._changes is not None:
+            self._changes.set(key, val, persistent, ttl)
         return resp
 
     def _callback_mset(self, msg, meta):
@@ -416,21 +2251,22 @@ class DerpMe(object):
                 persistent = True
         keys = msg['keys']
         vals = msg['vals']
-        _d = {}
-        for i in range(len(keys)):
-            _d[keys[i]] = vals[i]
+        if len(keys) != len(vals):
+            resp['status'] = 0
+            resp['error'] = 'Length of <keys> and <vals> does not match'
+            return resp
+        if not self._check_ttl(msg, resp):
+            return resp
+        ttl = msg.get('ttl')
         if persistent:
-            self.logger.debug('[Persistent Mem]: MSET <{},{}>'.format(keys, vals))
-            self._persistent_mem.mset(_d)
-            try:
-                self._persistent_mem.bgsave()
-            except Exception:
-                pass
+            self._debug_log('[Persistent Mem]: MSET <{},{}>', keys, vals)
+            self._mem(True).mset(keys, vals, ttl)
         else:
-            sval = str(vals)
-            sval = sval if len(sval) < 200 else sval[:200] + "..."
-            self.logger.debug('[Runtime Mem]: MSET <{},{}>'.format(keys, sval))
-            self._runtime_mem.mset(_d)
+            self._debug_log('[Runtime Mem]: MSET <{},{}>', keys, vals)
+            self._mem(False).mset(keys, vals, ttl)
+        self._invalidate(keys, persistent)
+        if self._changes is not None:
+            self._changes.mset(keys, vals, persistent, ttl)
         return resp
 
     def _callback_mget(self, msg, meta):
@@ -455,14 +2291,85 @@ class DerpMe(object):
                 persistent = True
         keys = msg['keys']
         if persistent:
-            self.logger.debug('[Persistent Mem]: MGET <{}>'.format(keys))
-            vals = self._persistent_mem.mget(keys)
+            self._debug_log('[Persistent Mem]: MGET <{}>', keys)
+            vals = self._mem(True).mget(keys)
         else:
-            self.logger.debug('[Runtime Mem]: MGET <{}>'.format(keys))
-            vals = self._runtime_mem.mget(keys)
+            self._debug_log('[Runtime Mem]: MGET <{}>', keys)
+            vals = self._mem(False).mget(keys)
         resp['vals'] = vals
         return resp
 
+    def _callback_scan(self, msg, meta):
+        """_callback_scan.
+        Incrementally iterate over the keys matching the glob pattern
+        <match>. Each request visits about <count> keys from <cursor> on and
+        returns the matching ones in <keys>, plus the cursor of the next
+        request, which is 0 once the iteration is complete.
+
+        Args:
+            msg: Request Message
+            meta: Message Meta-Information
+        """
+        resp = {
+            'status': 1,
+            'error': '',
+            'keys': [],
+            'cursor': 0
+        }
+        count = msg.get('count', 100)
+        if not isinstance(count, int) or count <= 0:
+            resp['status'] = 0
+            resp['error'] = 'Invalid <count> parameter'
+            return resp
+        mem = self._mem(bool(msg.get('persistent')))
+        self._debug_log('SCAN <{},{}>', msg.get('match'), msg.get('cursor'))
+        cursor, keys = mem.scan(msg.get('cursor', 0), msg.get('match'),
+                                min(count, self._SCAN_MAX_COUNT))
+        resp['keys'] = [key for key in keys if not series.is_meta_key(key)]
+        resp['cursor'] = cursor
+        return resp
+
+    def _callback_mget_prefix(self, msg, meta):
+        """_callback_mget_prefix.
+        Returns in <val> a {key: value} dict of the keys starting with
+        <prefix>, up to <limit> keys. <truncated> is set if there are more.
+        Keys holding lists or series are left out.
+
+        Args:
+            msg: Request Message
+            meta: Message Meta-Information
+        """
+        resp = {
+            'status': 1,
+            'error': '',
+            'val': {},
+            'truncated': False
+        }
+        if not 'prefix' in msg:
+            resp['status'] = 0
+            resp['error'] = 'Missing <prefix> parameter'
+            return resp
+        limit = msg.get('limit', 1000)
+        if not isinstance(limit, int) or limit <= 0:
+            resp['status'] = 0
+            resp['error'] = 'Invalid <limit> parameter'
+            return resp
+        limit = min(limit, self._MGET_PREFIX_MAX)
+        mem = self._mem(bool(msg.get('persistent')))
+        self._debug_log('MGET_PREFIX <{}>', msg['prefix'])
+        keys = mem.scan_prefix(msg['prefix'], limit + 1)
+        found = set(keys)
+        # Series hold packed samples, found by their dtype key
+        keys = [key for key in keys if not series.is_meta_key(key) and
+                key + series.DTYPE_SUFFIX not in found]
+        if len(keys) > limit:
+            resp['truncated'] = True
+            keys = keys[:limit]
+        vals = mem.mget(keys) if keys else []
+        resp['val'] = {key: val for key, val in zip(keys, vals)
+                       if val is not None}
+        return resp
+
     def _callback_lget(self, msg, meta):
         """_callback_lget.
         Modified Redis LGET operation. Returns a list given its key.
@@ -498,23 +2405,81 @@ class DerpMe(object):
         _to = msg['l_to']
         _key = msg['key']
 
-        if self._runtime_mem.llen(_key) == 0:
+        if msg.get('typed'):
+            return self._lget_series(_key, _from, _to, persistent, resp)
+        if persistent:
+            self._debug_log('[Persistent Mem]: LGET <{},[{},{}]>',
+                            _key, _from, _to)
+        else:
+            self._debug_log('[Runtime Mem]: LGET <{},[{},{}]>',
+                            _key, _from, _to)
+        # Length and items are read together, so the list cannot change
+        # in between
+        size, res = self._mem(persistent).llen_range(_key, _from, _to)
+        if size == 0:
             # Check if list exists: https://redis.io/commands/llen
             resp['status'] = 0
             resp['error'] = 'List <{}> does not exist'.format(_key)
             return resp
-        if persistent:
-            self.logger.debug(
-                '[Persistent Mem]: LGET <{},[{},{}]>'.format(_key, _from, _to))
-            res = self._persistent_mem.lget(_key, _from, _to)
-        else:
-            self.logger.debug(
-                '[Runtime Mem]: LGET <{},[{},{}]>'.format(_key, _from, _to))
-            res = self._runtime_mem.lget(_key, _from, _to)
-        res = [json.loads(x) for x in res]
+        res = decode_elements(res)
         resp['val'] = res
         return resp
 
+    def _callback_lscan(self, msg, meta):
+        """_callback_lscan.
+        Cursor based iteration over a list, newest items first. Each request
+        returns up to <count> items from position <cursor> on, and the
+        cursor of the next chunk, which is 0 once the list is exhausted.
+        Items pushed during a scan shift the list, so they may cause items
+        to be returned twice, but never skipped. Typed series are rejected,
+        they are read with a typed lget.
+
+        Args:
+            msg: Request Message
+            meta: Message Meta-Information
+        """
+        resp = {
+            'status': 1,
+            'error': '',
+            'val': [],
+            'cursor': 0
+        }
+        if not 'key' in msg:
+            resp['status'] = 0
+            resp['error'] = 'Missing <key> parameter'
+            return resp
+        cursor = msg.get('cursor', 0)
+        count = msg.get('count', 100)
+        if not isinstance(cursor, int) or isinstance(cursor, bool) or \
+                cursor < 0:
+            resp['status'] = 0
+            resp['error'] = 'Invalid <cursor> parameter'
+            return resp
+        if not isinstance(count, int) or isinstance(count, bool) or \
+                count <= 0:
+            resp['status'] = 0
+            resp['error'] = 'Invalid <count> parameter'
+            return resp
+        count = min(count, self._LSCAN_MAX_COUNT)
+        key = msg['key']
+        mem = self._mem(bool(msg.get('persistent')))
+        if mem.get(key + series.DTYPE_SUFFIX) is not None:
+            resp['status'] = 0
+            resp['error'] = 'Key <{}> is a typed series, read it with a ' \
+                'typed lget'.format(key)
+            return resp
+        self._debug_log('LSCAN <{},{},{}>', key, cursor, count)
+        # lget offsets are negated LRANGE offsets
+        size, res = mem.llen_range(key, -cursor, -(cursor + count - 1))
+        if size == 0:
+            resp['status'] = 0
+            resp['error'] = 'List <{}> does not exist'.format(key)
+            return resp
+        resp['val'] = decode_elements(res)
+        if cursor + count < size:
+            resp['cursor'] = cursor + count
+        return resp
+
     def _callback_lset(self, msg, meta):
         """_callback_lset.
         Modified Redis LSET operation
@@ -539,18 +2504,191 @@ class DerpMe(object):
         if 'persistent' in msg:
             if msg['persistent']:
                 persistent = True
+        if not self._check_ttl(msg, resp):
+            return resp
         key = msg['key']
         vals = msg['vals']
-        vals = [json.dumps(x) for x in vals]
+        ttl = msg.get('ttl')
+        if msg.get('dtype') is not None:
+            return self._lset_series(key, vals, msg['dtype'],
+                                     msg.get('timestamps'), persistent, resp,
+                                     ttl)
+        vals = encode_elements(vals)
         if persistent:
-            self.logger.debug(
-                '[Persistent Mem]: LSET <{},{}>'.format(key, vals))
-            self._persistent_mem.lset(key, vals)
+            self._debug_log('[Persistent Mem]: LSET <{},{}>', key, vals)
+            self._mem(True).lset(key, vals, ttl)
         else:
-            sval = str(vals)
-            sval = sval if len(sval) < 200 else sval[:200] + "..."
-            self.logger.debug('[Runtime Mem]: LSET <{},{}>'.format(key, sval))
-            self._runtime_mem.lset(key, vals)
+            self._debug_log('[Runtime Mem]: LSET <{},{}>', key, vals)
+            self._mem(False).lset(key, vals, ttl)
+        self._invalidate([key], persistent)
+        if self._changes is not None:
+            self._changes.lset(key, msg['vals'], persistent, ttl)
+        return resp
+
+    def _lset_series(self, key: str, vals: list, dtype: str,
+                     timestamps: list, persistent: bool, resp: dict,
+                     ttl: float = None):
+        """_lset_series.
+        Typed mode of lset. Samples are appended to a packed series of the
+        declared dtype, with optional per-sample timestamps. A time to live
+        applies to the series, its dtype and its timestamps.
+        """
+        mem = self._persistent_mem if persistent else self._runtime_mem
+        if dtype not in series.DTYPES:
+            resp['status'] = 0
+            resp['error'] = 'Unsupported dtype <{}>'.format(dtype)
+            return resp
+        if timestamps is not None and len(timestamps) != len(vals):
+            resp['status'] = 0
+            resp['error'] = 'Length of <timestamps> and <vals> does not match'
+            return resp
+        declared = mem.get(key + series.DTYPE_SUFFIX)
+        if declared is not None and declared != dtype:
+            resp['status'] = 0
+            resp['error'] = 'Series <{}> has dtype <{}>'.format(key, declared)
+            return resp
+        ts_key = key + series.TIMESTAMPS_SUFFIX
+        if timestamps is None and declared is not None and \
+                mem.series_len(ts_key, 8, self.series_size) > 0:
+            # Keep the timestamps of a timestamped series aligned
+            timestamps = [time.time()] * len(vals)
+        try:
+            data = series.pack(vals, dtype)
+            ts_data = None if timestamps is None else \
+                series.pack(timestamps, 'float64')
+        except (TypeError, OverflowError) as exc:
+            resp['status'] = 0
+            resp['error'] = str(exc)
+            return resp
+        if declared is None:
+            mem.set(key + series.DTYPE_SUFFIX, dtype)
+        mem.series_append(key, data, series.itemsize(dtype),
+                          self.series_size)
+        if ts_data is not None:
+            mem.series_append(ts_key, ts_data, 8, self.series_size)
+        if ttl is not None:
+            for _key in (key, key + series.DTYPE_SUFFIX, ts_key):
+                mem.expire(_key, ttl)
+        self._invalidate([key], persistent)
+        if self._changes is not None:
+            self._changes.lset(key, vals, persistent, ttl, dtype)
+        return resp
+
+    def _lget_series(self, key: str, l_from: int, l_to: int,
+                     persistent: bool, resp: dict):
+        """_lget_series.
+        Typed mode of lget. Returns the selected samples, oldest first, as
+        a base64 encoded packed buffer plus its dtype.
+        """
+        mem = self._persistent_mem if persistent else self._runtime_mem
+        dtype = mem.get(key + series.DTYPE_SUFFIX)
+        if dtype is None:
+            resp['status'] = 0
+            resp['error'] = 'Series <{}> does not exist'.format(key)
+            return resp
+        itemsize = series.itemsize(dtype)
+        data = mem.series_range(key, l_from, l_to, itemsize,
+                                self.series_size)
+        ts_key = key + series.TIMESTAMPS_SUFFIX
+        size = mem.series_len(key, itemsize, self.series_size)
+        ts_size = mem.series_len(ts_key, 8, self.series_size)
+        win = series.window(size, l_from, l_to)
+        ts_data = None
+        if win is not None and ts_size > 0:
+            # The timestamps may only cover the newest samples, if the
+            # series was first appended to without them
+            lo = win[0] - size + ts_size
+            hi = win[1] - size + ts_size
+            pad = min(max(-lo, 0), hi - lo)
+            lo = max(lo, 0)
+            ts_data = series.pack([float('nan')] * pad, 'float64')
+            if hi > lo:
+                ts_data += mem.series_range(ts_key, hi - ts_size,
+                                            lo + 1 - ts_size, 8,
+                                            self.series_size)
+        resp['val'] = {
+            'dtype': dtype,
+            'data': base64.b64encode(data).decode('ascii'),
+            'timestamps': base64.b64encode(ts_data).decode('ascii')
+            if ts_data else None
+        }
+        return resp
+
+    def _callback_expire(self, msg, meta):
+        """_callback_expire.
+        Set the time to live of a key, in seconds. Returns in <val> whether
+        the key exists.
+
+        Args:
+            msg: Request Message
+            meta: Message Meta-Information
+        """
+        resp = {
+            'status': 1,
+            'error': '',
+            'val': False
+        }
+        if not 'key' in msg:
+            resp['status'] = 0
+            resp['error'] = 'Missing <key> parameter'
+            return resp
+        if msg.get('ttl') is None:
+            resp['status'] = 0
+            resp['error'] = 'Missing <ttl> parameter'
+            return resp
+        if not self._check_ttl(msg, resp):
+            return resp
+        persistent = bool(msg.get('persistent'))
+        mem = self._mem(persistent)
+        self._debug_log('EXPIRE <{},{}>', msg['key'], msg['ttl'])
+        resp['val'] = mem.expire(msg['key'], msg['ttl'])
+        return resp
+
+    def _callback_ttl(self, msg, meta):
+        """_callback_ttl.
+        Returns the seconds until a key expires, -1 if the key has no time
+        to live and -2 if it does not exist.
+
+        Args:
+            msg: Request Message
+            meta: Message Meta-Information
+        """
+        resp = {
+            'status': 1,
+            'error': '',
+            'val': -2
+        }
+        if not 'key' in msg:
+            resp['status'] = 0
+            resp['error'] = 'Missing <key> parameter'
+            return resp
+        persistent = bool(msg.get('persistent'))
+        mem = self._mem(persistent)
+        resp['val'] = mem.ttl(msg['key'])
+        return resp
+
+    def _callback_persist(self, msg, meta):
+        """_callback_persist.
+        Remove the time to live of a key. Returns in <val> whether the key
+        had one.
+
+        Args:
+            msg: Request Message
+            meta: Message Meta-Information
+        """
+        resp = {
+            'status': 1,
+            'error': '',
+            'val': False
+        }
+        if not 'key' in msg:
+            resp['status'] = 0
+            resp['error'] = 'Missing <key> parameter'
+            return resp
+        persistent = bool(msg.get('persistent'))
+        mem = self._mem(persistent)
+        self._debug_log('PERSIST <{}>', msg['key'])
+        resp['val'] = mem.persist(msg['key'])
         return resp
 
     def _callback_flush(self, msg, meta):
@@ -565,17 +2703,240 @@ class DerpMe(object):
             'status': 1,
             'error': ''
         }
-        self.logger.debug('Flushing db...')
+        self._debug_log('Flushing db...')
         try:
-            self._runtime_mem.flush()
+            self._mem(False).flush()
         except Exception as exc:
             print(exc)
             resp['status'] = 0
             resp['error'] = str(exc)
+        if resp['status']:
+            self._invalidate([], flush=True)
+            if self._changes is not None:
+                self._changes.flush()
+        return resp
+
+    def _callback_batch(self, msg, meta):
+        """_callback_batch.
+        Execute an ordered list of operations, each one a request message of
+        the corresponding endpoint plus an <op> field. Consecutive single
+        memory operations are grouped per memory (runtime/persistent) and
+        each group is executed in one pipeline. lget, typed lset and flush
+        go through the handlers of their endpoints, after the operations
+        before them. Returns a response per operation, in request order.
+
+        Args:
+            msg: Request Message
+            meta: Message Meta-Information
+        """
+        resp = {
+            'status': 1,
+            'error': '',
+            'results': []
+        }
+        if not 'ops' in msg:
+            resp['status'] = 0
+            resp['error'] = 'Missing <ops> parameter'
+            return resp
+        handlers = {
+            'lget': self._callback_lget,
+            'lset': self._callback_lset,
+            'flush': self._callback_flush
+        }
+        results = []
+        # memory -> [(result index, [(method, args), ...]), ...]
+        queued = {
+            self._mem(False): [],
+            self._mem(True): []
+        }
+        for op in msg['ops']:
+            result = {
+                'status': 1,
+                'error': ''
+            }
+            results.append(result)
+            name = op.get('op')
+            if name not in self._BATCH_PARAMS:
+                result['status'] = 0
+                result['error'] = 'Unsupported operation <{}>'.format(name)
+                continue
+            missing = [p for p in self._BATCH_PARAMS[name] if p not in op]
+            if missing:
+                result['status'] = 0
+                result['error'] = 'Missing <{}> parameter'.format(missing[0])
+                continue
+            if not self._check_ttl(op, result):
+                continue
+            if name in handlers and \
+                    (name != 'lset' or op.get('dtype') is not None):
+                self._execute_queued(queued, msg['ops'], results)
+                try:
+                    results[-1] = handlers[name](op, meta)
+                except Exception as exc:
+                    result['status'] = 0
+                    result['error'] = str(exc)
+                continue
+            mem = self._mem(bool(op.get('persistent')))
+            if name in ('get', 'set'):
+                mem_ops = [(name, (op['key'], op['val'], op.get('ttl'))
+                            if name == 'set' else (op['key'],))]
+            elif name in ('mget', 'mset'):
+                if name == 'mset' and len(op['keys']) != len(op['vals']):
+                    result['status'] = 0
+                    result['error'] = \
+                        'Length of <keys> and <vals> does not match'
+                    continue
+                mem_ops = [(name, (op['keys'], op['vals'], op.get('ttl'))
+                            if name == 'mset' else (op['keys'],))]
+            elif name == 'lset':
+                vals = encode_elements(op['vals'])
+                mem_ops = [('lset', (op['key'], vals, op.get('ttl')))]
+            elif name == 'expire':
+                if op['ttl'] is None:
+                    result['status'] = 0
+                    result['error'] = 'Missing <ttl> parameter'
+                    continue
+                mem_ops = [('expire', (op['key'], op['ttl']))]
+            else:
+                mem_ops = [(name, (op['key'],))]
+            queued[mem].append((len(results) - 1, mem_ops))
+        self._execute_queued(queued, msg['ops'], results)
+        resp['results'] = results
+        return resp
+
+    def _execute_queued(self, queued: dict, ops: list, results: list):
+        """_execute_queued.
+        Execute the operations of a batch queued per memory, one pipeline
+        per memory, and fill in their results.
+
+        Args:
+            queued (dict): {memory: [(result index, [(method, args), ...])]},
+                emptied
+            ops (list): Operations of the batch
+            results (list): Results of the batch
+        """
+        for mem, entries in queued.items():
+            if not entries:
+                continue
+            queued[mem] = []
+            mem_ops = [mem_op for _, _ops in entries for mem_op in _ops]
+            try:
+                replies = iter(mem.execute(mem_ops))
+            except Exception as exc:
+                for idx, _ in entries:
+                    results[idx]['status'] = 0
+                    results[idx]['error'] = str(exc)
+                continue
+            persistent = mem is self._mem(True)
+            written = []
+            for idx, _ops in entries:
+                result = results[idx]
+                op = ops[idx]
+                name = op['op']
+                if name in ('set', 'lset'):
+                    written.append(op['key'])
+                elif name == 'mset':
+                    written.extend(op['keys'])
+                if self._changes is not None:
+                    self._record_change(op, persistent)
+                reply = [next(replies) for _ in _ops]
+                if name in ('get', 'expire', 'ttl', 'persist'):
+                    result['val'] = reply[0]
+                elif name == 'mget':
+                    result['vals'] = reply[0]
+            if written:
+                self._invalidate(written, persistent)
+
+    def _publish_replication(self, msg: dict) -> None:
+        self._replication_pub.publish(msg)
+
+    def _callback_replication_fetch(self, msg, meta):
+        """_callback_replication_fetch.
+        Returns the entries of the replication log from <offset> on, at most
+        <limit>, compressed in <data>, and the <next> offset of the log.
+        Sets <resync> if <epoch> is not the epoch of the log or the offset
+        is not in its backlog anymore.
+
+        Args:
+            msg: Request Message
+            meta: Message Meta-Information
+        """
+        from .replication import encode_entries
+        resp = {
+            'status': 1,
+            'error': '',
+            'epoch': self._replication.epoch,
+            'data': '',
+            'next': self._replication.next_offset
+        }
+        if not 'offset' in msg:
+            resp['status'] = 0
+            resp['error'] = 'Missing <offset> parameter'
+            return resp
+        limit = min(msg.get('limit', 1000), self._SCAN_MAX_COUNT)
+        entries = None
+        if msg.get('epoch') == self._replication.epoch:
+            entries = self._replication.read(msg['offset'], limit)
+        if entries is None:
+            resp['status'] = 0
+            resp['error'] = 'Offset <{}> is not in the replication ' \
+                'log'.format(msg['offset'])
+            resp['resync'] = True
+            return resp
+        resp['data'] = encode_entries(entries, self._replication.level)
+        return resp
+
+    def _callback_replication_snapshot(self, msg, meta):
+        """_callback_replication_snapshot.
+        One step of a snapshot of the persistent memory: the records (see
+        snapshot.read_records) of about <count> keys from <cursor> on,
+        compressed in <data>, and the <cursor> of the next step, 0 once
+        complete. <epoch> and <offset> are the position of the replication
+        log the records were read at.
+
+        Args:
+            msg: Request Message
+            meta: Message Meta-Information
+        """
+        from .replication import encode_entries
+        resp = {
+            'status': 1,
+            'error': '',
+            'epoch': self._replication.epoch,
+            'offset': 0,
+            'cursor': 0,
+            'data': ''
+        }
+        count = min(msg.get('count', 100), self._SCAN_MAX_COUNT)
+        cursor, records, offset = self._persistent_mem.snapshot(
+            msg.get('cursor', 0), count)
+        resp['cursor'] = cursor
+        resp['offset'] = offset
+        resp['data'] = encode_entries(records, self._replication.level)
         return resp
 
     def run_forever(self):
         """run_forever.
+        Block until stop() is called.
         """
-        while True:
-            time.sleep(0.001)
+        while not self._stop_event.wait(1.0):
+            pass
+
+    def stop(self):
+        """stop.
+        Stop serving requests and release the memories.
+        """
+        self._stop_event.set()
+        self._expiry_thread.join()
+        self.dispatcher.stop()
+        if self._changes is not None:
+            self._changes.stop()
+        if self._follower is not None:
+            self._follower.stop()
+        if self._replication is not None:
+            self._replication.stop()
+        for mem in (self._runtime_mem, self._persistent_mem):
+            if hasattr(mem, 'close'):
+                mem.close()
+        for pool in self._redis_pools.values():
+            pool.disconnect()
@@ -0,0 +1,182 @@
+"""Request dispatching."""
+
+import queue
+import threading
+from concurrent.futures import Future
+from enum import IntEnum
+
+
+class DispatchMode(IntEnum):
+    """DispatchMode.
+    """
+    DIRECT = 1
+    THREAD = 2
+
+
+class DispatcherBusy(Exception):
+    """DispatcherBusy.
+    Raised when the queue of a tier is full and a request is rejected.
+    """
+
+
+class _TierStats(object):
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        # Submitted and not finished yet, queued or running
+        self.pending = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+
+class Dispatcher(object):
+    """Dispatcher.
+    Runs requests on a pool of workers per memory tier, which bounds the
+    number of requests each memory executes at the same time. A backlog of
+    slow persistent operations thus occupies at most `persistent_workers`
+    connections or threads of the backend, and never the runtime workers.
+
+    The transport calls the RPC callbacks on its own threads and sends
+    their return value as the response, so submit() blocks its caller
+    until the job is done: the dispatcher adds no parallelism beyond the
+    threads of the transport. At most `queue_size` requests of a tier
+    wait for a worker, the next ones are rejected with DispatcherBusy.
+    Since every waiting request holds a transport thread, a queue_size
+    below the number of transport threads is needed to shed load.
+
+    Modes:
+        DIRECT:  Execute in the calling thread (no queueing).
+        THREAD:  A thread pool per tier.
+    """
+
+    TIERS = ('runtime', 'persistent')
+
+    def __init__(self,
+                 mode: DispatchMode = DispatchMode.THREAD,
+                 runtime_workers: int = 4,
+                 persistent_workers: int = 2,
+                 queue_size: int = 1000):
+        """__init__.
+
+        Args:
+            mode (DispatchMode): Dispatching mode
+            runtime_workers (int): Number of workers serving runtime requests
+            persistent_workers (int): Number of workers serving persistent
+                requests
+            queue_size (int): Max number of requests per tier waiting for a
+                worker
+        """
+        self.mode = mode
+        self.queue_size = queue_size
+        self._stats = {
+            'runtime': _TierStats(runtime_workers, queue_size),
+            'persistent': _TierStats(persistent_workers, queue_size)
+        }
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._threads = []
+        self._running = False
+
+    def start(self) -> None:
+        if self._running:
+            return
+        self._running = True
+        if self.mode == DispatchMode.THREAD:
+            self._start_threads()
+
+    def stop(self) -> None:
+        if not self._running:
+            return
+        self._running = False
+        if self.mode == DispatchMode.THREAD:
+            for tier in self.TIERS:
+                for _ in range(self._stats[tier].workers):
+                    self._queues[tier].put(None)
+            for t in self._threads:
+                t.join()
+        self._threads = []
+
+    def _start_threads(self) -> None:
+        for tier in self.TIERS:
+            self._queues[tier] = queue.Queue()
+            for i in range(self._stats[tier].workers):
+                t = threading.Thread(
+                    target=self._thread_worker,
+                    args=(tier,),
+                    name='derpme-{}-{}'.format(tier, i),
+                    daemon=True
+                )
+                t.start()
+                self._threads.append(t)
+
+    def _thread_worker(self, tier: str) -> None:
+        _queue = self._queues[tier]
+        while True:
+            job = _queue.get()
+            if job is None:
+                return
+            fut, fn, args = job
+            self._run_job(tier, fut, fn, args)
+
+    def _run_job(self, tier: str, fut: Future, fn, args: tuple) -> None:
+        if not fut.set_running_or_notify_cancel():
+            return
+        stats = self._stats[tier]
+        with self._lock:
+            stats.active += 1
+        try:
+            fut.set_result(fn(*args))
+            ok = True
+        except Exception as exc:
+            fut.set_exception(exc)
+            ok = False
+        with self._lock:
+            stats.active -= 1
+            stats.pending -= 1
+            if ok:
+                stats.completed += 1
+            else:
+                stats.failed += 1
+
+    def submit(self, tier: str, fn, *args):
+        """submit.
+        Execute fn(*args) on a worker of the given tier and wait for the
+        result.
+
+        Args:
+            tier (str): 'runtime' or 'persistent'
+            fn: Callable
+            args: Positional arguments of fn
+        """
+        if self.mode == DispatchMode.DIRECT or not self._running:
+            return fn(*args)
+        stats = self._stats[tier]
+        with self._lock:
+            if stats.pending >= stats.workers + stats.queue_size:
+                stats.rejected += 1
+                raise DispatcherBusy(tier)
+            stats.pending += 1
+        fut = Future()
+        self._queues[tier].put((fut, fn, args))
+        return fut.result()
+
+    def stats(self) -> dict:
+        """stats.
+        Returns per tier queue depth, active workers and request counters.
+        """
+        res = {'mode': self.mode.name}
+        with self._lock:
+            for tier in self.TIERS:
+                stats = self._stats[tier]
+                res[tier] = {
+                    'workers': stats.workers,
+                    'queue_size': stats.queue_size,
+                    'queue_depth': stats.pending - stats.active,
+                    'active': stats.active,
+                    'completed': stats.completed,
+                    'failed': stats.failed,
+                    'rejected': stats.rejected
+                }
+        return res
@@ -0,0 +1,173 @@
+"""Eviction policies of bounded memories."""
+
+from collections import OrderedDict
+from enum import IntEnum
+
+
+class EvictionPolicy(IntEnum):
+    """EvictionPolicy.
+    """
+    LRU = 1
+    LFU = 2
+    TTL = 3
+
+
+def approx_size(val) -> int:
+    """approx_size.
+    Approximate memory footprint of a value in bytes. Only meant to be
+    consistent, so that a memory budget can be enforced cheaply.
+    """
+    if isinstance(val, (str, bytes, bytearray)):
+        return len(val)
+    if isinstance(val, (list, tuple)):
+        return 8 * len(val) + sum(approx_size(x) for x in val)
+    if isinstance(val, dict):
+        return sum(approx_size(k) + approx_size(v) + 16
+                   for k, v in val.items())
+    return 8
+
+
+class LRUTracker(object):
+    """LRUTracker.
+    Keys in order of last access, least recently used first.
+    """
+
+    def __init__(self):
+        self._keys = OrderedDict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key: str) -> None:
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+
+    def touch(self, key: str) -> None:
+        if key in self._keys:
+            self._keys.move_to_end(key)
+
+    def remove(self, key: str) -> None:
+        self._keys.pop(key, None)
+
+    def victim(self, exclude: str = None):
+        """victim.
+        Returns the key to evict first, other than exclude, or None.
+        """
+        for key in self._keys:
+            if key != exclude:
+                return key
+        return None
+
+    def clear(self) -> None:
+        self._keys.clear()
+
+
+class LFUTracker(object):
+    """LFUTracker.
+    Keys grouped in buckets by access count, least recently used first
+    within a bucket. The non-empty buckets form a doubly linked list in
+    order of access count, so accesses and evictions are O(1).
+    """
+
+    def __init__(self):
+        self._freqs = {}
+        self._buckets = {}
+        # Neighbours of each bucket. 0 is the sentinel at both ends
+        self._next = {0: 0}
+        self._prev = {0: 0}
+
+    def __len__(self):
+        return len(self._freqs)
+
+    def _unlink(self, key: str, freq: int) -> None:
+        bucket = self._buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[freq]
+            prev = self._prev.pop(freq)
+            _next = self._next.pop(freq)
+            self._next[prev] = _next
+            self._prev[_next] = prev
+
+    def _link(self, key: str, freq: int, after: int) -> None:
+        """_link.
+        Add key to the bucket of freq, created right after the bucket of
+        the `after` count if missing.
+        """
+        self._freqs[key] = freq
+        bucket = self._buckets.get(freq)
+        if bucket is None:
+            bucket = self._buckets[freq] = OrderedDict()
+            _next = self._next[after]
+            self._next[after] = freq
+            self._prev[freq] = after
+            self._next[freq] = _next
+            self._prev[_next] = freq
+        bucket[key] = None
+
+    def add(self, key: str) -> None:
+        freq = self._freqs.get(key)
+        if freq is None:
+            self._link(key, 1, 0)
+        else:
+            self.touch(key)
+
+    def touch(self, key: str) -> None:
+        freq = self._freqs.get(key)
+        if freq is None:
+            return
+        # Linked while the bucket of freq still exists
+        self._link(key, freq + 1, freq)
+        self._unlink(key, freq)
+
+    def remove(self, key: str) -> None:
+        freq = self._freqs.pop(key, None)
+        if freq is not None:
+            self._unlink(key, freq)
+
+    def victim(self, exclude: str = None):
+        freq = self._next[0]
+        while freq:
+            for key in self._buckets[freq]:
+                if key != exclude:
+                    return key
+            freq = self._next[freq]
+        return None
+
+    def clear(self) -> None:
+        self._freqs.clear()
+        self._buckets.clear()
+        self._next = {0: 0}
+        self._prev = {0: 0}
+
+
+class TTLTracker(LRUTracker):
+    """TTLTracker.
+    Evicts the key closest to expiration first. Keys without a time to
+    live are evicted in LRU order once no key with one is left.
+    """
+
+    def __init__(self, expiry):
+        """__init__.
+
+        Args:
+            expiry (ExpiryIndex): Deadlines of the memory
+        """
+        super(TTLTracker, self).__init__()
+        self._expiry = expiry
+
+    def victim(self, exclude: str = None):
+        key = self._expiry.first(exclude)
+        if key is not None:
+            return key
+        return super(TTLTracker, self).victim(exclude)
+
+
+def make_tracker(policy: EvictionPolicy, expiry=None):
+    if policy == EvictionPolicy.LRU:
+        return LRUTracker()
+    elif policy == EvictionPolicy.LFU:
+        return LFUTracker()
+    elif policy == EvictionPolicy.TTL:
+        return TTLTracker(expiry)
+    raise ValueError('Unsupported eviction policy <{}>'.format(policy))
@@ -0,0 +1,105 @@
+"""Key expiration for memories without native TTL support."""
+
+import heapq
+import time
+
+
+class ExpiryIndex(object):
+    """ExpiryIndex.
+    Deadlines of the keys that have a TTL. Deadlines live in a dict, for
+    O(1) lazy checks on reads, and in a min-heap ordered by deadline, so
+    the keys due for expiration are found in O(log n) each.
+    Changing or removing the deadline of a key leaves its old heap entry
+    behind. Stale entries are skipped when popped, and the heap is rebuilt
+    once they outnumber the live ones.
+
+    Deadlines are wall-clock timestamps (time.time()), so that they stay
+    valid across restarts of persistent memories.
+    """
+
+    def __init__(self):
+        self._deadlines = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def set(self, key: str, deadline: float) -> None:
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(d, k) for k, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def remove(self, key: str) -> bool:
+        """remove.
+        Drop the deadline of a key. Returns False if it had none.
+        """
+        return self._deadlines.pop(key, None) is not None
+
+    def deadline(self, key: str):
+        return self._deadlines.get(key)
+
+    def expired(self, key: str, now: float = None) -> bool:
+        deadline = self._deadlines.get(key)
+        if deadline is None:
+            return False
+        return deadline <= (time.time() if now is None else now)
+
+    def ttl(self, key: str, now: float = None) -> float:
+        """ttl.
+        Seconds until the key expires, or -1 if it has no deadline.
+        """
+        deadline = self._deadlines.get(key)
+        if deadline is None:
+            return -1
+        return max(deadline - (time.time() if now is None else now), 0.0)
+
+    def pop_expired(self, now: float = None, limit: int = None) -> list:
+        """pop_expired.
+        Remove and return the keys whose deadline has passed.
+
+        Args:
+            now (float): Current time, defaults to time.time()
+            limit (int): Max number of keys to return
+        """
+        if now is None:
+            now = time.time()
+        heap = self._heap
+        keys = []
+        while heap and heap[0][0] <= now:
+            if limit is not None and len(keys) >= limit:
+                break
+            deadline, key = heapq.heappop(heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                keys.append(key)
+        return keys
+
+    def first(self, exclude: str = None):
+        """first.
+        Returns the key with the earliest deadline, other than exclude, or
+        None.
+        """
+        heap = self._heap
+        while heap and self._deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        if heap[0][1] != exclude:
+            return heap[0][1]
+        entry = heapq.heappop(heap)
+        try:
+            return self.first()
+        finally:
+            heapq.heappush(heap, entry)
+
+    def items(self):
+        return self._deadlines.items()
+
+    def clear(self) -> None:
+        self._deadlines.clear()
+        self._heap = []
@@ -0,0 +1,501 @@
+"""File-backed persistent memory."""
+
+import base64
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from .derp_me import PersistentMemory, _lrange, _series_slice
+from .expiry import ExpiryIndex
+from .keyindex import KeyIndex
+
+
+class FilePersistentMem(PersistentMemory):
+    """FilePersistentMem.
+    Embedded persistent memory. Every write is appended to a log file and
+    applied to an in-memory index, which serves all reads. Concurrent writers
+    are group-committed: a single writer thread appends whatever has been
+    queued since its last round, fsyncs once for the whole batch and only
+    then applies it to the index, so the index never holds writes that are
+    not in the log.
+    On startup the index is rebuilt by replaying the log. Once the log grows
+    past `compact_size` bytes (and is twice as large as after the previous
+    compaction), a compaction thread rewrites it from a copy of the index,
+    while the writer thread keeps appending to the current log. The batches
+    appended meanwhile are copied to the end of the new log before it
+    replaces the current one.
+
+    Keys with a time to live are tracked by an ExpiryIndex. Expired keys
+    are hidden from reads and deleted by expire_due(), which logs their
+    deletion, so replaying the log never depends on the time it runs.
+
+    Log records are JSON objects, one per line:
+        {"op": "set", "k": key, "v": val, "x": deadline}
+        {"op": "mset", "k": [keys], "v": [vals], "x": deadline}
+        {"op": "lpush", "k": key, "v": [vals], "x": deadline}
+        {"op": "lput", "k": key, "v": [vals]}  (whole list, head first)
+        {"op": "sappend", "k": key, "v": b64 data, "m": max bytes}
+        {"op": "sput", "k": key, "v": b64 data}  (whole typed series)
+        {"op": "expire", "k": key, "x": deadline}
+        {"op": "persist", "k": key}
+        {"op": "del", "k": [keys]}
+        {"op": "flush"}
+    The "x" field is optional. Deadlines are Unix timestamps.
+    Typed series are kept as byte buffers and appended to with sappend
+    records holding only the new samples. A buffer may grow to twice its
+    max bytes before it is trimmed, which amortizes the trimming.
+    """
+
+    def __init__(self,
+                 path: str = 'derpme.log',
+                 compact_size: int = 16 * 1024 * 1024,
+                 fsync: bool = True,
+                 *args, **kwargs):
+        """__init__.
+
+        Args:
+            path (str): Path of the log file
+            compact_size (int): Log size in bytes that triggers a compaction
+            fsync (bool): fsync every committed batch
+        """
+        super(FilePersistentMem, self).__init__(*args, **kwargs)
+        self.path = path
+        self.compact_size = compact_size
+        self.fsync = fsync
+        self._vals = {}
+        self._lists = {}
+        self._series = {}
+        self._expiry = ExpiryIndex()
+        # Built once the log is replayed, rather than key by key
+        self._index = None
+        self._cond = threading.Condition()
+        self._pending = []
+        self._pending_recs = []
+        self._queued_seq = 0
+        self._committed_seq = 0
+        self._error = None
+        self._running = True
+        _dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(_dir, exist_ok=True)
+        self._replay()
+        self._index = KeyIndex()
+        self._index.update(self._vals.keys() | self._lists.keys() |
+                           self._series.keys())
+        self._fd = open(self.path, 'ab')
+        self._log_size = self._fd.tell()
+        self._compacted_size = self._log_size
+        # Guards the log file, shared by the writer and compaction threads
+        self._fd_lock = threading.Lock()
+        self._compactor = None
+        # Batches appended since the snapshot of a running compaction
+        self._tail = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _set_deadline(self, key: str, deadline) -> None:
+        if deadline is None:
+            self._expiry.remove(key)
+        else:
+            self._expiry.set(key, deadline)
+
+    def _apply(self, rec: dict) -> None:
+        op = rec['op']
+        index = self._index
+        if op == 'set':
+            self._lists.pop(rec['k'], None)
+            self._series.pop(rec['k'], None)
+            self._vals[rec['k']] = rec['v']
+            self._set_deadline(rec['k'], rec.get('x'))
+            if index is not None:
+                index.add(rec['k'])
+        elif op == 'mset':
+            for key, val in zip(rec['k'], rec['v']):
+                self._lists.pop(key, None)
+                self._series.pop(key, None)
+                self._vals[key] = val
+                self._set_deadline(key, rec.get('x'))
+                if index is not None:
+                    index.add(key)
+        elif op == 'lpush':
+            _list = self._lists.get(rec['k'])
+            if _list is None:
+                self._vals.pop(rec['k'], None)
+                self._series.pop(rec['k'], None)
+                self._expiry.remove(rec['k'])
+                _list = deque(maxlen=self.list_size)
+                self._lists[rec['k']] = _list
+                if index is not None:
+                    index.add(rec['k'])
+            _list.extendleft(rec['v'])
+            if 'x' in rec:
+                self._expiry.set(rec['k'], rec['x'])
+        elif op == 'lput':
+            self._vals.pop(rec['k'], None)
+            self._series.pop(rec['k'], None)
+            self._lists[rec['k']] = deque(rec['v'], maxlen=self.list_size)
+            if index is not None:
+                index.add(rec['k'])
+        elif op == 'sappend':
+            buf = self._series.get(rec['k'])
+            if buf is None:
+                self._vals.pop(rec['k'], None)
+                self._lists.pop(rec['k'], None)
+                buf = bytearray()
+                self._series[rec['k']] = buf
+                if index is not None:
+                    index.add(rec['k'])
+            buf += base64.b64decode(rec['v'])
+            excess = len(buf) - rec['m']
+            if excess > rec['m']:
+                del buf[:excess]
+        elif op == 'sput':
+            self._vals.pop(rec['k'], None)
+            self._lists.pop(rec['k'], None)
+            self._series[rec['k']] = bytearray(base64.b64decode(rec['v']))
+            if index is not None:
+                index.add(rec['k'])
+        elif op == 'expire':
+            self._expiry.set(rec['k'], rec['x'])
+        elif op == 'persist':
+            self._expiry.remove(rec['k'])
+        elif op == 'del':
+            for key in rec['k']:
+                self._vals.pop(key, None)
+                self._lists.pop(key, None)
+                self._series.pop(key, None)
+                self._expiry.remove(key)
+                if index is not None:
+                    index.discard(key)
+        elif op == 'flush':
+            self._vals.clear()
+            self._lists.clear()
+            self._series.clear()
+            self._expiry.clear()
+            if index is not None:
+                index.clear()
+        else:
+            raise ValueError('Unknown log record <{}>'.format(op))
+
+    def _replay(self) -> None:
+        """_replay.
+        Rebuild the index from the log. A torn record at the tail (crash
+        during an append) is discarded and truncated away.
+        """
+        if not os.path.exists(self.path):
+            return
+        valid_size = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break
+                self._apply(rec)
+                valid_size += len(line)
+        if valid_size != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_size)
+
+    def _commit(self, *recs) -> None:
+        """_commit.
+        Block until records are on disk and applied to the index.
+        """
+        lines = [json.dumps(rec).encode() + b'\n' for rec in recs]
+        with self._cond:
+            if not self._running:
+                raise RuntimeError('{} is closed'.format(
+                    self.__class__.__name__))
+            if self._error is not None:
+                raise self._error
+            self._pending.extend(lines)
+            self._pending_recs.extend(recs)
+            self._queued_seq += 1
+            seq = self._queued_seq
+            self._cond.notify_all()
+            while self._committed_seq < seq and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+
+    def _snapshot(self) -> tuple:
+        """_snapshot.
+        Copy of the index, taken under the lock.
+        """
+        return (dict(self._vals),
+                {key: list(_list) for key, _list in self._lists.items()},
+                {key: bytes(buf) for key, buf in self._series.items()},
+                list(self._expiry.items()))
+
+    @staticmethod
+    def _snapshot_lines(snapshot: tuple) -> list:
+        vals, lists, series_bufs, deadlines = snapshot
+        lines = []
+        if vals:
+            rec = {
+                'op': 'mset',
+                'k': list(vals.keys()),
+                'v': list(vals.values())
+            }
+            lines.append(json.dumps(rec).encode() + b'\n')
+        for key, _list in lists.items():
+            rec = {'op': 'lput', 'k': key, 'v': _list}
+            lines.append(json.dumps(rec).encode() + b'\n')
+        for key, buf in series_bufs.items():
+            rec = {'op': 'sput', 'k': key,
+                   'v': base64.b64encode(buf).decode('ascii')}
+            lines.append(json.dumps(rec).encode() + b'\n')
+        for key, deadline in deadlines:
+            rec = {'op': 'expire', 'k': key, 'x': deadline}
+            lines.append(json.dumps(rec).encode() + b'\n')
+        return lines
+
+    def _compact(self, snapshot: tuple) -> None:
+        """_compact.
+        Compaction thread. Writes the snapshot to a new log, then, holding
+        the log file, appends the batches written since and swaps the logs.
+        """
+        tmp_path = self.path + '.compact'
+        try:
+            with open(tmp_path, 'wb') as f:
+                lines = self._snapshot_lines(snapshot)
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+                with self._fd_lock:
+                    f.writelines(self._tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self._fd.close()
+                    os.replace(tmp_path, self.path)
+                    self._fd = open(self.path, 'ab')
+                    self._log_size = self._fd.tell()
+                    # Live data only, not the batches of the tail
+                    self._compacted_size = sum(len(line) for line in lines)
+                    self._tail = None
+        except Exception as exc:
+            # Keep appending to the current log, retried once it doubles
+            print(exc)
+            with self._fd_lock:
+                self._tail = None
+                self._compacted_size = self._log_size
+                if self._fd.closed:
+                    self._fd = open(self.path, 'ab')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _start_compaction(self) -> None:
+        """_start_compaction.
+        Called by the writer thread, holding the lock, right after applying
+        a batch, so the snapshot matches the end of the log.
+        """
+        self._tail = []
+        self._compactor = threading.Thread(
+            target=self._compact, args=(self._snapshot(),), daemon=True)
+        self._compactor.start()
+
+    def _append(self, batch: list) -> None:
+        with self._fd_lock:
+            try:
+                self._fd.writelines(batch)
+                self._fd.flush()
+                if self.fsync:
+                    os.fsync(self._fd.fileno())
+            except Exception:
+                # Drop a partially written batch, it is not in the index
+                try:
+                    self._fd.truncate(self._log_size)
+                except Exception:
+                    pass
+                raise
+            self._log_size += sum(len(line) for line in batch)
+            if self._tail is not None:
+                self._tail.extend(batch)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while self._running and not self._pending:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, []
+                recs, self._pending_recs = self._pending_recs, []
+                seq = self._queued_seq
+            try:
+                self._append(batch)
+            except Exception as exc:
+                with self._cond:
+                    self._error = exc
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                for rec in recs:
+                    self._apply(rec)
+                self._committed_seq = seq
+                self._cond.notify_all()
+                if self._tail is None and self._compaction_due():
+                    self._start_compaction()
+
+    def _compaction_due(self) -> bool:
+        return self._log_size >= self.compact_size and \
+            self._log_size >= 2 * self._compacted_size
+
+    def _exists(self, key: str) -> bool:
+        return (key in self._vals or key in self._lists or
+                key in self._series) and not self._expiry.expired(key)
+
+    def set(self, key: str, val: str, ttl: float = None) -> None:
+        rec = {'op': 'set', 'k': key, 'v': val}
+        if ttl is not None:
+            rec['x'] = time.time() + ttl
+        self._commit(rec)
+
+    def get(self, key: str):
+        if self._expiry and self._expiry.expired(key):
+            return None
+        return self._vals.get(key)
+
+    def mset(self, keys: list, vals: list, ttl: float = None) -> None:
+        rec = {'op': 'mset', 'k': list(keys), 'v': list(vals)}
+        if ttl is not None:
+            rec['x'] = time.time() + ttl
+        self._commit(rec)
+
+    def mget(self, keys: list):
+        _vals = self._vals
+        if self._expiry:
+            expired = self._expiry.expired
+            return [None if expired(key) else _vals.get(key) for key in keys]
+        return [_vals.get(key) for key in keys]
+
+    def lset(self, key: str, vals: list, ttl: float = None) -> None:
+        rec = {'op': 'lpush', 'k': key, 'v': list(vals)}
+        if ttl is not None:
+            rec['x'] = time.time() + ttl
+        with self._cond:
+            if self._expiry.expired(key):
+                # Start a new list instead of extending the expired one
+                self._commit({'op': 'del', 'k': [key]}, rec)
+            else:
+                self._commit(rec)
+
+    def lget(self, key: str, from_idx: int, to_idx: int) -> list:
+        with self._cond:
+            _list = self._lists.get(key)
+            if _list is None or self._expiry.expired(key):
+                return []
+            return _lrange(_list, -1 * from_idx, -1 * to_idx)
+
+    def llen(self, key: str) -> int:
+        _list = self._lists.get(key)
+        if _list is None or self._expiry.expired(key):
+            return 0
+        return len(_list)
+
+    def flush(self) -> None:
+        self._commit({'op': 'flush'})
+
+    def scan(self, cursor=0, match: str = None, count: int = 100) -> tuple:
+        with self._cond:
+            cursor, keys = self._index.scan(cursor, match, count)
+        return cursor, [key for key in keys
+                        if not self._expiry.expired(key)]
+
+    def scan_prefix(self, prefix: str, limit: int) -> list:
+        with self._cond:
+            return self._index.prefix(prefix, limit, self._expiry.expired)
+
+    def expire(self, key: str, ttl: float) -> bool:
+        with self._cond:
+            if not self._exists(key):
+                return False
+            self._commit({'op': 'expire', 'k': key, 'x': time.time() + ttl})
+            return True
+
+    def ttl(self, key: str) -> float:
+        with self._cond:
+            if not self._exists(key):
+                return -2
+            return self._expiry.ttl(key)
+
+    def persist(self, key: str) -> bool:
+        with self._cond:
+            if not self._exists(key) or key not in self._expiry:
+                return False
+            self._commit({'op': 'persist', 'k': key})
+            return True
+
+    def expire_due(self, limit: int = None) -> list:
+        with self._cond:
+            keys = self._expiry.pop_expired(limit=limit)
+            if keys:
+                self._commit({'op': 'del', 'k': keys})
+        return keys
+
+    def delete(self, keys: list) -> int:
+        with self._cond:
+            found = [key for key in keys
+                     if key in self._vals or key in self._lists or
+                     key in self._series]
+            count = sum(1 for key in found if not self._expiry.expired(key))
+            if found:
+                self._commit({'op': 'del', 'k': found})
+        return count
+
+    def series_append(self, key: str, data: bytes, itemsize: int,
+                      max_len: int) -> None:
+        rec = {'op': 'sappend', 'k': key,
+               'v': base64.b64encode(data).decode('ascii'),
+               'm': max_len * itemsize}
+        with self._cond:
+            if self._expiry.expired(key):
+                # Start a new series instead of extending the expired one
+                self._commit({'op': 'del', 'k': [key]}, rec)
+            else:
+                self._commit(rec)
+
+    def series_range(self, key: str, from_idx: int, to_idx: int,
+                     itemsize: int, max_len: int) -> bytes:
+        with self._cond:
+            buf = self._series.get(key)
+            if buf is None or self._expiry.expired(key):
+                return b''
+            return bytes(_series_slice(memoryview(buf), from_idx, to_idx,
+                                       itemsize, max_len))
+
+    def series_len(self, key: str, itemsize: int, max_len: int) -> int:
+        buf = self._series.get(key)
+        if buf is None or self._expiry.expired(key):
+            return 0
+        return min(len(buf) // itemsize, max_len)
+
+    def sync(self) -> None:
+        """sync.
+        Every write is durable once its call returns, so there is nothing
+        left to wait for beyond the writes of other threads in flight.
+        """
+        with self._cond:
+            seq = self._queued_seq
+            while self._committed_seq < seq and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+
+    def close(self) -> None:
+        """close.
+        Commit pending writes and close the log, compacting it if due.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        if self._compactor is not None:
+            self._compactor.join()
+        if self._error is None and self._compaction_due():
+            self._tail = []
+            self._compact(self._snapshot())
+        self._fd.close()
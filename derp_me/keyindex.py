@@ -0,0 +1,241 @@
+"""Sorted key index of memories without native key scanning."""
+
+import re
+from bisect import bisect_left, bisect_right, insort
+from functools import lru_cache
+
+
+def literal_prefix(pattern: str) -> str:
+    """literal_prefix.
+    The part of a glob pattern before its first special character, which
+    every matching key starts with. Escaped characters are unescaped.
+    """
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\' and i + 1 < len(pattern):
+            prefix.append(pattern[i + 1])
+            i += 2
+            continue
+        if ch in '*?[':
+            break
+        prefix.append(ch)
+        i += 1
+    return ''.join(prefix)
+
+
+def escape_glob(text: str) -> str:
+    """escape_glob.
+    Escape the special characters of a Redis glob pattern.
+    """
+    return ''.join('\\' + ch if ch in '*?[]\\' else ch for ch in text)
+
+
+@lru_cache(maxsize=256)
+def _glob_regex(pattern: str):
+    """_glob_regex.
+    Translate a Redis glob pattern to a regular expression. Unlike fnmatch,
+    Redis escapes with backslashes, negates classes with [^...], and sorts
+    the bounds of reversed ranges.
+    """
+    out = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        ch = pattern[i]
+        i += 1
+        if ch == '*':
+            out.append('.*')
+        elif ch == '?':
+            out.append('.')
+        elif ch == '\\' and i < n:
+            out.append(re.escape(pattern[i]))
+            i += 1
+        elif ch == '[':
+            negate = i < n and pattern[i] == '^'
+            if negate:
+                i += 1
+            items = []
+            # An unterminated class runs to the end of the pattern
+            while i < n and pattern[i] != ']':
+                if pattern[i] == '\\' and i + 1 < n:
+                    items.append(re.escape(pattern[i + 1]))
+                    i += 2
+                elif i + 2 < n and pattern[i + 1] == '-':
+                    lo, hi = sorted((pattern[i], pattern[i + 2]))
+                    items.append(re.escape(lo) + '-' + re.escape(hi))
+                    i += 3
+                else:
+                    items.append(re.escape(pattern[i]))
+                    i += 1
+            i += 1
+            if items:
+                out.append('[{}{}]'.format('^' if negate else '',
+                                           ''.join(items)))
+            else:
+                # [] matches nothing, [^] any character
+                out.append('.' if negate else '(?!)')
+        else:
+            out.append(re.escape(ch))
+    return re.compile(''.join(out) + r'\Z', re.DOTALL)
+
+
+def glob_match(pattern: str, key: str) -> bool:
+    """glob_match.
+    Whether key matches a glob pattern, with the semantics of Redis SCAN
+    MATCH and PSUBSCRIBE.
+    """
+    return _glob_regex(pattern).match(key) is not None
+
+
+class KeyIndex(object):
+    """KeyIndex.
+    The keys of a memory in sorted order, so that the keys under a prefix
+    are a contiguous range found by bisection. Scans only visit the range
+    of the literal prefix of their pattern.
+    Keys are kept in sorted chunks of at most CHUNK_SIZE keys, located by
+    bisecting the last key of each chunk, so that inserts and deletes only
+    shift the keys of one chunk.
+
+    Cursors are the last key visited by the previous scan, so inserts and
+    deletes between two scans do not make them skip keys. Like in Redis,
+    0 starts a scan and is returned once it is complete.
+    """
+
+    # Chunks growing past this size are split in two
+    CHUNK_SIZE = 512
+
+    def __init__(self):
+        self._chunks = []
+        # Last key of each chunk
+        self._maxes = []
+        self._members = set()
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, key):
+        return key in self._members
+
+    def add(self, key: str) -> None:
+        if key in self._members:
+            return
+        self._members.add(key)
+        maxes = self._maxes
+        if not maxes:
+            self._chunks.append([key])
+            maxes.append(key)
+            return
+        i = bisect_left(maxes, key)
+        if i == len(maxes):
+            i -= 1
+            chunk = self._chunks[i]
+            chunk.append(key)
+            maxes[i] = key
+        else:
+            chunk = self._chunks[i]
+            insort(chunk, key)
+        if len(chunk) > self.CHUNK_SIZE:
+            half = len(chunk) // 2
+            self._chunks.insert(i + 1, chunk[half:])
+            del chunk[half:]
+            maxes.insert(i, chunk[-1])
+
+    def discard(self, key: str) -> None:
+        if key not in self._members:
+            return
+        self._members.remove(key)
+        i = bisect_left(self._maxes, key)
+        chunk = self._chunks[i]
+        del chunk[bisect_left(chunk, key)]
+        if not chunk:
+            del self._chunks[i]
+            del self._maxes[i]
+        elif self._maxes[i] == key:
+            self._maxes[i] = chunk[-1]
+
+    def update(self, keys) -> None:
+        """update.
+        Add many keys at once, sorting the index a single time.
+        """
+        self._members.update(keys)
+        keys = sorted(self._members)
+        # Half full chunks leave room for inserts
+        size = self.CHUNK_SIZE // 2
+        self._chunks = [keys[i:i + size] for i in range(0, len(keys), size)]
+        self._maxes = [chunk[-1] for chunk in self._chunks]
+
+    def clear(self) -> None:
+        self._chunks = []
+        self._maxes = []
+        self._members.clear()
+
+    def _iter(self, start: str, after: bool = False):
+        """_iter.
+        Iterate over the keys from start, or after it, in order.
+        """
+        _bisect = bisect_right if after else bisect_left
+        chunks = self._chunks
+        i = _bisect(self._maxes, start)
+        if i == len(chunks):
+            return
+        j = _bisect(chunks[i], start)
+        while i < len(chunks):
+            chunk = chunks[i]
+            while j < len(chunk):
+                yield chunk[j]
+                j += 1
+            i += 1
+            j = 0
+
+    def scan(self, cursor=0, match: str = None, count: int = 100) -> tuple:
+        """scan.
+        Visit up to count keys after the cursor and return the next cursor
+        and the visited keys matching the pattern.
+
+        Args:
+            cursor: 0 or the cursor returned by the previous scan
+            match (str): Glob pattern of the returned keys
+            count (int): Max number of keys visited
+        """
+        prefix = literal_prefix(match) if match else ''
+        if cursor and cursor >= prefix:
+            keys = self._iter(cursor, after=True)
+        else:
+            keys = self._iter(prefix)
+        regex = _glob_regex(match) if match else None
+        found = []
+        visited = 0
+        for key in keys:
+            if not key.startswith(prefix):
+                return 0, found
+            if regex is None or regex.match(key):
+                found.append(key)
+            visited += 1
+            if visited >= count:
+                break
+        else:
+            return 0, found
+        nxt = next(keys, None)
+        if nxt is None or not nxt.startswith(prefix):
+            return 0, found
+        return key, found
+
+    def prefix(self, prefix: str, limit: int = None, skip=None) -> list:
+        """prefix.
+        Returns the keys starting with prefix, in order, up to limit.
+
+        Args:
+            prefix (str): Key prefix
+            limit (int): Max number of keys returned
+            skip: Predicate of keys left out of the result
+        """
+        found = []
+        for key in self._iter(prefix):
+            if not key.startswith(prefix) or \
+                    (limit is not None and len(found) >= limit):
+                break
+            if skip is None or not skip(key):
+                found.append(key)
+        return found
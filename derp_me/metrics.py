@@ -0,0 +1,157 @@
+"""Runtime metrics."""
+
+import threading
+from bisect import bisect_left
+
+
+# Latency buckets in seconds, from 10us to 10s
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class Counter(object):
+    """Counter.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Histogram(object):
+    """Histogram.
+    Fixed-bucket histogram. Recording a value is a bisect over the bucket
+    bounds and a few increments, so it is cheap enough to stay on in
+    production. Quantiles are estimated from the bucket counts.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # Last slot counts values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """quantile.
+        Upper bound of the bucket that holds the q-quantile.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                break
+        if idx < len(self.buckets):
+            return self.buckets[idx]
+        return float('inf')
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'p999': self.quantile(0.999)
+        }
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+class MetricsRegistry(object):
+    """MetricsRegistry.
+    Holds labelled counters and histograms, e.g.
+        registry.histogram('derpme_request_seconds',
+                           op='get', tier='runtime', stage='backend')
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, **labels) -> Counter:
+        key = (name, _labels_key(labels))
+        metric = self._counters.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._counters.setdefault(key, Counter())
+        return metric
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = (name, _labels_key(labels))
+        metric = self._histograms.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._histograms.setdefault(key, Histogram())
+        return metric
+
+    def to_dict(self) -> dict:
+        """to_dict.
+        Returns {name: [{'labels': {...}, ...values}]}.
+        """
+        res = {}
+        for (name, labels), metric in list(self._counters.items()):
+            res.setdefault(name, []).append({
+                'labels': dict(labels),
+                'value': metric.value
+            })
+        for (name, labels), metric in list(self._histograms.items()):
+            entry = metric.to_dict()
+            entry['labels'] = dict(labels)
+            res.setdefault(name, []).append(entry)
+        return res
+
+    def to_prometheus(self) -> str:
+        """to_prometheus.
+        Render the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name in sorted({n for n, _ in self._counters}):
+            lines.append('# TYPE {} counter'.format(name))
+            for (n, labels), metric in sorted(self._counters.items()):
+                if n == name:
+                    lines.append('{}{} {}'.format(
+                        name, _format_labels(labels), metric.value))
+        for name in sorted({n for n, _ in self._histograms}):
+            lines.append('# TYPE {} histogram'.format(name))
+            for (n, labels), metric in sorted(self._histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf',),
+                                        metric.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(labels + (('le', bound),)),
+                        cumulative))
+                lines.append('{}_sum{} {}'.format(
+                    name, _format_labels(labels), metric.sum))
+                lines.append('{}_count{} {}'.format(
+                    name, _format_labels(labels), metric.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
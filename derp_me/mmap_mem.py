@@ -0,0 +1,714 @@
+"""Memory-mapped persistent memory."""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import deque
+from hashlib import blake2b
+
+from .derp_me import (
+    PersistentMemory, PersistenceScheduler, _lrange, _series_slice
+)
+from .expiry import ExpiryIndex
+from .keyindex import KeyIndex
+
+
+MAGIC = b'DERPMMAP'
+VERSION = 2
+# Files of version 1 have no count of deadline records, it is computed
+# once their deadlines are loaded
+_VERSIONS = (1, 2)
+
+# magic, version, nbuckets, data_start, data_end, count, live_bytes,
+# deadline records
+_HEADER = struct.Struct('<8sIQQQQQQ')
+HEADER_SIZE = 64
+# key hash, record offset (0 marks an empty slot)
+_SLOT = struct.Struct('<QQ')
+# key length, value length, kind
+_RECORD = struct.Struct('<IIB')
+
+KIND_VAL = 0
+KIND_LIST = 1
+# Deadline of the key the record key is derived from (see _ttl_key)
+KIND_TTL = 2
+# Tombstone of a deleted key
+KIND_DEL = 3
+# Chunk of a typed series (see series_append)
+KIND_SERIES = 4
+
+# Offset of the previous chunk of the series (0 if none), and number of
+# data bytes in this chunk and all the previous ones
+_CHUNK = struct.Struct('<QQ')
+
+_TTL_SUFFIX = '\x00ttl'
+
+
+def _hash(key: bytes) -> int:
+    return int.from_bytes(blake2b(key, digest_size=8).digest(), 'little')
+
+
+def _ttl_key(key: str) -> str:
+    return key + _TTL_SUFFIX
+
+
+class MmapPersistentMem(PersistentMemory):
+    """MmapPersistentMem.
+    Persistent memory stored in a single memory-mapped file. The file holds
+    a header, an open-addressing hash index and an append-only data region:
+
+        | header | nbuckets x (hash, offset) | records ... |
+
+    Reads resolve the key through the on-disk index and decode only the
+    requested value straight out of the mapping, so opening a store is
+    constant-time and touches only the pages that are actually read.
+    Updates append a new record, which supersedes the previous one. The dead
+    records are dropped when the index is grown, or once live records take
+    less than `compact_ratio` of the data region (past `compact_min_size`
+    bytes).
+    Dirty pages are msync'ed by a PersistenceScheduler, or immediately
+    through sync(). To survive a crash at any point, the index slots and the
+    header are only repointed at new records once these are msync'ed: until
+    then, the slots of the keys written since the last msync are kept in
+    memory, and the file still describes the previous, consistent state.
+    The deadline of a key with a time to live is stored in a record of its
+    own. Expired keys are hidden from reads and deleted, with tombstone
+    records, by expire_due(). The deadlines and the sorted key index that
+    need every record, for expire_due() and scans, are built by the first
+    call that needs them, LOAD_STEP index slots at a time so that requests
+    are served in between; writes keep them up to date meanwhile. Until
+    they are complete, reads look up the deadline record of their key. The
+    header counts the deadline records, so that expire_due() returns
+    without loading anything from a store without any.
+    Typed series are stored as a chain of chunk records, the newest one
+    being the current record of the key, so an append writes only the new
+    samples. Like the carries of a binary counter, an append merges the
+    newest chunks that are not larger than the new one, which keeps chains
+    short; once a chain holds twice its max bytes, it is trimmed to a
+    single chunk.
+    """
+
+    # Index slots visited per step of the load of the deadlines and keys,
+    # under the lock
+    LOAD_STEP = 1024
+
+    def __init__(self,
+                 path: str = 'derpme.mmap',
+                 nbuckets: int = 1024,
+                 max_load: float = 0.7,
+                 snapshot_interval: float = 1.0,
+                 snapshot_max_dirty: int = 100,
+                 compact_ratio: float = 0.5,
+                 compact_min_size: int = 1024 * 1024,
+                 *args, **kwargs):
+        """__init__.
+
+        Args:
+            path (str): Path of the data file
+            nbuckets (int): Initial number of index slots (power of two)
+            max_load (float): Index load factor that triggers a resize
+            snapshot_interval (float): Minimum seconds between two msyncs
+            snapshot_max_dirty (int): Number of writes that forces a msync
+            compact_ratio (float): Share of live bytes in the data region
+                below which it is compacted
+            compact_min_size (int): Size in bytes of the data region below
+                which it is never compacted
+        """
+        super(MmapPersistentMem, self).__init__(*args, **kwargs)
+        if nbuckets & (nbuckets - 1):
+            raise ValueError('nbuckets must be a power of two')
+        self.path = path
+        self.max_load = max_load
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self._lock = threading.RLock()
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            self._create(path, nbuckets)
+        self._open(path)
+        # Completed by _load(), kept up to date by writes meanwhile
+        self._expiry = ExpiryIndex()
+        self._index = KeyIndex()
+        self._loaded = False
+        # Next index slot visited by _load_step()
+        self._load_pos = 0
+        self._scheduler = PersistenceScheduler(
+            self._msync,
+            interval=snapshot_interval,
+            max_dirty=snapshot_max_dirty
+        )
+        self._scheduler.start()
+
+    @staticmethod
+    def _create(path: str, nbuckets: int) -> None:
+        data_start = HEADER_SIZE + nbuckets * _SLOT.size
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, nbuckets, data_start,
+                                 data_start, 0, 0, 0))
+            f.truncate(data_start * 2)
+
+    def _open(self, path: str) -> None:
+        self._fd = open(path, 'r+b')
+        self._mm = mmap.mmap(self._fd.fileno(), 0)
+        (magic, version, self._nbuckets, self._data_start,
+         self._data_end, self._count, self._live, self._ttls) = \
+            _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version not in _VERSIONS:
+            raise ValueError('{} is not a derp-me data file'.format(path))
+        if version == 1:
+            self._ttls = None
+        # Key -> offset of the records not published in the index yet
+        self._unpublished = {}
+        self._synced_end = self._data_end
+
+    def _load(self) -> None:
+        """_load.
+        Complete the expiry and key indexes, one step at a time.
+        """
+        while not self._load_step():
+            pass
+
+    def _load_step(self) -> bool:
+        """_load_step.
+        Add the current records of the keys of the next LOAD_STEP index
+        slots to the expiry and key indexes. Records written since the
+        store was opened are already in them, and are only added again.
+        Returns whether the indexes are complete.
+        """
+        with self._lock:
+            if self._loaded:
+                return True
+            mm = self._mm
+            end = min(self._load_pos + self.LOAD_STEP, self._nbuckets)
+            keys = []
+            for i in range(self._load_pos, end):
+                _, off = _SLOT.unpack_from(mm, HEADER_SIZE + i * _SLOT.size)
+                if off == 0:
+                    continue
+                kb = self._record(off)[0]
+                kb, vb, kind = self._record(self._find(kb))
+                if kind == KIND_TTL:
+                    key = kb.decode()[:-len(_TTL_SUFFIX)]
+                    self._expiry.set(key, json.loads(vb))
+                elif kind != KIND_DEL:
+                    # Deadline records are internal, so they are not
+                    # indexed
+                    keys.append(kb.decode())
+            for key in keys:
+                self._index.add(key)
+            self._load_pos = end
+            if end == self._nbuckets:
+                self._loaded = True
+                self._ttls = len(self._expiry)
+            return self._loaded
+
+    def _deadline(self, key: str):
+        if self._loaded:
+            return self._expiry.deadline(key)
+        return self._read(_ttl_key(key), KIND_TTL)
+
+    def _expired(self, key: str) -> bool:
+        deadline = self._deadline(key)
+        return deadline is not None and deadline <= time.time()
+
+    def _clear_ttl(self, key: str) -> bool:
+        """_clear_ttl.
+        Drop the deadline of a key. Returns False if it had none.
+        """
+        if self._deadline(key) is None:
+            return False
+        self._expiry.remove(key)
+        self._delete(_ttl_key(key))
+        return True
+
+    def _close_map(self) -> None:
+        self._mm.close()
+        self._fd.close()
+
+    def _write_header(self) -> None:
+        # Upgraded to the current version once the deadlines are counted
+        version = 1 if self._ttls is None else VERSION
+        _HEADER.pack_into(self._mm, 0, MAGIC, version, self._nbuckets,
+                          self._data_start, self._data_end, self._count,
+                          self._live, self._ttls or 0)
+
+    def _msync(self) -> bool:
+        with self._lock:
+            # The records first, then the header covering them, then the
+            # slots pointing at them
+            self._flush_range(self._synced_end, self._data_end)
+            self._synced_end = self._data_end
+            self._write_header()
+            if self._unpublished:
+                self._flush_range(0, HEADER_SIZE)
+                self._publish()
+            self._flush_range(0, self._data_start)
+        return True
+
+    def _flush_range(self, start: int, end: int) -> None:
+        start -= start % mmap.PAGESIZE
+        if end > start:
+            self._mm.flush(start, end - start)
+
+    def _publish(self) -> None:
+        for kb, off in self._unpublished.items():
+            h = _hash(kb)
+            pos, _ = self._lookup(kb, h)
+            _SLOT.pack_into(self._mm, pos, h, off)
+        self._unpublished.clear()
+
+    def _lookup(self, kb: bytes, h: int):
+        """_lookup.
+        Returns (slot position, record offset). The record offset is 0 if
+        the key is not present, in which case the slot is the free one
+        where it should be inserted.
+        """
+        mm = self._mm
+        mask = self._nbuckets - 1
+        i = h & mask
+        while True:
+            pos = HEADER_SIZE + i * _SLOT.size
+            s_hash, off = _SLOT.unpack_from(mm, pos)
+            if off == 0:
+                return pos, 0
+            if s_hash == h:
+                klen, _, _ = _RECORD.unpack_from(mm, off)
+                kstart = off + _RECORD.size
+                if klen == len(kb) and mm[kstart:kstart + klen] == kb:
+                    return pos, off
+            i = (i + 1) & mask
+
+    def _find(self, kb: bytes) -> int:
+        """_find.
+        Offset of the current record of a key, 0 if there is none.
+        """
+        off = self._unpublished.get(kb)
+        if off is None:
+            _, off = self._lookup(kb, _hash(kb))
+        return off
+
+    def _read(self, key: str, kind: int = None):
+        kb = key.encode()
+        off = self._find(kb)
+        if off == 0:
+            return None
+        klen, vlen, r_kind = _RECORD.unpack_from(self._mm, off)
+        if r_kind == KIND_DEL or (kind is not None and r_kind != kind):
+            return None
+        vstart = off + _RECORD.size + klen
+        return json.loads(self._mm[vstart:vstart + vlen])
+
+    def _ensure_space(self, nbytes: int) -> None:
+        size = len(self._mm)
+        if self._data_end + nbytes <= size:
+            return
+        new_size = max(size * 2, self._data_end + nbytes)
+        self._mm.close()
+        self._fd.truncate(new_size)
+        self._mm = mmap.mmap(self._fd.fileno(), 0)
+
+    def _reserve(self, nbytes: int) -> None:
+        """_reserve.
+        Make room for a new record of at most nbytes. This may rewrite the
+        file, which moves every record.
+        """
+        if (self._count + 1) > self._nbuckets * self.max_load:
+            self._rewrite(self._nbuckets * 2)
+        elif self._compaction_due():
+            self._rewrite(self._nbuckets)
+        self._ensure_space(nbytes)
+
+    def _write(self, key: str, val, kind: int) -> None:
+        kb = key.encode()
+        vb = json.dumps(val).encode()
+        self._reserve(_RECORD.size + len(kb) + len(vb))
+        self._put(key, kb, vb, kind)
+
+    def _put(self, key: str, kb: bytes, vb: bytes, kind: int,
+             dead: int = None) -> None:
+        """_put.
+        Append a record superseding the current one of the key, in space
+        made by _reserve().
+
+        Args:
+            dead (int): Bytes of records no longer reachable once this one
+                is written. All the records of the current value if None
+        """
+        rec_size = _RECORD.size + len(kb) + len(vb)
+        off = self._data_end
+        _RECORD.pack_into(self._mm, off, len(kb), len(vb), kind)
+        kstart = off + _RECORD.size
+        self._mm[kstart:kstart + len(kb)] = kb
+        self._mm[kstart + len(kb):off + rec_size] = vb
+        old_off = self._find(kb)
+        if old_off == 0:
+            self._count += 1
+        if self._ttls is not None:
+            old_kind = _RECORD.unpack_from(self._mm, old_off)[2] \
+                if old_off else None
+            if kind == KIND_TTL and old_kind != KIND_TTL:
+                self._ttls += 1
+            elif kind != KIND_TTL and old_kind == KIND_TTL:
+                self._ttls -= 1
+        if dead is None:
+            dead = self._record_bytes(old_off) if old_off else 0
+        self._live -= dead
+        # Published by the next msync, once the record is on disk
+        self._unpublished[kb] = off
+        self._data_end += rec_size
+        self._live += rec_size
+        if kind != KIND_TTL:
+            if kind == KIND_DEL:
+                self._index.discard(key)
+            else:
+                self._index.add(key)
+
+    def _compaction_due(self) -> bool:
+        used = self._data_end - self._data_start
+        return used >= self.compact_min_size and \
+            self._live < used * self.compact_ratio
+
+    def _record_bytes(self, off: int) -> int:
+        """_record_bytes.
+        Size of the record at off, with the previous chunks of a series.
+        """
+        size = 0
+        while off:
+            klen, vlen, kind = _RECORD.unpack_from(self._mm, off)
+            size += _RECORD.size + klen + vlen
+            off = self._chunk(off)[0] if kind == KIND_SERIES else 0
+        return size
+
+    def _chunk(self, off: int) -> tuple:
+        """_chunk.
+        Returns (previous chunk offset, chain bytes, data) of a series
+        chunk record.
+        """
+        klen, vlen, _ = _RECORD.unpack_from(self._mm, off)
+        vstart = off + _RECORD.size + klen
+        prev, chain = _CHUNK.unpack_from(self._mm, vstart)
+        return prev, chain, self._mm[vstart + _CHUNK.size:vstart + vlen]
+
+    def _series_data(self, off: int, limit: int) -> bytes:
+        """_series_data.
+        The newest limit data bytes of the chain of chunks ending at off,
+        oldest first.
+        """
+        parts = []
+        size = 0
+        while off and size < limit:
+            off, _, data = self._chunk(off)
+            parts.append(data)
+            size += len(data)
+        parts.reverse()
+        data = b''.join(parts)
+        return data[len(data) - min(limit, len(data)):]
+
+    def _series_head(self, kb: bytes) -> int:
+        """_series_head.
+        Offset of the newest chunk of a series, 0 if the key holds none.
+        """
+        off = self._find(kb)
+        if off and _RECORD.unpack_from(self._mm, off)[2] == KIND_SERIES:
+            return off
+        return 0
+
+    def _record(self, off: int) -> tuple:
+        mm = self._mm
+        klen, vlen, kind = _RECORD.unpack_from(mm, off)
+        kstart = off + _RECORD.size
+        return (mm[kstart:kstart + klen],
+                mm[kstart + klen:kstart + klen + vlen],
+                kind)
+
+    def _iter_records(self):
+        pending = dict(self._unpublished)
+        for i in range(self._nbuckets):
+            _, off = _SLOT.unpack_from(self._mm, HEADER_SIZE + i * _SLOT.size)
+            if off == 0:
+                continue
+            record = self._record(off)
+            if record[0] in pending:
+                record = self._record(pending.pop(record[0]))
+            yield record
+        for off in pending.values():
+            yield self._record(off)
+
+    def _rewrite(self, nbuckets: int) -> None:
+        """_rewrite.
+        Copy the live records into a fresh file with `nbuckets` index
+        slots and atomically swap it in.
+        """
+        tmp_path = self.path + '.rewrite'
+        self._create(tmp_path, nbuckets)
+        dst = MmapPersistentMem.__new__(MmapPersistentMem)
+        dst.path = tmp_path
+        dst.max_load = self.max_load
+        dst._open(tmp_path)
+        dst._ensure_space(self._live)
+        for kb, vb, kind in self._iter_records():
+            if kind == KIND_DEL:
+                continue
+            if kind == KIND_SERIES:
+                # Merge the chain into a single chunk
+                prev, chain = _CHUNK.unpack_from(vb)
+                vb = _CHUNK.pack(0, chain) + \
+                    self._series_data(prev, chain) + vb[_CHUNK.size:]
+            rec_size = _RECORD.size + len(kb) + len(vb)
+            off = dst._data_end
+            _RECORD.pack_into(dst._mm, off, len(kb), len(vb), kind)
+            kstart = off + _RECORD.size
+            dst._mm[kstart:kstart + len(kb)] = kb
+            dst._mm[kstart + len(kb):off + rec_size] = vb
+            h = _hash(kb)
+            pos, _ = dst._lookup(kb, h)
+            _SLOT.pack_into(dst._mm, pos, h, off)
+            dst._data_end += rec_size
+            dst._count += 1
+            dst._live += rec_size
+            if kind == KIND_TTL:
+                dst._ttls += 1
+        dst._write_header()
+        dst._mm.flush()
+        dst._close_map()
+        self._close_map()
+        os.replace(tmp_path, self.path)
+        self._open(self.path)
+        # The slots moved, the load starts over
+        self._load_pos = 0
+
+    def compact(self) -> None:
+        """compact.
+        Reclaim the space of overwritten records.
+        """
+        with self._lock:
+            self._rewrite(self._nbuckets)
+
+    def _exists(self, key: str) -> bool:
+        kb = key.encode()
+        off = self._find(kb)
+        if off == 0 or self._expired(key):
+            return False
+        return _RECORD.unpack_from(self._mm, off)[2] != KIND_DEL
+
+    def _delete(self, key: str) -> None:
+        kb = key.encode()
+        off = self._find(kb)
+        if off != 0 and _RECORD.unpack_from(self._mm, off)[2] != KIND_DEL:
+            self._write(key, None, KIND_DEL)
+
+    def _set_ttl(self, key: str, ttl: float) -> None:
+        if ttl is not None:
+            deadline = time.time() + ttl
+            self._write(_ttl_key(key), deadline, KIND_TTL)
+            self._expiry.set(key, deadline)
+        else:
+            self._clear_ttl(key)
+
+    def set(self, key: str, val: str, ttl: float = None) -> None:
+        with self._lock:
+            self._write(key, val, KIND_VAL)
+            self._set_ttl(key, ttl)
+        self._scheduler.mark_dirty()
+
+    def get(self, key: str):
+        with self._lock:
+            if self._expired(key):
+                return None
+            return self._read(key, KIND_VAL)
+
+    def mset(self, keys: list, vals: list, ttl: float = None) -> None:
+        with self._lock:
+            for i in range(len(keys)):
+                self._write(keys[i], vals[i], KIND_VAL)
+                self._set_ttl(keys[i], ttl)
+        self._scheduler.mark_dirty(len(keys))
+
+    def mget(self, keys: list):
+        with self._lock:
+            expired = self._expired
+            return [None if expired(key) else self._read(key, KIND_VAL)
+                    for key in keys]
+
+    def lset(self, key: str, vals: list, ttl: float = None) -> None:
+        with self._lock:
+            if self._expired(key):
+                _list = None
+                self._clear_ttl(key)
+            else:
+                _list = self._read(key, KIND_LIST)
+            if _list is None and ttl is None:
+                # A new list does not inherit the deadline of a value
+                self._clear_ttl(key)
+            _list = deque(_list or [], maxlen=self.list_size)
+            _list.extendleft(vals)
+            self._write(key, list(_list), KIND_LIST)
+            if ttl is not None:
+                self._set_ttl(key, ttl)
+        self._scheduler.mark_dirty()
+
+    def lget(self, key: str, from_idx: int, to_idx: int) -> list:
+        with self._lock:
+            if self._expired(key):
+                return []
+            _list = self._read(key, KIND_LIST)
+        if _list is None:
+            return []
+        return _lrange(_list, -1 * from_idx, -1 * to_idx)
+
+    def llen(self, key: str) -> int:
+        with self._lock:
+            if self._expired(key):
+                return 0
+            _list = self._read(key, KIND_LIST)
+        return 0 if _list is None else len(_list)
+
+    def series_append(self, key: str, data: bytes, itemsize: int,
+                      max_len: int) -> None:
+        max_bytes = max_len * itemsize
+        kb = key.encode()
+        with self._lock:
+            if self._expired(key):
+                # Start a new series instead of extending the expired one
+                self._clear_ttl(key)
+                self._delete(key)
+            head = self._series_head(kb)
+            chain = self._chunk(head)[1] if head else 0
+            self._reserve(_RECORD.size + len(kb) + _CHUNK.size + len(data) +
+                          chain)
+            # The chunks may have moved
+            head = self._series_head(kb)
+            old_off = self._find(kb)
+            dead = self._record_bytes(old_off) if old_off and not head else 0
+            while head:
+                prev, _, chunk = self._chunk(head)
+                if len(chunk) > len(data):
+                    break
+                data = chunk + data
+                klen, vlen, _ = _RECORD.unpack_from(self._mm, head)
+                dead += _RECORD.size + klen + vlen
+                head = prev
+            chain = len(data) + (self._chunk(head)[1] if head else 0)
+            if chain - max_bytes > max_bytes:
+                data = (self._series_data(head, max_bytes) + data)[-max_bytes:]
+                dead += self._record_bytes(head)
+                head = 0
+                chain = len(data)
+            self._put(key, kb, _CHUNK.pack(head, chain) + data, KIND_SERIES,
+                      dead)
+        self._scheduler.mark_dirty()
+
+    def series_range(self, key: str, from_idx: int, to_idx: int,
+                     itemsize: int, max_len: int) -> bytes:
+        with self._lock:
+            if self._expired(key):
+                return b''
+            head = self._series_head(key.encode())
+            if not head:
+                return b''
+            chain = self._chunk(head)[1]
+            buf = self._series_data(head, min(chain, max_len * itemsize))
+        return bytes(_series_slice(buf, from_idx, to_idx, itemsize, max_len))
+
+    def series_len(self, key: str, itemsize: int, max_len: int) -> int:
+        with self._lock:
+            if self._expired(key):
+                return 0
+            head = self._series_head(key.encode())
+            if not head:
+                return 0
+            return min(self._chunk(head)[1] // itemsize, max_len)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._mm[HEADER_SIZE:self._data_start] = \
+                bytes(self._data_start - HEADER_SIZE)
+            # No slot may point past the data end of the header
+            self._mm.flush()
+            self._data_end = self._data_start
+            self._synced_end = self._data_start
+            self._count = 0
+            self._live = 0
+            self._ttls = 0
+            self._unpublished.clear()
+            self._write_header()
+            self._expiry = ExpiryIndex()
+            self._index = KeyIndex()
+            self._loaded = True
+        self._scheduler.mark_dirty()
+
+    def scan(self, cursor=0, match: str = None, count: int = 100) -> tuple:
+        self._load()
+        with self._lock:
+            cursor, keys = self._index.scan(cursor, match, count)
+            return cursor, [key for key in keys
+                            if not self._expiry.expired(key)]
+
+    def scan_prefix(self, prefix: str, limit: int) -> list:
+        self._load()
+        with self._lock:
+            return self._index.prefix(prefix, limit, self._expiry.expired)
+
+    def expire(self, key: str, ttl: float) -> bool:
+        with self._lock:
+            if not self._exists(key):
+                return False
+            self._set_ttl(key, ttl)
+        self._scheduler.mark_dirty()
+        return True
+
+    def ttl(self, key: str) -> float:
+        with self._lock:
+            if not self._exists(key):
+                return -2
+            deadline = self._deadline(key)
+            if deadline is None:
+                return -1
+            return max(deadline - time.time(), 0.0)
+
+    def persist(self, key: str) -> bool:
+        with self._lock:
+            if not self._exists(key) or self._deadline(key) is None:
+                return False
+            self._set_ttl(key, None)
+        self._scheduler.mark_dirty()
+        return True
+
+    def expire_due(self, limit: int = None) -> list:
+        if self._ttls == 0:
+            # No deadline in the store
+            return []
+        self._load()
+        with self._lock:
+            keys = self._expiry.pop_expired(limit=limit)
+            for key in keys:
+                self._delete(key)
+                self._delete(_ttl_key(key))
+        if keys:
+            self._scheduler.mark_dirty(len(keys))
+        return keys
+
+    def delete(self, keys: list) -> int:
+        count = 0
+        with self._lock:
+            for key in keys:
+                if self._exists(key):
+                    count += 1
+                self._delete(key)
+                self._clear_ttl(key)
+        if count:
+            self._scheduler.mark_dirty(count)
+        return count
+
+    def sync(self) -> None:
+        dirty = self._scheduler.dirty
+        self._msync()
+        self._scheduler.reset(dirty)
+
+    def close(self) -> None:
+        self._scheduler.stop()
+        with self._lock:
+            self._msync()
+            self._close_map()
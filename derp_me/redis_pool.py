@@ -0,0 +1,157 @@
+"""Shared Redis connection pools."""
+
+import configparser
+import os
+import threading
+
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'config.ini')
+
+# setting -> (environment variable, type)
+_SETTINGS = {
+    'host': ('DERPME_REDIS_HOST', str),
+    'port': ('DERPME_REDIS_PORT', int),
+    'password': ('DERPME_REDIS_PASSWORD', str),
+    'unix_socket': ('DERPME_REDIS_SOCKET', str),
+    'max_connections': ('DERPME_REDIS_MAX_CONNECTIONS', int),
+    'timeout': ('DERPME_REDIS_POOL_TIMEOUT', float),
+    'database_runtime': ('DERPME_REDIS_RUNTIME_DB', int),
+    'database_persistent': ('DERPME_REDIS_PERSISTENT_DB', int)
+}
+
+
+def import_redis():
+    """import_redis.
+    Import the redis module on first use, so that servers without Redis
+    memories do not pay for it at startup.
+    """
+    import redis
+    return redis
+
+
+def load_redis_settings(path: str = None, env: dict = None) -> dict:
+    """load_redis_settings.
+    Read the Redis connection settings from the [redis] section of a
+    config file, overridden by DERPME_REDIS_* environment variables.
+    Empty values are ignored.
+
+    Args:
+        path (str): Config file. Defaults to $DERPME_CONFIG, or the
+            config.ini of the package
+        env (dict): Environment, defaults to os.environ
+    """
+    env = os.environ if env is None else env
+    path = path or env.get('DERPME_CONFIG') or DEFAULT_CONFIG
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    section = parser['redis'] if parser.has_section('redis') else {}
+    settings = {}
+    for name, (var, _type) in _SETTINGS.items():
+        val = env.get(var) or section.get(name)
+        if val:
+            settings[name] = _type(val)
+    return settings
+
+
+class RedisPool(object):
+    """RedisPool.
+    Blocking connection pools shared by the Redis memories, one per
+    database and response decoding, each holding up to max_connections
+    connections. Callers beyond that wait up to timeout seconds for a free
+    connection instead of opening new ones. With unix_socket set, Redis is
+    reached through a unix-domain socket instead of TCP.
+    """
+
+    def __init__(self,
+                 host: str = 'localhost',
+                 port: int = 6379,
+                 password: str = None,
+                 unix_socket: str = None,
+                 max_connections: int = 16,
+                 timeout: float = 5.0,
+                 **kwargs):
+        """__init__.
+
+        Args:
+            host (str): Redis host
+            port (int): Redis port
+            password (str): Redis password
+            unix_socket (str): Path of the Redis unix-domain socket
+            max_connections (int): Max connections per pool
+            timeout (float): Seconds to wait for a free connection
+            kwargs: Other settings (see load_redis_settings), ignored
+        """
+        self.host = host
+        self.port = port
+        self.password = password
+        self.unix_socket = unix_socket
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _create_pool(self, db: int, decode_responses: bool):
+        redis = import_redis()
+        if self.unix_socket:
+            conn = {
+                'connection_class': redis.UnixDomainSocketConnection,
+                'path': self.unix_socket
+            }
+        else:
+            conn = {
+                'host': self.host,
+                'port': self.port
+            }
+        return redis.BlockingConnectionPool(
+            db=db,
+            password=self.password or None,
+            decode_responses=decode_responses,
+            max_connections=self.max_connections,
+            timeout=self.timeout,
+            **conn
+        )
+
+    def pool(self, db: int, decode_responses: bool = False):
+        key = (db, decode_responses)
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = self._create_pool(db, decode_responses)
+                    self._pools[key] = pool
+        return pool
+
+    def client(self, db: int, decode_responses: bool = False):
+        """client.
+        Returns a Redis client of a database, backed by the shared pool.
+        """
+        return import_redis().Redis(
+            connection_pool=self.pool(db, decode_responses))
+
+    def stats(self) -> dict:
+        """stats.
+        Returns the connections created, idle and in use per pool.
+        """
+        res = {
+            'endpoint': self.unix_socket or '{}:{}'.format(self.host,
+                                                           self.port),
+            'max_connections': self.max_connections,
+            'pools': {}
+        }
+        for (db, decode), pool in list(self._pools.items()):
+            created = len(getattr(pool, '_connections', ()))
+            queue = getattr(pool, 'pool', None)
+            idle = 0 if queue is None else \
+                sum(1 for conn in list(queue.queue) if conn is not None)
+            res['pools']['db{}{}'.format(db, '' if decode else '.raw')] = {
+                'created': created,
+                'idle': idle,
+                'in_use': created - idle
+            }
+        return res
+
+    def disconnect(self) -> None:
+        for pool in list(self._pools.values()):
+            pool.disconnect()
@@ -0,0 +1,653 @@
+"""Replication of the persistent memory to read-only followers."""
+
+import base64
+import json
+import queue
+import threading
+import uuid
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+
+from commlib.logger import Logger
+
+from .derp_me import Memory
+from .snapshot import clear, read_records, record_ops
+
+
+class ReadOnlyError(Exception):
+    """ReadOnlyError.
+    Raised by writes to the persistent memory of a replica.
+    """
+
+
+# Memory methods that modify it
+WRITE_OPS = ('set', 'mset', 'lset', 'delete', 'expire', 'persist',
+             'series_append', 'flush')
+
+
+def encode_entries(entries: list, level: int = 1) -> str:
+    """encode_entries.
+    Entries as a zlib-compressed JSON array, base64 encoded.
+    """
+    data = json.dumps(entries, separators=(',', ':')).encode()
+    return base64.b64encode(zlib.compress(data, level)).decode()
+
+
+def decode_entries(data: str) -> list:
+    return json.loads(zlib.decompress(base64.b64decode(data)))
+
+
+def op_keys(name: str, args) -> list:
+    """op_keys.
+    The keys written by an operation, or None for all of them (flush).
+    """
+    if name == 'flush':
+        return None
+    if name in ('mset', 'delete'):
+        return list(args[0])
+    return [args[0]]
+
+
+def apply_entry(mem: Memory, name: str, args: list) -> None:
+    """apply_entry.
+    Apply a write of the replication log to a memory.
+    """
+    if name not in WRITE_OPS:
+        raise ValueError('Unsupported operation <{}>'.format(name))
+    if name == 'series_append':
+        args = [args[0], base64.b64decode(args[1])] + list(args[2:])
+    getattr(mem, name)(*args)
+
+
+class ReplicationLog(object):
+    """ReplicationLog.
+    Ordered log of the writes of the persistent memory. Every write gets
+    the next offset and is kept in a backlog of max_entries, from which
+    followers catch up. The write path only appends to the backlog: new
+    entries are published by a background thread every interval seconds,
+    in batches of up to max_batch entries, each batch compressed with zlib.
+
+    Offsets are only meaningful within an epoch, a random id of the log,
+    which changes when the primary restarts, or when the log is reset
+    because it cannot describe the writes that were applied.
+    """
+
+    def __init__(self, publish, max_entries: int = 100000,
+                 interval: float = 0.05, max_batch: int = 1000,
+                 level: int = 1, logger=None):
+        """__init__.
+
+        Args:
+            publish: Called with each batch message
+            max_entries (int): Entries kept for catch-up
+            interval (float): Seconds between two publishing rounds
+            max_batch (int): Max entries per published batch
+            level (int): zlib compression level
+            logger: Logger of the publishing errors
+        """
+        self._publish = publish
+        self.interval = interval
+        self.max_batch = max_batch
+        self.level = level
+        self.logger = logger if logger is not None else \
+            Logger(namespace=self.__class__.__name__)
+        self.epoch = uuid.uuid4().hex
+        self._entries = deque(maxlen=max_entries)
+        self._next = 0
+        self._published = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.batches = 0
+
+    @property
+    def next_offset(self) -> int:
+        return self._next
+
+    def _first(self) -> int:
+        return self._entries[0][0] if self._entries else self._next
+
+    def append(self, name: str, args: list) -> None:
+        with self._lock:
+            self._entries.append((self._next, name, args))
+            self._next += 1
+
+    def reset(self) -> None:
+        """reset.
+        Start a new epoch with an empty log, so that followers resync.
+        """
+        with self._lock:
+            self.epoch = uuid.uuid4().hex
+            self._entries.clear()
+            self._next = 0
+            self._published = 0
+
+    def read(self, offset: int, limit: int):
+        """read.
+        Returns up to limit entries from offset on, or None if offset is
+        not in the backlog anymore.
+        """
+        with self._lock:
+            first = self._first()
+            if offset < first or offset > self._next:
+                return None
+            start = offset - first
+            return [list(e) for e in
+                    islice(self._entries, start, start + limit)]
+
+    def publish_pending(self) -> int:
+        """publish_pending.
+        Publish the entries appended since the last round. Returns the
+        number of batches sent.
+        """
+        with self._lock:
+            if self._published >= self._next:
+                return 0
+            first = self._first()
+            # Entries dropped before being published are caught up
+            start = max(self._published, first)
+            entries = [list(e) for e in
+                       islice(self._entries, start - first, None)]
+            self._published = self._next
+        sent = 0
+        for i in range(0, len(entries), self.max_batch):
+            batch = entries[i:i + self.max_batch]
+            try:
+                self._publish({
+                    'epoch': self.epoch,
+                    'first': batch[0][0],
+                    'last': batch[-1][0],
+                    'data': encode_entries(batch, self.level)
+                })
+                sent += 1
+            except Exception as exc:
+                self.logger.error('Failed to publish replication batch: '
+                                  '{}'.format(exc))
+        self.batches += sent
+        return sent
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.publish_pending()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.publish_pending()
+
+    def stats(self) -> dict:
+        return {
+            'epoch': self.epoch,
+            'next_offset': self._next,
+            'first_offset': self._first(),
+            'batches': self.batches
+        }
+
+
+class _MemoryWrapper(Memory):
+    """_MemoryWrapper.
+    Forwards every operation to the wrapped memory.
+    """
+
+    def __init__(self, mem: Memory, list_size: int = 10):
+        """__init__.
+
+        Args:
+            mem (Memory): Wrapped memory
+            list_size (int): Max size of the lists of the wrapped memory
+        """
+        super(_MemoryWrapper, self).__init__(list_size=list_size)
+        self._mem = mem
+
+    def __getattr__(self, name):
+        return getattr(self._mem, name)
+
+    def _write(self, name: str, args: tuple):
+        return getattr(self._mem, name)(*args)
+
+    def set(self, key: str, val: str, ttl: float = None) -> None:
+        self._write('set', (key, val, ttl))
+
+    def mset(self, keys: list, vals: list, ttl: float = None) -> None:
+        self._write('mset', (keys, vals, ttl))
+
+    def lset(self, key: str, vals: list, ttl: float = None) -> None:
+        self._write('lset', (key, vals, ttl))
+
+    def flush(self) -> None:
+        self._write('flush', ())
+
+    def delete(self, keys: list) -> int:
+        return self._write('delete', (keys,))
+
+    def expire(self, key: str, ttl: float) -> bool:
+        return self._write('expire', (key, ttl))
+
+    def persist(self, key: str) -> bool:
+        return self._write('persist', (key,))
+
+    def series_append(self, key: str, data: bytes, itemsize: int,
+                      max_len: int) -> None:
+        self._write('series_append', (key, data, itemsize, max_len))
+
+    def get(self, key: str):
+        return self._mem.get(key)
+
+    def mget(self, keys: list):
+        return self._mem.mget(keys)
+
+    def lget(self, key: str, from_idx: int, to_idx: int) -> list:
+        return self._mem.lget(key, from_idx, to_idx)
+
+    def llen(self, key: str) -> int:
+        return self._mem.llen(key)
+
+    def llen_range(self, key: str, from_idx: int, to_idx: int) -> tuple:
+        return self._mem.llen_range(key, from_idx, to_idx)
+
+    def ttl(self, key: str) -> float:
+        return self._mem.ttl(key)
+
+    def scan(self, cursor=0, match: str = None, count: int = 100) -> tuple:
+        return self._mem.scan(cursor, match, count)
+
+    def scan_prefix(self, prefix: str, limit: int) -> list:
+        return self._mem.scan_prefix(prefix, limit)
+
+    def expire_due(self, limit: int = None) -> list:
+        return self._mem.expire_due(limit)
+
+    def memory_stats(self) -> dict:
+        return self._mem.memory_stats()
+
+    def execute(self, ops: list) -> list:
+        return self._mem.execute(ops)
+
+    def series_range(self, key: str, from_idx: int, to_idx: int,
+                     itemsize: int, max_len: int) -> bytes:
+        return self._mem.series_range(key, from_idx, to_idx, itemsize,
+                                      max_len)
+
+    def series_len(self, key: str, itemsize: int, max_len: int) -> int:
+        return self._mem.series_len(key, itemsize, max_len)
+
+
+class _KeyLocks(object):
+    """_KeyLocks.
+    Striped locks of keys. Holding the locks of a set of keys orders the
+    writes to them, while writes to other keys go on.
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    @contextmanager
+    def hold(self, keys=None):
+        """hold.
+        Hold the locks of keys, or all of them if keys is None. Locks are
+        taken in order, so that two holders never deadlock.
+        """
+        n = len(self._locks)
+        stripes = range(n) if keys is None else \
+            sorted({hash(key) % n for key in keys})
+        locks = [self._locks[i] for i in stripes]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+
+class ReplicatedMemory(_MemoryWrapper):
+    """ReplicatedMemory.
+    Appends the successful writes of a memory to a ReplicationLog. Batches
+    keep running in a single pipeline and are logged once executed.
+    Keys deleted by active expiration are logged as deletes.
+
+    Each write holds the locks of its keys (see _KeyLocks) while it is
+    applied and logged, so that the log has the order in which the writes
+    of a key were applied, while the writes of other keys, and their I/O,
+    go on concurrently. The log assigns offsets atomically.
+    When a write or batch fails, the log cannot tell which of its writes
+    were applied, so the current state of its keys is logged instead (a
+    delete and the records rewriting them). A failed flush resets the log,
+    making followers resync.
+    """
+
+    def __init__(self, mem: Memory, log: ReplicationLog,
+                 list_size: int = 10):
+        super(ReplicatedMemory, self).__init__(mem, list_size)
+        self.log = log
+        self._locks = _KeyLocks()
+
+    def _write(self, name: str, args: tuple):
+        keys = op_keys(name, args)
+        with self._locks.hold(keys):
+            try:
+                res = getattr(self._mem, name)(*args)
+            except Exception:
+                self._log_state(keys)
+                raise
+            self._log(name, args)
+        return res
+
+    def _log(self, name: str, args: tuple) -> None:
+        if name == 'series_append':
+            args = (args[0], base64.b64encode(args[1]).decode()) + \
+                tuple(args[2:])
+        self.log.append(name, list(args))
+
+    def _log_state(self, keys) -> None:
+        """_log_state.
+        Log the current state of keys, whose locks are held, or reset the
+        log if keys is None or cannot be read.
+        """
+        if keys is not None:
+            keys = list(dict.fromkeys(keys))
+            try:
+                records = read_records(self._mem, keys)
+            except Exception:
+                records = None
+            if records is not None:
+                self.log.append('delete', [keys])
+                for name, args in record_ops(records):
+                    self._log(name, args)
+                return
+        self.log.reset()
+
+    def execute(self, ops: list) -> list:
+        written = [(name, args) for name, args in ops if name in WRITE_OPS]
+        if not written:
+            return self._mem.execute(ops)
+        keys = []
+        for name, args in written:
+            op = op_keys(name, args)
+            if op is None:
+                keys = None
+                break
+            keys.extend(op)
+        with self._locks.hold(keys):
+            try:
+                replies = self._mem.execute(ops)
+            except Exception:
+                self._log_state(keys)
+                raise
+            for name, args in written:
+                self._log(name, args)
+        return replies
+
+    def expire_due(self, limit: int = None) -> list:
+        keys = self._mem.expire_due(limit)
+        if keys:
+            with self._locks.hold(keys):
+                # A key written again since it expired is logged with its
+                # new state, after the delete
+                alive = [key for key, ttl in zip(keys, self._mem.execute(
+                    [('ttl', (key,)) for key in keys])) if ttl != -2]
+                self.log.append('delete', [keys])
+                if alive:
+                    for name, args in record_ops(
+                            read_records(self._mem, alive)):
+                        self._log(name, args)
+        return keys
+
+    def snapshot(self, cursor=0, count: int = 100) -> tuple:
+        """snapshot.
+        One step of a snapshot of the memory: the next cursor, the records
+        (see snapshot.read_records) of about count keys from cursor on, and
+        the offset of the log they were read at. The records include every
+        logged write of their keys before that offset and none after it.
+
+        Args:
+            cursor: 0 or the cursor returned by the previous step
+            count (int): Max number of keys read
+        """
+        cursor, keys = self._mem.scan(cursor, None, count)
+        with self._locks.hold(keys):
+            return cursor, read_records(self._mem, keys), \
+                self.log.next_offset
+
+
+class ReadOnlyMemory(_MemoryWrapper):
+    """ReadOnlyMemory.
+    Serves the reads of a memory and rejects its writes with
+    ReadOnlyError, as the persistent memory of a replica.
+    """
+
+    def _write(self, name: str, args: tuple):
+        raise ReadOnlyError('Persistent memory of a replica is read-only')
+
+    def execute(self, ops: list) -> list:
+        if any(name in WRITE_OPS for name, _ in ops):
+            self._write(None, ())
+        return self._mem.execute(ops)
+
+
+class Follower(object):
+    """Follower.
+    Applies the replication log of a primary to a memory, in order. Batches
+    are received on {namespace}.replication. A batch that does not start
+    at the next expected offset, a new epoch, or poll_interval seconds
+    without batches (e.g. after a reconnect) trigger a catch-up through
+    the {namespace}.replication.fetch RPC. If the expected offset is not
+    in the backlog of the primary anymore, the memory is cleared and
+    resynchronized from a snapshot ({namespace}.replication.snapshot),
+    followed by a catch-up from the offset of the start of the snapshot.
+    Each step of the snapshot is read at a later offset than the previous
+    ones, so until the catch-up reaches the offset of the last step, the
+    entries of keys read at a later offset are skipped: their records
+    already include them, and lset or series_append would be applied twice.
+    An entry that fails to apply triggers a resync. If it fails again
+    after that, it is skipped.
+    """
+
+    def __init__(self, mem: Memory, node, namespace: str,
+                 poll_interval: float = 1.0, fetch_size: int = 1000,
+                 logger=None):
+        """__init__.
+
+        Args:
+            mem (Memory): Memory the log is applied to
+            node: commlib Node
+            namespace (str): Namespace of the primary
+            poll_interval (float): Max seconds between two catch-ups
+            fetch_size (int): Max entries or keys per fetch
+            logger: Logger of the replication errors
+        """
+        self._mem = mem
+        self.logger = logger if logger is not None else \
+            Logger(namespace=self.__class__.__name__)
+        self.namespace = namespace
+        self.poll_interval = poll_interval
+        self.fetch_size = fetch_size
+        self.epoch = None
+        self.offset = 0
+        self.applied = 0
+        self.resyncs = 0
+        # Offset each key of the last snapshot was read at, until the
+        # catch-up reaches _snapshot_end
+        self._snapshot = {}
+        self._snapshot_end = 0
+        # (epoch, offset) of the last entry that failed to apply
+        self._failed = None
+        self._queue = queue.Queue()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._sub = node.create_subscriber(
+            topic=f'{namespace}.replication',
+            on_message=self._on_batch)
+        self._fetch_rpc = node.create_rpc_client(
+            rpc_name=f'{namespace}.replication.fetch')
+        self._snapshot_rpc = node.create_rpc_client(
+            rpc_name=f'{namespace}.replication.snapshot')
+
+    def start(self) -> None:
+        self._sub.run()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if hasattr(self._sub, 'stop'):
+            self._sub.stop()
+
+    def stats(self) -> dict:
+        return {
+            'primary': self.namespace,
+            'epoch': self.epoch,
+            'offset': self.offset,
+            'applied': self.applied,
+            'resyncs': self.resyncs
+        }
+
+    def _on_batch(self, msg, *args):
+        self._queue.put(msg)
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                msg = self._queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                msg = None
+            try:
+                if msg is None:
+                    self.catch_up()
+                else:
+                    self.apply_batch(msg)
+            except Exception as exc:
+                self.logger.error('Replication from <{}> failed: {}'.format(
+                    self.namespace, exc))
+
+    def apply_batch(self, msg: dict) -> None:
+        if msg['epoch'] != self.epoch or msg['first'] > self.offset:
+            # Entries were missed. The fetched ones include this batch.
+            self.catch_up()
+            return
+        if msg['last'] >= self.offset:
+            self._apply(decode_entries(msg['data']))
+
+    def _apply(self, entries: list) -> None:
+        for offset, name, args in entries:
+            if offset < self.offset:
+                continue
+            if offset > self.offset:
+                raise RuntimeError('Replication gap at offset {}'.format(
+                    self.offset))
+            if self._snapshot:
+                args = self._unread(offset, name, args)
+            if args is not None:
+                try:
+                    apply_entry(self._mem, name, args)
+                except Exception as exc:
+                    if self._failed != (self.epoch, offset):
+                        self.logger.error(
+                            'Failed to apply entry {} <{}>: {}, '
+                            'resynchronizing'.format(offset, name, exc))
+                        self._failed = (self.epoch, offset)
+                        self.resync()
+                        return
+                    self.logger.error(
+                        'Failed to apply entry {} <{}> again: {}, '
+                        'skipping it'.format(offset, name, exc))
+            self.offset = offset + 1
+            self.applied += 1
+            if self.offset >= self._snapshot_end:
+                self._snapshot = {}
+
+    def _unread(self, offset: int, name: str, args: list):
+        """_unread.
+        The args of an entry without the keys whose snapshot records were
+        read after it, or None if none is left.
+        """
+        read = self._snapshot
+
+        def _stale(key):
+            return read.get(key, -1) <= offset
+
+        if name == 'flush':
+            # Only the keys read before the flush are left to delete
+            cursor = 0
+            while True:
+                cursor, keys = self._mem.scan(cursor, None, self.fetch_size)
+                keys = [key for key in keys if _stale(key)]
+                if keys:
+                    self._mem.delete(keys)
+                if not cursor:
+                    return None
+        if name == 'delete':
+            keys = [key for key in args[0] if _stale(key)]
+            return [keys] + list(args[1:]) if keys else None
+        if name == 'mset':
+            pairs = [(key, val) for key, val in zip(args[0], args[1])
+                     if _stale(key)]
+            if not pairs:
+                return None
+            keys, vals = zip(*pairs)
+            return [list(keys), list(vals)] + list(args[2:])
+        return args if _stale(args[0]) else None
+
+    def _call(self, rpc, req: dict) -> dict:
+        resp = rpc.call(req)
+        if not resp['status'] and not resp.get('resync'):
+            raise RuntimeError(resp['error'])
+        return resp
+
+    def catch_up(self) -> None:
+        """catch_up.
+        Fetch and apply the entries of the primary from the next expected
+        offset on, until there are no more.
+        """
+        while True:
+            resp = self._call(self._fetch_rpc, {
+                'epoch': self.epoch,
+                'offset': self.offset,
+                'limit': self.fetch_size
+            })
+            if resp.get('resync'):
+                self.resync()
+                continue
+            resyncs = self.resyncs
+            self._apply(decode_entries(resp['data']))
+            if self.offset >= resp['next'] and self.resyncs == resyncs:
+                return
+
+    def resync(self) -> None:
+        """resync.
+        Replace the contents of the memory with a snapshot of the primary.
+        """
+        clear(self._mem, self.fetch_size)
+        cursor = 0
+        start = None
+        read = {}
+        while True:
+            resp = self._call(self._snapshot_rpc, {
+                'cursor': cursor,
+                'count': self.fetch_size
+            })
+            if start is None:
+                start = (resp['epoch'], resp['offset'])
+            records = decode_entries(resp['data'])
+            for name, args in record_ops(records):
+                getattr(self._mem, name)(*args)
+            for record in records:
+                read[record[1]] = resp['offset']
+            cursor = resp['cursor']
+            if not cursor:
+                break
+        self.epoch, self.offset = start
+        self._snapshot = read
+        self._snapshot_end = resp['offset']
+        self.resyncs += 1
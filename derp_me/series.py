@@ -0,0 +1,87 @@
+"""Typed numeric series."""
+
+import sys
+from array import array
+
+
+# Declared series dtype -> array typecode. Samples are stored packed,
+# little-endian, oldest first.
+DTYPES = {
+    'int8': 'b',
+    'uint8': 'B',
+    'int16': 'h',
+    'uint16': 'H',
+    'int32': 'i',
+    'uint32': 'I',
+    'int64': 'q',
+    'uint64': 'Q',
+    'int': 'q',
+    'float32': 'f',
+    'float64': 'd',
+    'float': 'd'
+}
+
+# Per-sample timestamps are stored as a float64 series under this suffix
+TIMESTAMPS_SUFFIX = '.__ts__'
+# The declared dtype of a series is stored under this suffix
+DTYPE_SUFFIX = '.__dtype__'
+
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def is_meta_key(key: str) -> bool:
+    """is_meta_key.
+    Whether a key holds the timestamps or dtype of a series, rather than
+    data of its own.
+    """
+    return key.endswith(TIMESTAMPS_SUFFIX) or key.endswith(DTYPE_SUFFIX)
+
+
+def itemsize(dtype: str) -> int:
+    return array(DTYPES[dtype]).itemsize
+
+
+def pack(vals, dtype: str) -> bytes:
+    """pack.
+    Pack numbers into the storage representation of a dtype.
+    """
+    arr = array(DTYPES[dtype], vals)
+    if not _LITTLE_ENDIAN:
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def view(data: bytes, dtype: str) -> memoryview:
+    """view.
+    Zero-copy typed view over packed samples. The view supports the buffer
+    protocol, so it can be wrapped with numpy.frombuffer() or array().
+    """
+    if not _LITTLE_ENDIAN:
+        arr = array(DTYPES[dtype])
+        arr.frombytes(data)
+        arr.byteswap()
+        return memoryview(arr)
+    return memoryview(data).cast(DTYPES[dtype])
+
+
+def window(size: int, from_idx: int, to_idx: int):
+    """window.
+    Translate lget() indices, which count from the newest sample, to the
+    [start, stop) sample range of a series stored oldest first.
+    Returns None for an empty range.
+
+    Args:
+        size (int): Number of samples in the series
+        from_idx (int): from_idx as given to lget()
+        to_idx (int): to_idx as given to lget()
+    """
+    start = -1 * from_idx
+    stop = -1 * to_idx
+    if start < 0:
+        start = max(size + start, 0)
+    if stop < 0:
+        stop = size + stop
+    stop = min(stop, size - 1)
+    if start > stop:
+        return None
+    return size - 1 - stop, size - start
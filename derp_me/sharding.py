@@ -0,0 +1,478 @@
+"""Consistent-hash sharding of memories."""
+
+import sys
+import threading
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from hashlib import blake2b
+
+from .derp_me import Memory
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(),
+                          'little')
+
+
+class HashRing(object):
+    """HashRing.
+    Consistent hashing with virtual nodes. Every node is placed on the ring
+    at `vnodes` points and a key belongs to the node of the first point
+    clockwise of its hash. Adding a node only moves the keys of the arcs it
+    takes over, about 1/N of them, while virtual nodes keep the share of
+    each node balanced.
+    """
+
+    def __init__(self, nodes=(), vnodes: int = 100):
+        """__init__.
+
+        Args:
+            nodes: Node names
+            vnodes (int): Points per node
+        """
+        self.vnodes = vnodes
+        self.nodes = []
+        self._ring = ([], [])
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str) -> None:
+        if node in self.nodes:
+            raise ValueError('Node <{}> is already in the ring'.format(node))
+        self.nodes.append(node)
+        self._rebuild()
+
+    def remove(self, node: str) -> None:
+        self.nodes.remove(node)
+        self._rebuild()
+
+    def _rebuild(self) -> None:
+        points = sorted((_hash('{}#{}'.format(node, i)), node)
+                        for node in self.nodes for i in range(self.vnodes))
+        # Swapped in one assignment, for lock-free lookups
+        self._ring = ([p for p, _ in points], [n for _, n in points])
+
+    def node(self, key: str) -> str:
+        points, owners = self._ring
+        if not points:
+            raise LookupError('The hash ring is empty')
+        return owners[bisect_right(points, _hash(key)) % len(owners)]
+
+
+class _RingLock(object):
+    """_RingLock.
+    Shared by the writes while they route and apply their keys, and held
+    exclusively while the ring is swapped, so that no write lands on a
+    shard chosen by a ring that is no longer current.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._holders = 0
+        self._exclusive = False
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            while self._exclusive:
+                self._cond.wait()
+            self._holders += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._holders -= 1
+                if not self._holders:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            while self._exclusive:
+                self._cond.wait()
+            # New writes wait from now on
+            self._exclusive = True
+            while self._holders:
+                self._cond.wait()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+class ShardedMemory(Memory):
+    """ShardedMemory.
+    Partitions the keys across several memories by consistent hashing (see
+    HashRing). Single-key operations go to the shard of their key.
+    Multi-key operations are split per shard, executed on the shards in
+    parallel and their results merged back in request order.
+
+    add_shard() rebalances online. The keys the new shard takes over are
+    copied to it and deleted from their previous shard. Until that is
+    complete, reads that miss on the new shard fall back to the previous
+    one, and writes are serialized with the copies, so that a copy never
+    overwrites a newer write.
+    """
+
+    # Single-key operations that execute() can group per shard
+    _KEY_OPS = ('get', 'set', 'lset', 'lget', 'llen', 'expire', 'ttl',
+                'persist')
+
+    def __init__(self, shards: dict, vnodes: int = 100, workers: int = None,
+                 *args, **kwargs):
+        """__init__.
+
+        Args:
+            shards (dict): Shard name -> Memory. Names place the shards on
+                the ring, so they must stay the same across restarts
+            vnodes (int): Points of each shard on the ring
+            workers (int): Threads executing the operations of the shards
+                in parallel. Defaults to twice the number of shards
+        """
+        super(ShardedMemory, self).__init__(*args, **kwargs)
+        self.shards = dict(shards)
+        self.ring = HashRing(self.shards, vnodes)
+        self._prev_ring = None
+        self._rebalance_lock = threading.Lock()
+        self._ring_lock = _RingLock()
+        self._migration_lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or 2 * max(len(self.shards), 1))
+
+    def _shard(self, key: str) -> Memory:
+        return self.shards[self.ring.node(key)]
+
+    def _fallback(self, key: str):
+        """_fallback.
+        Previous shard of a key while it is being moved, otherwise None.
+        """
+        prev = self._prev_ring
+        if prev is None:
+            return None
+        name = prev.node(key)
+        return None if name == self.ring.node(key) else self.shards[name]
+
+    @contextmanager
+    def _write_lock(self):
+        """_write_lock.
+        Held by writes while they route their keys and apply them. While
+        rebalancing, writes are also serialized with the copies.
+        Writes must not nest it.
+        """
+        with self._ring_lock.shared():
+            if self._prev_ring is None:
+                yield
+            else:
+                with self._migration_lock:
+                    yield
+
+    def _group(self, keys: list) -> dict:
+        """_group.
+        Returns {shard name: [indices of its keys]}.
+        """
+        groups = {}
+        node = self.ring.node
+        for i, key in enumerate(keys):
+            groups.setdefault(node(key), []).append(i)
+        return groups
+
+    def _fan_out(self, calls: list) -> list:
+        """_fan_out.
+        Execute (function, args) calls, in parallel if there are several,
+        and return their results in order.
+        """
+        if len(calls) == 1:
+            fn, args = calls[0]
+            return [fn(*args)]
+        futures = [self._executor.submit(fn, *args) for fn, args in calls]
+        return [future.result() for future in futures]
+
+    def set(self, key: str, val: str, ttl: float = None) -> None:
+        with self._write_lock():
+            self._shard(key).set(key, val, ttl)
+
+    def get(self, key: str):
+        val = self._shard(key).get(key)
+        if val is None:
+            prev = self._fallback(key)
+            if prev is not None:
+                val = prev.get(key)
+        return val
+
+    def mset(self, keys: list, vals: list, ttl: float = None) -> None:
+        with self._write_lock():
+            groups = self._group(keys)
+            self._fan_out([
+                (self.shards[name].mset, ([keys[i] for i in idx],
+                                          [vals[i] for i in idx], ttl))
+                for name, idx in groups.items()
+            ])
+
+    def mget(self, keys: list):
+        groups = self._group(keys)
+        names = list(groups)
+        results = self._fan_out([
+            (self.shards[name].mget, ([keys[i] for i in groups[name]],))
+            for name in names
+        ])
+        vals = [None] * len(keys)
+        for name, res in zip(names, results):
+            for i, val in zip(groups[name], res):
+                vals[i] = val
+        if self._prev_ring is not None:
+            for i, val in enumerate(vals):
+                if val is None:
+                    vals[i] = self.get(keys[i])
+        return vals
+
+    def lset(self, key: str, vals: list, ttl: float = None) -> None:
+        with self._write_lock():
+            shard = self._shard(key)
+            prev = self._fallback(key)
+            if prev is not None:
+                # Push onto the whole list, not a new one
+                self._migrate_key(key, prev, shard)
+            shard.lset(key, vals, ttl)
+
+    def lget(self, key: str, from_idx: int, to_idx: int) -> list:
+        return self.llen_range(key, from_idx, to_idx)[1]
+
+    def llen(self, key: str) -> int:
+        size = self._shard(key).llen(key)
+        if size == 0:
+            prev = self._fallback(key)
+            if prev is not None:
+                size = prev.llen(key)
+        return size
+
+    def llen_range(self, key: str, from_idx: int, to_idx: int) -> tuple:
+        res = self._shard(key).llen_range(key, from_idx, to_idx)
+        if res[0] == 0:
+            prev = self._fallback(key)
+            if prev is not None:
+                res = prev.llen_range(key, from_idx, to_idx)
+        return res
+
+    def flush(self) -> None:
+        self._fan_out([(shard.flush, ()) for shard in self.shards.values()])
+
+    def delete(self, keys: list) -> int:
+        count = 0
+        with self._write_lock():
+            for key in keys:
+                prev = self._fallback(key)
+                count += self._shard(key).delete([key])
+                if prev is not None:
+                    count += prev.delete([key])
+        return count
+
+    def expire(self, key: str, ttl: float) -> bool:
+        with self._write_lock():
+            if self._shard(key).expire(key, ttl):
+                return True
+            prev = self._fallback(key)
+            return prev is not None and prev.expire(key, ttl)
+
+    def ttl(self, key: str) -> float:
+        ttl = self._shard(key).ttl(key)
+        if ttl == -2:
+            prev = self._fallback(key)
+            if prev is not None:
+                ttl = prev.ttl(key)
+        return ttl
+
+    def persist(self, key: str) -> bool:
+        with self._write_lock():
+            if self._shard(key).persist(key):
+                return True
+            prev = self._fallback(key)
+            return prev is not None and prev.persist(key)
+
+    def expire_due(self, limit: int = None) -> list:
+        keys = []
+        for shard in list(self.shards.values()):
+            keys.extend(shard.expire_due(limit))
+        return keys
+
+    def memory_stats(self) -> dict:
+        return {
+            'shards': {name: shard.memory_stats()
+                       for name, shard in list(self.shards.items())},
+            'rebalancing': self._prev_ring is not None
+        }
+
+    def execute(self, ops: list) -> list:
+        """execute.
+        Single-key operations are grouped per shard and each group is
+        executed by its shard, in parallel. Batches with other operations,
+        or submitted while rebalancing, are executed one operation at a
+        time.
+        """
+        if any(name not in self._KEY_OPS for name, _ in ops):
+            return super(ShardedMemory, self).execute(ops)
+        results = None
+        with self._ring_lock.shared():
+            if self._prev_ring is None:
+                groups = self._group([args[0] for _, args in ops])
+                names = list(groups)
+                results = self._fan_out([
+                    (self.shards[name].execute,
+                     ([ops[i] for i in groups[name]],))
+                    for name in names
+                ])
+        if results is None:
+            # Rebalancing, the writes take the migration lock one by one
+            return super(ShardedMemory, self).execute(ops)
+        replies = [None] * len(ops)
+        for name, res in zip(names, results):
+            for i, reply in zip(groups[name], res):
+                replies[i] = reply
+        return replies
+
+    def scan(self, cursor=0, match: str = None, count: int = 100) -> tuple:
+        """scan.
+        Scan the shards one after the other. Cursors are
+        [shard index, cursor] pairs, shards being ordered by name.
+        """
+        names = sorted(self.shards)
+        idx, cursor = cursor if cursor else (0, 0)
+        cursor, keys = self.shards[names[idx]].scan(cursor, match, count)
+        if cursor:
+            return [idx, cursor], keys
+        if idx + 1 < len(names):
+            return [idx + 1, 0], keys
+        return 0, keys
+
+    def scan_prefix(self, prefix: str, limit: int) -> list:
+        keys = set()
+        for shard in list(self.shards.values()):
+            keys.update(shard.scan_prefix(prefix, limit))
+        return sorted(keys)[:limit]
+
+    def series_append(self, key: str, data: bytes, itemsize: int,
+                      max_len: int) -> None:
+        with self._write_lock():
+            shard = self._shard(key)
+            prev = self._fallback(key)
+            if prev is not None:
+                # Append to the whole series, not a new one
+                self._migrate_key(key, prev, shard)
+            shard.series_append(key, data, itemsize, max_len)
+
+    def series_range(self, key: str, from_idx: int, to_idx: int,
+                     itemsize: int, max_len: int) -> bytes:
+        data = self._shard(key).series_range(key, from_idx, to_idx,
+                                             itemsize, max_len)
+        if not data:
+            prev = self._fallback(key)
+            if prev is not None:
+                data = prev.series_range(key, from_idx, to_idx, itemsize,
+                                         max_len)
+        return data
+
+    def series_len(self, key: str, itemsize: int, max_len: int) -> int:
+        size = self._shard(key).series_len(key, itemsize, max_len)
+        if size == 0:
+            prev = self._fallback(key)
+            if prev is not None:
+                size = prev.series_len(key, itemsize, max_len)
+        return size
+
+    def _migrate_key(self, key: str, src: Memory, dst: Memory) -> int:
+        """_migrate_key.
+        Move a key from its previous shard to its new one. Returns 1 if the
+        key was copied.
+        """
+        with self._migration_lock:
+            ttl = src.ttl(key)
+            if ttl == -2:
+                return 0
+            if dst.ttl(key) != -2:
+                # Written to its new shard since, the old copy is stale
+                src.delete([key])
+                return 0
+            ttl = ttl if ttl > 0 else None
+            try:
+                val = src.get(key)
+            except Exception:
+                # Not a plain value
+                val = None
+            if val is not None:
+                dst.set(key, val, ttl)
+            else:
+                try:
+                    size = src.llen(key)
+                except Exception:
+                    size = 0
+                if size > 0:
+                    items = src.lget(key, 0, -(size - 1))
+                    # lset pushes to the head, so push the oldest item first
+                    dst.lset(key, items[::-1], ttl)
+                elif not self._migrate_series(key, src, dst, ttl):
+                    return 0
+            src.delete([key])
+            return 1
+
+    @staticmethod
+    def _migrate_series(key: str, src: Memory, dst: Memory, ttl) -> bool:
+        """_migrate_series.
+        Copy a typed series as raw bytes, so that its dtype is not needed.
+        Returns False if the key is not a series.
+        """
+        size = src.series_len(key, 1, sys.maxsize)
+        if size == 0:
+            return False
+        data = src.series_range(key, 0, -(size - 1), 1, size)
+        dst.series_append(key, data, 1, size)
+        if ttl is not None:
+            dst.expire(key, ttl)
+        return True
+
+    def add_shard(self, name: str, memory: Memory) -> int:
+        """add_shard.
+        Add a shard and move to it the keys it now owns, while serving
+        requests. Returns the number of keys moved.
+
+        Args:
+            name (str): Shard name
+            memory (Memory): Memory of the shard
+        """
+        with self._rebalance_lock:
+            if name in self.shards:
+                raise ValueError('Shard <{}> already exists'.format(name))
+            prev = self.ring
+            ring = HashRing(prev.nodes + [name], prev.vnodes)
+            with self._ring_lock.exclusive():
+                self.shards[name] = memory
+                self._prev_ring = prev
+                self.ring = ring
+            moved = 0
+            try:
+                for src_name in prev.nodes:
+                    src = self.shards[src_name]
+                    cursor = 0
+                    while True:
+                        cursor, keys = src.scan(cursor, None, 1000)
+                        for key in keys:
+                            if ring.node(key) == name:
+                                moved += self._migrate_key(key, src, memory)
+                        if not cursor:
+                            break
+            finally:
+                with self._ring_lock.exclusive():
+                    self._prev_ring = None
+            return moved
+
+    def sync(self) -> None:
+        for shard in self.shards.values():
+            if hasattr(shard, 'sync'):
+                shard.sync()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        for shard in self.shards.values():
+            if hasattr(shard, 'close'):
+                shard.close()
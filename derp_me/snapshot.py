@@ -0,0 +1,283 @@
+"""Streaming snapshots of the memories, for backups and migrations."""
+
+import base64
+import json
+import struct
+import time
+import zlib
+
+MAGIC = b'DERPME-SNAPSHOT\n'
+VERSION = 1
+
+# Record kinds
+VALUE = 'v'
+LIST = 'l'
+SERIES = 's'
+
+# Bytes of a typed series read at once, as a series of 1 byte samples
+_MAX_SERIES_BYTES = 1 << 40
+
+_LENGTH = struct.Struct('>I')
+
+
+class SnapshotError(Exception):
+    """SnapshotError.
+    Raised when reading a file that is not a valid snapshot.
+    """
+
+
+class SnapshotWriter(object):
+    """SnapshotWriter.
+    Writes a snapshot file: the magic line, then a sequence of chunks,
+    each a big-endian uint32 length followed by a zlib-compressed JSON
+    array, and a zero length chunk at the end. The first chunk is the
+    header (a JSON object), the next ones hold records:
+
+        [tier, kind, key, value, ttl]
+
+    tier is 0 for runtime and 1 for persistent memory. kind is 'v' for
+    values, 'l' for lists (items oldest first) and 's' for typed series
+    (the packed buffer, base64 encoded). ttl is the remaining time to live
+    in seconds or None. Records are written a chunk at a time, so memory
+    use does not depend on the size of the snapshot.
+    """
+
+    def __init__(self, fp, header: dict = None, level: int = 1):
+        """__init__.
+
+        Args:
+            fp: Binary file object
+            header (dict): Metadata of the snapshot
+            level (int): zlib compression level
+        """
+        self._fp = fp
+        self.level = level
+        self.records = 0
+        fp.write(MAGIC)
+        header = dict(header or {})
+        header.setdefault('version', VERSION)
+        header.setdefault('created', time.time())
+        self._write_chunk(header)
+
+    def _write_chunk(self, obj) -> None:
+        data = zlib.compress(
+            json.dumps(obj, separators=(',', ':')).encode(), self.level)
+        self._fp.write(_LENGTH.pack(len(data)))
+        self._fp.write(data)
+
+    def write(self, records: list) -> None:
+        if records:
+            self._write_chunk(records)
+            self.records += len(records)
+
+    def close(self) -> None:
+        self._fp.write(_LENGTH.pack(0))
+        self._fp.flush()
+
+
+class SnapshotReader(object):
+    """SnapshotReader.
+    Reads a snapshot file written by SnapshotWriter, one chunk of records
+    at a time.
+    """
+
+    def __init__(self, fp):
+        self._fp = fp
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise SnapshotError('Not a derp-me snapshot')
+        self.header = self._read_chunk()
+        if self.header is None or self.header.get('version') != VERSION:
+            raise SnapshotError('Unsupported snapshot version')
+
+    def _read_chunk(self):
+        head = self._fp.read(_LENGTH.size)
+        if len(head) < _LENGTH.size:
+            raise SnapshotError('Truncated snapshot')
+        size, = _LENGTH.unpack(head)
+        if size == 0:
+            return None
+        data = self._fp.read(size)
+        if len(data) < size:
+            raise SnapshotError('Truncated snapshot')
+        return json.loads(zlib.decompress(data))
+
+    def __iter__(self):
+        while True:
+            chunk = self._read_chunk()
+            if chunk is None:
+                return
+            yield chunk
+
+
+def _get(mem, key: str):
+    try:
+        return mem.get(key)
+    except Exception:
+        # A binary typed series
+        return None
+
+
+def _execute(mem, ops: list) -> list:
+    """_execute.
+    Execute operations in one batch, or one by one if the batch fails, e.g.
+    on a Redis type error. Failed operations return None.
+    """
+    if not ops:
+        return []
+    try:
+        return mem.execute(ops)
+    except Exception:
+        pass
+    replies = []
+    for name, args in ops:
+        try:
+            replies.append(getattr(mem, name)(*args))
+        except Exception:
+            replies.append(None)
+    return replies
+
+
+def read_records(mem, keys: list) -> list:
+    """read_records.
+    Read keys of a memory as [kind, key, value, ttl] records, using a few
+    pipelined round trips per call. Keys that do not exist are left out.
+
+    Args:
+        mem (Memory): Memory
+        keys (list): Keys
+    """
+    try:
+        vals = mem.mget(keys)
+    except Exception:
+        # Binary typed series among the keys, read them one by one
+        vals = [_get(mem, key) for key in keys]
+    others = [key for key, val in zip(keys, vals) if val is None]
+    replies = _execute(mem, [('ttl', (key,)) for key in keys] +
+                       [('llen', (key,)) for key in others])
+    ttls = dict(zip(keys, replies[:len(keys)]))
+    sizes = dict(zip(others, replies[len(keys):]))
+    lists = [key for key in others if sizes[key]]
+    items = dict(zip(lists, _execute(
+        mem, [('lget', (key, 0, -(sizes[key] - 1))) for key in lists])))
+    records = []
+    for key, val in zip(keys, vals):
+        ttl = ttls[key]
+        if ttl == -2:
+            continue
+        ttl = ttl if ttl is not None and ttl > 0 else None
+        if val is not None:
+            records.append([VALUE, key, val, ttl])
+        elif key in items:
+            records.append([LIST, key, items[key][::-1], ttl])
+        else:
+            try:
+                size = mem.series_len(key, 1, _MAX_SERIES_BYTES)
+            except Exception:
+                # Another type of Redis key
+                size = 0
+            if size:
+                data = mem.series_range(key, 0, -(size - 1), 1,
+                                        _MAX_SERIES_BYTES)
+                records.append([SERIES, key,
+                                base64.b64encode(data).decode(), ttl])
+    return records
+
+
+def record_ops(records: list) -> list:
+    """record_ops.
+    The (method name, args) operations writing records to a memory,
+    replacing the lists and series that already exist.
+    """
+    ops = []
+    for kind, key, val, ttl in records:
+        if kind == VALUE:
+            ops.append(('set', (key, val, ttl)))
+        elif kind == LIST:
+            ops.append(('delete', ([key],)))
+            ops.append(('lset', (key, val, ttl)))
+        elif kind == SERIES:
+            data = base64.b64decode(val)
+            ops.append(('delete', ([key],)))
+            ops.append(('series_append', (key, data, 1, len(data))))
+            if ttl is not None:
+                ops.append(('expire', (key, ttl)))
+        else:
+            raise SnapshotError('Unknown record kind <{}>'.format(kind))
+    return ops
+
+
+def clear(mem, count: int = 1000) -> None:
+    """clear.
+    Delete every key of a memory, count keys at a time.
+    """
+    cursor = 0
+    while True:
+        cursor, keys = mem.scan(cursor, None, count)
+        if keys:
+            mem.delete(keys)
+        if not cursor:
+            return
+
+
+def dump(mems: dict, fp, match: str = None, count: int = 1000,
+         header: dict = None) -> int:
+    """dump.
+    Write the keys of memories to a snapshot file, count keys per chunk.
+    Returns the number of records written.
+
+    Args:
+        mems (dict): {tier: Memory}, tier being 0 (runtime) or 1
+            (persistent)
+        fp: Binary file object
+        match (str): Glob pattern of the dumped keys
+        count (int): Keys per chunk
+        header (dict): Metadata of the snapshot
+    """
+    header = dict(header or {})
+    header['tiers'] = sorted(mems)
+    writer = SnapshotWriter(fp, header)
+    for tier, mem in sorted(mems.items()):
+        cursor = 0
+        while True:
+            cursor, keys = mem.scan(cursor, match, count)
+            if keys:
+                writer.write([[tier] + record
+                              for record in read_records(mem, keys)])
+            if not cursor:
+                break
+    writer.close()
+    return writer.records
+
+
+def load(mems: dict, fp, flush: bool = False) -> int:
+    """load.
+    Write the records of a snapshot file to memories, each chunk in one
+    pipelined batch per memory. Records of tiers missing from mems are
+    skipped. Returns the number of records loaded.
+
+    Args:
+        mems (dict): {tier: Memory}
+        fp: Binary file object, or a SnapshotReader of it
+        flush (bool): Delete the keys of the memories first
+    """
+    reader = fp if isinstance(fp, SnapshotReader) else SnapshotReader(fp)
+    if flush:
+        for mem in mems.values():
+            clear(mem)
+    loaded = 0
+    for chunk in reader:
+        by_tier = {}
+        for record in chunk:
+            if record[0] in mems:
+                by_tier.setdefault(record[0], []).append(record[1:])
+        for tier, records in by_tier.items():
+            ops = record_ops(records)
+            mem = mems[tier]
+            if any(name == 'series_append' for name, _ in ops):
+                # Not pipelined by every memory
+                for name, args in ops:
+                    getattr(mem, name)(*args)
+            else:
+                mem.execute(ops)
+            loaded += len(records)
+    return loaded
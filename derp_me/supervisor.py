@@ -0,0 +1,339 @@
+"""Multi-process server mode."""
+
+import inspect
+import multiprocessing as mp
+import os
+import signal
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+from commlib.logger import Logger
+from commlib.node import TransportType
+
+from .derp_me import DerpMe, InProcessRuntimeMem, LocalMemType, sd_notify
+
+
+# Methods of the memories exposed to the workers. close() is left out, the
+# supervisor closes the shared memories once every worker has stopped.
+_MEMORY_METHODS = (
+    'set', 'get', 'mset', 'mget', 'lset', 'lget', 'llen', 'llen_range',
+    'flush', 'delete', 'expire', 'ttl', 'persist', 'scan', 'scan_prefix',
+    'expire_due', 'memory_stats', 'execute', 'series_append',
+    'series_range', 'series_len'
+)
+
+
+class _Store(object):
+    """_Store.
+    The memories of a SharedStore, living in its server process.
+    """
+
+    def __init__(self, settings: dict):
+        self.memories = {}
+        if settings['runtime_mem'] == LocalMemType.INPROCESS:
+            self.memories[False] = InProcessRuntimeMem(
+                list_size=settings['list_size'],
+                max_memory=settings['runtime_max_memory'],
+                eviction_policy=settings['eviction_policy']
+            )
+        if settings['persistent_mem'] == LocalMemType.FILE:
+            from .file_mem import FilePersistentMem
+            self.memories[True] = FilePersistentMem(
+                path=settings['storage_path'],
+                list_size=settings['list_size']
+            )
+        elif settings['persistent_mem'] == LocalMemType.MMAP:
+            from .mmap_mem import MmapPersistentMem
+            self.memories[True] = MmapPersistentMem(
+                path=settings['storage_path'],
+                list_size=settings['list_size'],
+                snapshot_interval=settings['snapshot_interval'],
+                snapshot_max_dirty=settings['snapshot_max_dirty']
+            )
+
+    def close(self) -> None:
+        for mem in self.memories.values():
+            if hasattr(mem, 'close'):
+                mem.close()
+
+
+_store = None
+
+
+def _init_store(settings: dict) -> None:
+    global _store
+    _store = _Store(settings)
+
+
+def _get_store():
+    return _store
+
+
+def _get_memory(persistent: bool):
+    return _store.memories[persistent]
+
+
+class SharedStore(BaseManager):
+    """SharedStore.
+    Serves the in-process memories (INPROCESS runtime, FILE/MMAP
+    persistent) from a single process to the workers of a Supervisor, so
+    that they all see the same keys. Workers access them through proxies,
+    one round trip per operation (or per batch), while encoding, decoding
+    and callbacks run in the workers in parallel.
+    """
+
+
+SharedStore.register('store', _get_store, exposed=('close',))
+SharedStore.register('memory', _get_memory, exposed=_MEMORY_METHODS)
+
+
+def start_shared_store(settings: dict, ctx=None) -> SharedStore:
+    """start_shared_store.
+    Start the process of a SharedStore.
+
+    Args:
+        settings (dict): DerpMe parameters of the memories (runtime_mem,
+            persistent_mem, list_size, runtime_max_memory, eviction_policy,
+            storage_path, snapshot_interval, snapshot_max_dirty)
+        ctx: multiprocessing context
+    """
+    store = SharedStore(ctx=ctx)
+    store.start(_init_store, (settings,))
+    return store
+
+
+def _run_worker(idx: int, kwargs: dict, store_address, heartbeats,
+                ready, interval: float) -> None:
+    # Readiness is reported to systemd by the supervisor
+    os.environ.pop('NOTIFY_SOCKET', None)
+    stop_event = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop_event.set())
+    if store_address is not None:
+        store = SharedStore(address=store_address)
+        store.connect()
+        kwargs = dict(kwargs, shared_store=store)
+    derp = DerpMe(**kwargs)
+    derp.wait_ready()
+    ready[idx] = 1
+    heartbeats[idx] = time.monotonic()
+    while not stop_event.wait(interval):
+        heartbeats[idx] = time.monotonic()
+    derp.stop()
+
+
+class _Worker(object):
+    def __init__(self, idx: int):
+        self.idx = idx
+        self.process = None
+        self.started = 0.0
+        self.restarts = 0
+        self.backoff = 0.0
+        self.restart_at = None
+
+
+class Supervisor(object):
+    """Supervisor.
+    Runs a DerpMe server in each of N worker processes. The workers share
+    one namespace and consume the same RPC queues, so requests are spread
+    across them and across CPU cores. This requires a broker with queue
+    semantics for RPCs (REDIS or AMQP).
+
+    Redis memories are shared natively. The in-process memories are
+    hosted by a SharedStore process instead, so every worker serves the
+    same keys. The store serves the operations of all the workers from
+    one process, one IPC round trip each, so it bounds the throughput of
+    the workers to that of a single core: only encoding, decoding and
+    callbacks scale with N. Use Redis memories to scale further (see
+    benchmarks/bench_derpme.py --workers).
+
+    Workers report a heartbeat every heartbeat_interval seconds. A worker
+    that exits or misses heartbeats for heartbeat_timeout seconds is
+    killed and restarted, after restart_delay seconds, doubled on every
+    crash within min_uptime seconds of the start, up to max_restart_delay.
+    Heartbeats are read from the monotonic clock, which the workers share
+    with the supervisor, so wall-clock jumps do not restart them.
+
+    Workers do not notify systemd themselves. Once every worker is ready,
+    the supervisor sets `ready` and sends READY=1 from the main process.
+    """
+
+    def __init__(self,
+                 workers: int = None,
+                 heartbeat_interval: float = 1.0,
+                 heartbeat_timeout: float = 10.0,
+                 restart_delay: float = 1.0,
+                 max_restart_delay: float = 30.0,
+                 min_uptime: float = 5.0,
+                 **kwargs):
+        """__init__.
+
+        Args:
+            workers (int): Number of worker processes. Defaults to the
+                number of CPUs
+            heartbeat_interval (float): Seconds between two heartbeats of
+                a worker
+            heartbeat_timeout (float): Seconds without heartbeats after
+                which a worker is considered hung and restarted
+            restart_delay (float): Seconds before restarting a worker
+            max_restart_delay (float): Max seconds before restarting a
+                worker that keeps crashing
+            min_uptime (float): Workers crashing sooner than this after
+                their start are restarted with a growing delay
+            kwargs: DerpMe parameters of the workers
+        """
+        params = inspect.signature(DerpMe).bind_partial(**kwargs)
+        params.apply_defaults()
+        settings = params.arguments
+        if settings['broker_type'] not in (TransportType.REDIS,
+                                           TransportType.AMQP):
+            raise ValueError('Workers can only share the RPC queues of '
+                             'REDIS or AMQP brokers')
+        self._shared = settings['runtime_mem'] == LocalMemType.INPROCESS or \
+            settings['persistent_mem'] in (LocalMemType.FILE,
+                                           LocalMemType.MMAP)
+        if self._shared and (settings['tiered'] or
+                             settings['spill_evicted'] or
+                             settings['runtime_nodes'] or
+                             settings['persistent_nodes']):
+            raise ValueError('Tiered mode, spilling and sharding require '
+                             'Redis memories in multi-process mode')
+        if settings['replication'] or settings['replica_of'] is not None:
+            # Every worker would publish a log of its own writes
+            raise ValueError('Replication is not supported in '
+                             'multi-process mode')
+        self.num_workers = workers or os.cpu_count() or 1
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self._kwargs = kwargs
+        self._settings = settings
+        self._ctx = mp.get_context('fork')
+        self._heartbeats = self._ctx.Array('d', self.num_workers, lock=False)
+        self._ready = self._ctx.Array('b', self.num_workers, lock=False)
+        self._workers = [_Worker(i) for i in range(self.num_workers)]
+        self._store = None
+        self._stop_event = threading.Event()
+        self.ready = threading.Event()
+        self.logger = Logger(namespace=self.__class__.__name__)
+
+    def start(self) -> None:
+        if self._shared:
+            self._store = start_shared_store(self._settings, self._ctx)
+        for worker in self._workers:
+            self._start_worker(worker)
+
+    def _start_worker(self, worker: _Worker) -> None:
+        address = None if self._store is None else self._store.address
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        # Grace period for the worker to start up
+        self._heartbeats[worker.idx] = worker.started
+        self._ready[worker.idx] = 0
+        worker.process = self._ctx.Process(
+            target=_run_worker,
+            args=(worker.idx, self._kwargs, address, self._heartbeats,
+                  self._ready, self.heartbeat_interval),
+            name='derpme-worker-{}'.format(worker.idx),
+            daemon=True
+        )
+        worker.process.start()
+
+    def _check_worker(self, worker: _Worker, now: float) -> None:
+        if worker.restart_at is not None:
+            if now >= worker.restart_at:
+                worker.restarts += 1
+                self._start_worker(worker)
+            return
+        proc = worker.process
+        if proc.is_alive():
+            if now - self._heartbeats[worker.idx] < self.heartbeat_timeout:
+                return
+            self.logger.warning('Worker {} (pid {}) missed its heartbeats, '
+                                'restarting'.format(worker.idx, proc.pid))
+            proc.kill()
+        else:
+            self.logger.warning('Worker {} (pid {}) exited with code {}, '
+                                'restarting'.format(worker.idx, proc.pid,
+                                                    proc.exitcode))
+        proc.join()
+        if now - worker.started < self.min_uptime:
+            worker.backoff = min(
+                max(worker.backoff * 2, self.restart_delay),
+                self.max_restart_delay)
+        else:
+            worker.backoff = self.restart_delay
+        worker.restart_at = now + worker.backoff
+
+    def _check_ready(self) -> None:
+        if self.ready.is_set() or not all(self._ready):
+            return
+        self.ready.set()
+        self.logger.info('{} workers ready'.format(self.num_workers))
+        try:
+            sd_notify('READY=1')
+        except OSError as exc:
+            self.logger.error('Failed to notify systemd: {}'.format(exc))
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        """wait_ready.
+        Block until every worker serves requests, up to timeout seconds.
+        """
+        return self.ready.wait(timeout)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            'workers': [{
+                'pid': w.process.pid if w.process else None,
+                'alive': w.restart_at is None and w.process.is_alive(),
+                'restarts': w.restarts,
+                'uptime': now - w.started,
+                'last_heartbeat': now - self._heartbeats[w.idx]
+            } for w in self._workers],
+            'shared_store': self._store is not None
+        }
+
+    def run_forever(self) -> None:
+        """run_forever.
+        Start the workers and supervise them until stop() is called or
+        SIGTERM/SIGINT is received.
+        """
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, lambda *_: self._stop_event.set())
+        self.start()
+        try:
+            while not self._stop_event.wait(self.heartbeat_interval):
+                now = time.monotonic()
+                for worker in self._workers:
+                    self._check_worker(worker, now)
+                self._check_ready()
+        finally:
+            self._shutdown()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def _shutdown(self, timeout: float = 10.0) -> None:
+        procs = [w.process for w in self._workers
+                 if w.process is not None and w.process.is_alive()]
+        for proc in procs:
+            proc.terminate()
+        deadline = time.monotonic() + timeout
+        for proc in procs:
+            proc.join(max(deadline - time.monotonic(), 0))
+            if proc.is_alive():
+                proc.kill()
+                proc.join()
+        if self._store is not None:
+            try:
+                self._store.store().close()
+            except Exception as exc:
+                self.logger.error('Failed to close the shared store: '
+                                  '{}'.format(exc))
+            self._store.shutdown()
+            self._store = None
@@ -0,0 +1,190 @@
+"""Tiered runtime/persistent memory."""
+
+from .derp_me import Memory
+
+
+class TieredMemory(Memory):
+    """TieredMemory.
+    Presents a runtime and a persistent memory as one store, with the
+    runtime memory acting as a cache of the persistent one:
+
+    - Reads are served by the runtime memory. Misses are read from the
+      persistent memory and promoted to the runtime memory.
+    - Durable writes go to the persistent memory and are written through to
+      the runtime memory, whose copy of the key is then clean.
+    - Runtime writes only go to the runtime memory, leaving the key dirty,
+      unless the key is clean, in which case they are written through to
+      keep it so.
+
+    Two views are used, a durable one for persistent requests and a runtime
+    one, sharing the set of clean keys. Dirty keys are demoted to the
+    persistent memory when evicted from the runtime one (see
+    DerpMe._on_evict). Clean keys are simply dropped.
+    """
+
+    def __init__(self, runtime: Memory, persistent: Memory, durable: bool,
+                 clean: set):
+        """__init__.
+
+        Args:
+            runtime (Memory): Runtime memory
+            persistent (Memory): Persistent memory
+            durable (bool): Writes of this view go to persistent memory
+            clean (set): Keys whose runtime copy mirrors persistent memory,
+                shared by the views of the same memories
+        """
+        super(TieredMemory, self).__init__(list_size=runtime.list_size)
+        self.runtime = runtime
+        self.persistent = persistent
+        self.durable = durable
+        self.clean = clean
+
+    def _write_through(self, key: str) -> bool:
+        return self.durable or key in self.clean
+
+    def _promote(self, key: str, val) -> None:
+        ttl = self.persistent.ttl(key)
+        self.runtime.set(key, val, ttl if ttl > 0 else None)
+        self.clean.add(key)
+
+    def _promote_list(self, key: str) -> int:
+        """_promote_list.
+        Copy a list from persistent to runtime memory. Returns its length.
+        """
+        items = self.persistent.lget(key, 0, -(self.list_size - 1))
+        if not items:
+            return 0
+        ttl = self.persistent.ttl(key)
+        # lset pushes to the head, so push the oldest item first
+        self.runtime.lset(key, items[::-1], ttl if ttl > 0 else None)
+        self.clean.add(key)
+        return len(items)
+
+    def _demote_list(self, key: str) -> None:
+        """_demote_list.
+        Move a dirty runtime list to persistent memory. Its items are all
+        newer than those of the persistent list, so they are appended.
+        """
+        items = self.runtime.lget(key, 0, -(self.list_size - 1))
+        ttl = self.runtime.ttl(key)
+        self.persistent.lset(key, items[::-1], ttl if ttl > 0 else None)
+        self.runtime.delete([key])
+
+    def set(self, key: str, val: str, ttl: float = None) -> None:
+        if self._write_through(key):
+            self.persistent.set(key, val, ttl)
+            self.clean.add(key)
+        else:
+            self.clean.discard(key)
+        self.runtime.set(key, val, ttl)
+
+    def get(self, key: str):
+        val = self.runtime.get(key)
+        if val is None:
+            val = self.persistent.get(key)
+            if val is not None:
+                self._promote(key, val)
+        return val
+
+    def mset(self, keys: list, vals: list, ttl: float = None) -> None:
+        durable = [i for i, key in enumerate(keys)
+                   if self._write_through(key)]
+        if durable:
+            self.persistent.mset([keys[i] for i in durable],
+                                 [vals[i] for i in durable], ttl)
+        self.runtime.mset(keys, vals, ttl)
+        durable = set(durable)
+        for i, key in enumerate(keys):
+            if i in durable:
+                self.clean.add(key)
+            else:
+                self.clean.discard(key)
+
+    def mget(self, keys: list):
+        vals = self.runtime.mget(keys)
+        missing = [i for i, val in enumerate(vals) if val is None]
+        if missing:
+            found = self.persistent.mget([keys[i] for i in missing])
+            for i, val in zip(missing, found):
+                if val is not None:
+                    vals[i] = val
+                    self._promote(keys[i], val)
+        return vals
+
+    def lset(self, key: str, vals: list, ttl: float = None) -> None:
+        if not self.durable and key not in self.clean and \
+                self.runtime.ttl(key) == -2:
+            # Push onto a list that only exists in persistent memory,
+            # rather than shadowing it with a new runtime list
+            self._promote_list(key)
+        if key in self.clean:
+            self.persistent.lset(key, vals, ttl)
+            self.runtime.lset(key, vals, ttl)
+        elif self.durable:
+            if self.runtime.llen(key) > 0:
+                self._demote_list(key)
+            # Promoted on the next read
+            self.persistent.lset(key, vals, ttl)
+        else:
+            self.runtime.lset(key, vals, ttl)
+
+    def llen(self, key: str) -> int:
+        size = self.runtime.llen(key)
+        if size == 0:
+            size = self._promote_list(key)
+        return size
+
+    def lget(self, key: str, from_idx: int, to_idx: int) -> list:
+        if self.runtime.llen(key) == 0:
+            self._promote_list(key)
+        return self.runtime.lget(key, from_idx, to_idx)
+
+    def flush(self) -> None:
+        """flush.
+        Flush the runtime memory. Dirty keys are lost, like the keys of a
+        runtime memory outside of tiered mode.
+        """
+        self.runtime.flush()
+        self.clean.clear()
+
+    def expire(self, key: str, ttl: float) -> bool:
+        if self._write_through(key):
+            res = self.persistent.expire(key, ttl)
+            return self.runtime.expire(key, ttl) or res
+        return self.runtime.expire(key, ttl)
+
+    def ttl(self, key: str) -> float:
+        ttl = self.runtime.ttl(key)
+        if ttl == -2:
+            ttl = self.persistent.ttl(key)
+        return ttl
+
+    def persist(self, key: str) -> bool:
+        if self._write_through(key):
+            res = self.persistent.persist(key)
+            return self.runtime.persist(key) or res
+        return self.runtime.persist(key)
+
+    def scan(self, cursor=0, match: str = None, count: int = 100) -> tuple:
+        """scan.
+        Scan the runtime memory, then the persistent one, skipping the clean
+        keys already returned by the runtime scan. Cursors are
+        [memory, cursor] pairs.
+        """
+        mem, cursor = cursor if cursor else ('r', 0)
+        if mem == 'r':
+            cursor, keys = self.runtime.scan(cursor, match, count)
+            return ['r', cursor] if cursor else ['p', 0], keys
+        cursor, keys = self.persistent.scan(cursor, match, count)
+        keys = [key for key in keys if key not in self.clean]
+        return ['p', cursor] if cursor else 0, keys
+
+    def scan_prefix(self, prefix: str, limit: int) -> list:
+        keys = self.runtime.scan_prefix(prefix, limit)
+        seen = set(keys)
+        for key in self.persistent.scan_prefix(prefix, limit):
+            if len(keys) >= limit:
+                break
+            if key not in seen:
+                keys.append(key)
+        return keys
@@ -12,6 +12,10 @@ with open('HISTORY.rst') as history_file:
 
 requirements = ['Click>=7.0', 'redis']
 
+extras_requirements = {
+    'msgpack': ['msgpack'],
+}
+
 setup_requirements = ['pytest-runner', ]
 
 test_requirements = ['pytest>=3', ]
@@ -38,6 +42,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
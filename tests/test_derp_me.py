@@ -2,12 +2,37 @@
 
 """Tests for `derp_me` package."""
 
+import asyncio
+import os
+import shutil
+import socket
+import threading
+import time
+import types
+from fnmatch import fnmatchcase
+
 import pytest
 
 from click.testing import CliRunner
 
 from derp_me import derp_me
+from derp_me import changes
+from derp_me import file_mem
+from derp_me import mmap_mem
 from derp_me import cli
+from derp_me import client
+from derp_me import codec
+from derp_me import dispatcher
+from derp_me import eviction
+from derp_me import expiry
+from derp_me import keyindex
+from derp_me import metrics
+from derp_me import redis_pool
+from derp_me import replication
+from derp_me import series
+from derp_me import sharding
+from derp_me import supervisor
+from derp_me import tiered
 
 
 @pytest.fixture
@@ -20,6 +45,61 @@ def response():
     # return requests.get('https://github.com/audreyr/cookiecutter-pypackage')
 
 
+class _Endpoint(object):
+    """A commlib endpoint that does not connect to a broker."""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.sent = []
+
+    def run(self):
+        pass
+
+    def publish(self, msg, *args):
+        self.sent.append(msg)
+
+
+class _Node(object):
+    """A commlib Node whose endpoints do not connect to a broker."""
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.rpcs = {}
+
+    def get_logger(self):
+        return derp_me.Logger(namespace=self.name)
+
+    def create_rpc(self, rpc_name, on_request):
+        self.rpcs[rpc_name] = _Endpoint(on_request=on_request)
+        return self.rpcs[rpc_name]
+
+    def create_publisher(self, **kwargs):
+        return _Endpoint(**kwargs)
+
+    def create_mpublisher(self, **kwargs):
+        return _Endpoint(**kwargs)
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    """DerpMe servers on INPROCESS/FILE memories, without a broker."""
+    monkeypatch.setattr(derp_me, 'Node', _Node)
+    servers = []
+
+    def _server(**kwargs):
+        kwargs.setdefault('runtime_mem', derp_me.LocalMemType.INPROCESS)
+        kwargs.setdefault('persistent_mem', derp_me.LocalMemType.FILE)
+        kwargs.setdefault('storage_path', str(tmp_path / 'derpme.log'))
+        kwargs.setdefault('expiry_interval', 0.05)
+        kwargs.setdefault('startup_workers', 1)
+        servers.append(derp_me.DerpMe(**kwargs))
+        return servers[-1]
+
+    yield _server
+    for derp in servers:
+        derp.stop()
+
+
 def test_content(response):
     """Sample pytest test function with the pytest fixture as an argument."""
     # from bs4 import BeautifulSoup
@@ -30,8 +110,933 @@ def test_command_line_interface():
     """Test the CLI."""
     runner = CliRunner()
     result = runner.invoke(cli.main)
-    assert result.exit_code == 0
-    assert 'derp_me.cli.main' in result.output
+    # Groups invoked without a command exit with 2 since click 8.2
+    assert result.exit_code in (0, 2)
+    assert 'Console script for derp_me.' in result.output
     help_result = runner.invoke(cli.main, ['--help'])
     assert help_result.exit_code == 0
     assert '--help  Show this message and exit.' in help_result.output
+
+
+def test_snapshot_dump_load(tmp_path):
+    """Test a snapshot of the persistent memory dumped and loaded."""
+    runner = CliRunner()
+    src = file_mem.FilePersistentMem(path=str(tmp_path / 'src.log'))
+    src.mset(['k{}'.format(i) for i in range(2500)], list(range(2500)))
+    src.set('t', 'x', ttl=60)
+    src.lset('l', ['1', '2', '3'], ttl=60)
+    src.series_append('s', b'\x01\x02', 1, 10)
+    src.expire('s', 60)
+    src.close()
+    snap = str(tmp_path / 'derpme.snap')
+    opts = ['--tier', 'persistent', '--persistent-mem', 'FILE']
+    result = runner.invoke(cli.main, ['dump', snap] + opts +
+                           ['--storage-path', str(tmp_path / 'src.log')])
+    assert result.exit_code == 0
+    assert 'Dumped 2503 keys' in result.output
+    result = runner.invoke(cli.main, ['load', snap] + opts +
+                           ['--storage-path', str(tmp_path / 'dst.log')])
+    assert result.exit_code == 0
+    dst = file_mem.FilePersistentMem(path=str(tmp_path / 'dst.log'))
+    assert dst.mget(['k0', 'k2499']) == [0, 2499]
+    assert dst.ttl('k0') == -1
+    assert dst.get('t') == 'x'
+    assert dst.lget('l', 0, -2) == ['3', '2', '1']
+    assert dst.series_range('s', 0, -1, 1, 10) == b'\x01\x02'
+    for key in ('t', 'l', 's'):
+        assert 0 < dst.ttl(key) <= 60
+    dst.close()
+
+
+def test_inprocess_runtime_mem():
+    """Test the in-process runtime memory backend."""
+    mem = derp_me.InProcessRuntimeMem(list_size=3)
+    mem.set('k1', 1)
+    assert mem.get('k1') == 1
+    assert mem.get('k2') is None
+    mem.mset(['k2', 'k3'], [2, 3])
+    assert mem.mget(['k1', 'k2', 'k3', 'k4']) == [1, 2, 3, None]
+    mem.lset('l1', ['a'])
+    mem.lset('l1', ['b', 'c', 'd'])
+    assert mem.llen('l1') == 3
+    # Redis LRANGE semantics: newest element first, trimmed to list_size
+    assert mem.lget('l1', 0, -2) == ['d', 'c', 'b']
+    assert mem.lget('l1', 0, 0) == ['d']
+    assert mem.llen('missing') == 0
+    mem.flush()
+    assert mem.get('k1') is None
+    assert mem.llen('l1') == 0
+
+
+def test_redis_persistent_mem_sync():
+    """Test that SAVE is only retried while a background save runs."""
+    class _Redis(object):
+        def __init__(self, errors):
+            self.errors = list(errors)
+
+        def register_script(self, script):
+            return None
+
+        def info(self, section):
+            return {'rdb_bgsave_in_progress': 0}
+
+        def save(self):
+            if self.errors:
+                raise redis_pool.import_redis().ResponseError(
+                    self.errors.pop(0))
+
+    class _Pool(object):
+        def client(self, db, **kwargs):
+            return _Redis([])
+
+    mem = derp_me.RedisPersistentMem(pool=_Pool(), snapshot_interval=60)
+    mem._scheduler.mark_dirty(3)
+    mem._redis = _Redis(['Background save already in progress'])
+    mem.sync()
+    assert mem._scheduler.dirty == 0
+    mem._scheduler.mark_dirty(2)
+    mem._redis = _Redis(['MISCONF Redis is configured to save RDB '
+                         'snapshots, but it is currently not able to '
+                         'persist on disk'])
+    with pytest.raises(redis_pool.import_redis().ResponseError):
+        mem.sync()
+    # The writes are still pending after a failed SAVE
+    assert mem._scheduler.dirty == 2
+    mem._redis = _Redis(['Background save already in progress'] * 3)
+    with pytest.raises(redis_pool.import_redis().ResponseError):
+        mem.sync(retries=3)
+    mem._scheduler.stop()
+
+
+def test_redis_list_ops():
+    """Test the script and transaction paths of the Redis list operations."""
+    error_cls = redis_pool.import_redis().ResponseError
+
+    class _Pipeline(object):
+        def __init__(self, calls):
+            self.calls = calls
+
+        def __getattr__(self, name):
+            return lambda *args: self.calls.append((name,) + args)
+
+        def execute(self):
+            return [2, ['b', 'a']]
+
+    class _Redis(object):
+        def __init__(self, error=None):
+            self.error = error
+            self.calls = []
+
+        def register_script(self, script):
+            def _run(keys, args):
+                self.calls.append(('script', keys[0]))
+                if self.error:
+                    raise error_cls(self.error)
+                return [2, ['b', 'a']]
+            return _run
+
+        def pipeline(self, transaction):
+            return _Pipeline(self.calls)
+
+    ops = derp_me.RedisListOps(_Redis(), 5)
+    assert ops.llen_range('l1', 0, 1) == (2, ['b', 'a'])
+    # Script errors other than missing scripting support are raised
+    for error in ('WRONGTYPE Operation against a key holding the wrong kind '
+                  'of value', 'ERR Error running script: out of memory'):
+        ops = derp_me.RedisListOps(_Redis(error), 5)
+        with pytest.raises(error_cls):
+            ops.lpush_trim('l1', ['a'])
+        assert ops.scripting
+    client = _Redis("ERR unknown command 'EVALSHA'")
+    ops = derp_me.RedisListOps(client, 5)
+    ops.lpush_trim('l1', ['a', 'b'], ttl=1)
+    assert not ops.scripting
+    assert client.calls == [('script', 'l1'), ('lpush', 'l1', 'a', 'b'),
+                            ('ltrim', 'l1', 0, 4), ('pexpire', 'l1', 1000)]
+    del client.calls[:]
+    assert ops.llen_range('l1', 0, 1) == (2, ['b', 'a'])
+    assert client.calls == [('llen', 'l1'), ('lrange', 'l1', 0, 1)]
+
+
+def test_file_persistent_mem_replay(tmp_path):
+    """Test that the file-backed persistent memory survives a restart."""
+    path = str(tmp_path / 'derpme.log')
+    mem = file_mem.FilePersistentMem(path=path, list_size=2)
+    mem.set('k1', 'v1')
+    mem.mset(['k2', 'k3'], ['v2', 'v3'])
+    mem.lset('l1', ['a', 'b', 'c'])
+    mem.close()
+    # Torn record from a crash during append
+    with open(path, 'ab') as f:
+        f.write(b'{"op": "set", "k": "k4"')
+
+    mem = file_mem.FilePersistentMem(path=path, list_size=2)
+    assert mem.mget(['k1', 'k2', 'k3', 'k4']) == ['v1', 'v2', 'v3', None]
+    assert mem.lget('l1', 0, -1) == ['c', 'b']
+    mem.close()
+
+
+def test_expiry_index():
+    """Test that keys are popped in deadline order, skipping stale ones."""
+    index = expiry.ExpiryIndex()
+    index.set('k1', 30.0)
+    index.set('k2', 10.0)
+    index.set('k3', 20.0)
+    # Re-arming k2 leaves a stale heap entry at 10.0
+    index.set('k2', 40.0)
+    index.remove('k3')
+    assert index.expired('k1', now=35.0)
+    assert not index.expired('k2', now=35.0)
+    assert index.pop_expired(now=35.0) == ['k1']
+    assert index.ttl('k2', now=35.0) == 5.0
+    assert index.ttl('k3') == -1
+    assert index.pop_expired(now=50.0) == ['k2']
+    assert len(index) == 0
+
+
+def test_file_persistent_mem_ttl(tmp_path):
+    """Test that expired keys stay expired across a restart."""
+    path = str(tmp_path / 'derpme.log')
+    mem = file_mem.FilePersistentMem(path=path)
+    mem.set('k1', 'v1', ttl=0.05)
+    mem.set('k2', 'v2', ttl=100)
+    mem.lset('l1', ['a'], ttl=100)
+    assert mem.persist('l1')
+    mem.close()
+    time.sleep(0.1)
+
+    mem = file_mem.FilePersistentMem(path=path)
+    assert mem.get('k1') is None
+    assert mem.ttl('k1') == -2
+    assert 0 < mem.ttl('k2') <= 100
+    assert mem.ttl('l1') == -1
+    assert mem.expire_due() == ['k1']
+    mem.close()
+
+
+def test_file_persistent_mem_compaction(tmp_path):
+    """Test that compaction keeps the log bounded and the data intact."""
+    path = str(tmp_path / 'derpme.log')
+    mem = file_mem.FilePersistentMem(path=path, compact_size=1024, fsync=False)
+    for i in range(500):
+        mem.set('k', i)
+        mem.lset('l', [i])
+    mem.close()
+    assert os.path.getsize(path) < 2048
+
+    mem = file_mem.FilePersistentMem(path=path)
+    assert mem.get('k') == 499
+    assert mem.lget('l', 0, -9) == list(range(499, 489, -1))
+    # A failed append is not applied to the index
+    mem._fd.close()
+    with pytest.raises(ValueError):
+        mem.set('k', 500)
+    assert mem.get('k') == 499
+
+
+def test_mmap_persistent_mem_reopen(tmp_path):
+    """Test the memory-mapped persistent memory across index resizes."""
+    path = str(tmp_path / 'derpme.mmap')
+    mem = mmap_mem.MmapPersistentMem(path=path, nbuckets=8, list_size=3)
+    for i in range(100):
+        mem.set('k{}'.format(i), i)
+    mem.set('k0', 'updated')
+    mem.lset('l1', [1, 2])
+    mem.lset('l1', [3, 4])
+    mem.set('t1', 1, ttl=0.05)
+    mem.set('t2', 2, ttl=100)
+    mem.close()
+    time.sleep(0.1)
+
+    mem = mmap_mem.MmapPersistentMem(path=path, list_size=3)
+    assert mem.mget(['k0', 'k99', 'k100']) == ['updated', 99, None]
+    assert mem.lget('l1', 0, -2) == [4, 3, 2]
+    assert mem.get('l1') is None
+    # Deadlines are read from their records until a scan needs them all
+    assert mem.get('t1') is None and 0 < mem.ttl('t2') <= 100
+    assert mem.persist('t2') and mem.ttl('t2') == -1
+    assert mem.scan(0, 't*')[1] == ['t2']
+    assert mem.expire_due() == ['t1']
+    mem.close()
+    # The deadlines are loaded a step at a time, while writes go on
+    mem = mmap_mem.MmapPersistentMem(path=path, list_size=3)
+    mem.LOAD_STEP = 16
+    assert mem._ttls == 0 and mem.expire_due() == [] and not mem._loaded
+    mem.set('t3', 3, ttl=0.05)
+    assert not mem._load_step()
+    mem.delete(['k1'])
+    mem.set('k100', 100)
+    mem.set('k2', 2, ttl=0.05)
+    time.sleep(0.1)
+    assert sorted(mem.expire_due()) == ['k2', 't3']
+    assert mem._loaded and mem._ttls == 0
+    assert len(mem.scan(0, 'k*', 1000)[1]) == 99
+    mem.close()
+
+
+def test_mmap_persistent_mem_compaction(tmp_path):
+    """Test automatic compaction and the file state between two msyncs."""
+    path = str(tmp_path / 'derpme.mmap')
+    mem = mmap_mem.MmapPersistentMem(path=path, snapshot_interval=60,
+                                     snapshot_max_dirty=10 ** 6,
+                                     compact_min_size=64 * 1024)
+    for i in range(20000):
+        mem.set('k', 'v' * 32 + str(i))
+    assert os.path.getsize(path) < 512 * 1024
+    mem.sync()
+    mem.set('k', 'unsynced')
+    mem.set('k2', 'unsynced')
+    # The file still describes the last msync
+    copy = str(tmp_path / 'crashed.mmap')
+    shutil.copyfile(path, copy)
+    crashed = mmap_mem.MmapPersistentMem(path=copy)
+    assert crashed.mget(['k', 'k2']) == ['v' * 32 + '19999', None]
+    crashed.set('k3', 3)
+    assert crashed.get('k') == 'v' * 32 + '19999'
+    crashed.close()
+    mem.close()
+    mem = mmap_mem.MmapPersistentMem(path=path)
+    assert mem.mget(['k', 'k2']) == ['unsynced', 'unsynced']
+    mem.close()
+
+
+def test_inprocess_eviction():
+    """Test that the runtime memory budget evicts the LFU keys."""
+    evicted = []
+    mem = derp_me.InProcessRuntimeMem(
+        max_memory=1000,
+        eviction_policy=eviction.EvictionPolicy.LFU,
+        on_evict=evicted.extend)
+    for i in range(10):
+        mem.set('k{}'.format(i), 'x' * 100)
+        # Keep k0 frequently used
+        mem.get('k0')
+    assert mem.memory_stats()['used_memory'] <= 1000
+    assert mem.get('k0') == 'x' * 100
+    assert mem.get('k1') is None
+    assert mem.memory_stats()['evictions'] == len(evicted)
+    assert evicted[0] == ('k1', 'val', 'x' * 100, None)
+    # Overwriting a key only needs room for the size difference
+    count = len(evicted)
+    mem.set('k0', 'y' * 100)
+    assert len(evicted) == count
+    # The key being written is never its own victim
+    mem = derp_me.InProcessRuntimeMem(max_memory=500, on_evict=evicted.extend)
+    mem.set('a', 'x' * 100)
+    mem.set('b', 'x' * 100)
+    mem.get('a')
+    mem.set('b', 'x' * 300)
+    assert mem.get('b') == 'x' * 300 and mem.get('a') is None
+
+
+def test_tiered_memory(tmp_path):
+    """Test promotion, write-through and demotion between tiers."""
+    runtime = derp_me.InProcessRuntimeMem()
+    persistent = file_mem.FilePersistentMem(path=str(tmp_path / 'derpme.log'))
+    clean = set()
+    mem = tiered.TieredMemory(runtime, persistent, durable=False, clean=clean)
+    durable = tiered.TieredMemory(runtime, persistent, durable=True,
+                                  clean=clean)
+    persistent.set('cfg', 'v1')
+    # Read-through promotes the key to the runtime memory
+    assert mem.get('cfg') == 'v1'
+    assert runtime.get('cfg') == 'v1'
+    # Runtime writes of a clean key are written through
+    mem.set('cfg', 'v2')
+    assert persistent.get('cfg') == 'v2'
+    # A dirty list is demoted before a durable write to it
+    mem.lset('l1', ['a', 'b'])
+    assert persistent.llen('l1') == 0
+    durable.lset('l1', ['c'])
+    assert persistent.lget('l1', 0, -2) == ['c', 'b', 'a']
+    assert mem.lget('l1', 0, -2) == ['c', 'b', 'a']
+    # A runtime push extends a list only in persistent memory
+    persistent.lset('l2', ['a', 'b'])
+    mem.lset('l2', ['c'])
+    assert mem.lget('l2', 0, -2) == ['c', 'b', 'a']
+    assert persistent.lget('l2', 0, -2) == ['c', 'b', 'a']
+    persistent.close()
+
+
+def test_preload(tmp_path, server):
+    """Test keys preloaded within the runtime memory budget."""
+    paths = [str(tmp_path / name) for name in ('a.log', 'b.log')]
+    for path in paths:
+        persistent = file_mem.FilePersistentMem(path=path)
+        persistent.mset(['k{}'.format(i) for i in range(20)],
+                        ['x' * 100] * 20)
+        persistent.lset('l', ['1', '2', '3'])
+        persistent.close()
+    derp = server(preload=['k*', 'l'], runtime_max_memory=1000,
+                  storage_path=paths[0])
+    assert derp.startup_timings['preloaded'] == 21
+    assert derp._runtime_mem.memory_stats()['used_memory'] <= 1000
+    assert derp.metrics.counter('derpme_evicted_keys_total').value > 0
+    # Preloaded keys are clean, durable writes do not demote them
+    derp = server(preload=['l'], tiered=True, storage_path=paths[1])
+    derp._mem(True).lset('l', ['4'])
+    assert derp._mem(False).lget('l', 0, -3) == ['4', '3', '2', '1']
+    assert derp._persistent_mem.llen('l') == 4
+
+
+def test_batch(server):
+    """Test batch requests, directly and through a client pipeline."""
+    derp = server()
+    derp._callback_lset({'key': 'l', 'vals': ['1', '2', '3']}, None)
+    resp = derp._callback_batch({'ops': [
+        {'op': 'set', 'key': 'a', 'val': 1},
+        {'op': 'lset', 'key': 'l', 'vals': ['4']},
+        {'op': 'lget', 'key': 'l', 'l_from': 0, 'l_to': -1},
+        {'op': 'lget', 'key': 'missing', 'l_from': 0, 'l_to': -1},
+        {'op': 'lset', 'key': 's', 'vals': [1.5, 2.5], 'dtype': 'float64'},
+        {'op': 'get', 'key': 'a'},
+        {'op': 'flush'},
+        {'op': 'get', 'key': 'a'},
+        {'op': 'incr', 'key': 'a'}
+    ]}, None)
+    results = resp['results']
+    # lget sees the lset queued before it
+    assert results[2]['val'] == ['4', '3']
+    assert results[3]['status'] == 0
+    assert results[4]['status'] == 1
+    assert results[5]['val'] == 1
+    assert results[7]['val'] is None
+    assert results[8]['status'] == 0
+    # A pipeline sends a single batch request, typed reads are unpacked
+    calls = []
+
+    def _rpc_client(conn_params, rpc_name):
+        calls.append(rpc_name)
+        return types.SimpleNamespace(
+            call=lambda req, **kwargs: derp._callback_batch(req, None))
+
+    sclient = client.DerpMeClient(namespace='n')
+    sclient._comm = types.SimpleNamespace(RPCClient=_rpc_client)
+    with sclient.pipeline() as pipe:
+        pipe.lset('s', [1.0, 2.0, 3.0], dtype='float64', timestamps=[1, 2, 3])
+        pipe.lget('s', 0, -1, typed=True)
+        pipe.get('s')
+    assert calls == ['n.derpme.batch']
+    assert pipe.results[1]['dtype'] == 'float64'
+    assert pipe.results[1]['val'].tolist() == [2.0, 3.0]
+    assert pipe.results[1]['timestamps'].tolist() == [2.0, 3.0]
+
+
+def test_lscan(server, monkeypatch):
+    """Test cursor based list scans, on the server and the client."""
+    derp = server(list_size=300)
+    derp._callback_lset({'key': 'l', 'vals': list(range(250))}, None)
+    items, cursor, chunks = [], 0, 0
+    while True:
+        resp = derp._callback_lscan({'key': 'l', 'cursor': cursor,
+                                     'count': 100}, None)
+        items += resp['val']
+        cursor = resp['cursor']
+        chunks += 1
+        if cursor == 0:
+            break
+    assert chunks == 3 and items == list(range(249, -1, -1))
+    # Exactly exhausted lists end with cursor 0 too
+    resp = derp._callback_lscan({'key': 'l', 'cursor': 200, 'count': 50},
+                                None)
+    assert resp['cursor'] == 0 and len(resp['val']) == 50
+    monkeypatch.setattr(derp, '_LSCAN_MAX_COUNT', 40)
+    resp = derp._callback_lscan({'key': 'l', 'count': 1000}, None)
+    assert len(resp['val']) == 40 and resp['cursor'] == 40
+    for msg in ({'cursor': -1}, {'cursor': 'a'}, {'count': 0},
+                {'count': True}):
+        msg['key'] = 'l'
+        assert derp._callback_lscan(msg, None)['status'] == 0
+    assert derp._callback_lscan({'key': 'missing'}, None)['status'] == 0
+    derp._callback_lset({'key': 's', 'vals': [1.0], 'dtype': 'float64'},
+                        None)
+    resp = derp._callback_lscan({'key': 's'}, None)
+    assert resp['status'] == 0 and 'typed series' in resp['error']
+    # The client follows the cursors until the list is exhausted
+    sclient = client.DerpMeClient(namespace='n')
+    sclient._comm = types.SimpleNamespace(
+        RPCClient=lambda conn_params, rpc_name: types.SimpleNamespace(
+            call=lambda req, **kwargs: derp._callback_lscan(req, None)))
+    assert list(sclient.lscan('l', count=30)) == list(range(249, -1, -1))
+    with pytest.raises(RuntimeError):
+        list(sclient.lscan('missing'))
+
+
+def test_dispatcher_tiers():
+    """Test per tier worker bounds and rejection of the dispatcher."""
+    disp = dispatcher.Dispatcher(runtime_workers=1, persistent_workers=1,
+                                 queue_size=1)
+    disp.start()
+    release = threading.Event()
+    results = []
+
+    def _slow(val):
+        release.wait(5)
+        return val
+
+    threads = [threading.Thread(
+        target=lambda v=v: results.append(disp.submit('persistent', _slow, v)))
+        for v in range(2)]
+    for t in threads:
+        t.start()
+    while disp.stats()['persistent']['queue_depth'] < 1:
+        time.sleep(0.01)
+    # One running and one waiting, the next one is rejected
+    with pytest.raises(dispatcher.DispatcherBusy):
+        disp.submit('persistent', _slow, 2)
+    # The runtime workers are not held by the persistent backlog
+    assert disp.submit('runtime', lambda: 'fast') == 'fast'
+    with pytest.raises(ZeroDivisionError):
+        disp.submit('runtime', lambda: 1 / 0)
+    release.set()
+    for t in threads:
+        t.join()
+    assert sorted(results) == [0, 1]
+    stats = disp.stats()
+    assert stats['persistent']['completed'] == 2
+    assert stats['persistent']['rejected'] == 1
+    assert stats['runtime']['failed'] == 1
+    assert stats['persistent']['queue_depth'] == 0
+    disp.stop()
+
+
+def test_read_cache():
+    """Test LRU eviction and invalidation of the client read cache."""
+    cache = client.ReadCache(max_size=2)
+    cache.put('k1', 1)
+    cache.put('k2', 2)
+    assert cache.get('k1') == 1
+    cache.put('k3', 3)
+    # k2 is the least recently used entry
+    assert cache.get('k2') is None
+    token = cache.token('k1')
+    other = cache.token('k4')
+    cache.invalidate(['k1'])
+    assert cache.get('k1') is None
+    # A response requested before the invalidation must not be cached
+    cache.put('k1', 'stale', token)
+    assert cache.get('k1') is None
+    # Unlike the responses of other keys
+    cache.put('k4', 4, other)
+    assert cache.get('k4') == 4
+    token = cache.token('k4')
+    cache.clear()
+    cache.put('k4', 'stale', token)
+    assert cache.get('k4') is None
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['evictions'] == 1
+
+
+def test_codec_roundtrip():
+    """Test numeric packing and the JSON fallback of the msgpack codec."""
+    cases = [
+        list(range(-100, 100)),
+        [i * 1000 for i in range(100)],
+        [2 ** 40 + i for i in range(10)],
+        [i / 4 for i in range(100)],
+        [1e300] + [0.5] * 10,
+        [1, 2.5] * 10,
+        [[1, 2, 3] * 4, 'a', {'x': list(range(20))}]
+    ]
+    for vals in cases:
+        msg = codec.encode_message({'status': 1, 'val': vals}, codec.MSGPACK)
+        assert msg['encoding'] == codec.MSGPACK
+        assert codec.decode_message(msg) == {
+            'status': 1, 'val': vals, 'encoding': codec.MSGPACK}
+    # Narrowest exact typecodes
+    assert codec._numeric_array(list(range(100))).typecode == 'b'
+    assert codec._numeric_array([0, 40000] * 4).typecode == 'i'
+    assert codec._numeric_array([0.5] * 8).typecode == 'f'
+    assert codec._numeric_array([0.1] * 8).typecode == 'd'
+    # Floats with few digits are smaller as plain JSON
+    vals = [round(i * 0.37, 2) for i in range(1000)]
+    msg = codec.encode_message({'status': 1, 'val': vals}, codec.MSGPACK)
+    assert 'payload' not in msg and msg['val'] == vals
+
+
+def test_async_client_concurrency():
+    """Test the concurrency bound and timeouts of the async client."""
+    class _Client(object):
+        def __init__(self):
+            self.timeout = None
+
+        def get(self, key, persistent):
+            with lock:
+                running.append(key)
+                peak[0] = max(peak[0], len(running))
+            time.sleep(0.05 if key != 'slow' else 0.3)
+            with lock:
+                running.remove(key)
+            return key
+
+    class _AsyncClient(client.AsyncDerpMeClient):
+        def _thread_client(self):
+            return _Client()
+
+    lock = threading.Lock()
+    running = []
+    peak = [0]
+    aclient = _AsyncClient(max_concurrency=2, timeout=1.0)
+
+    async def _gets():
+        return await asyncio.gather(
+            *[aclient.get('k{}'.format(i)) for i in range(6)])
+
+    async def _timeout():
+        with pytest.raises(asyncio.TimeoutError):
+            await aclient.get('slow', timeout=0.05)
+        # The slot is held until the blocking call returns
+        assert aclient.in_flight == 1
+
+    # Event loops in turn, each with its own semaphore
+    assert asyncio.run(_gets()) == ['k{}'.format(i) for i in range(6)]
+    assert peak[0] == 2
+    asyncio.run(_timeout())
+    aclient.close()
+    time.sleep(0.4)
+    assert aclient.in_flight == 0
+    # Clients only create the RPC clients of the services they call
+    created = []
+
+    def _rpc_client(conn_params, rpc_name):
+        created.append(rpc_name)
+        return types.SimpleNamespace(
+            call=lambda req, **kwargs: {'status': 1, 'val': req['key']})
+
+    sclient = client.DerpMeClient(namespace='n')
+    sclient._comm = types.SimpleNamespace(RPCClient=_rpc_client)
+    assert sclient.get('a')['val'] == 'a' and sclient.get('b')['val'] == 'b'
+    assert created == ['n.derpme.get']
+
+
+def test_inprocess_series():
+    """Test typed series stored in the in-process runtime memory."""
+    mem = derp_me.InProcessRuntimeMem()
+    size = series.itemsize('float64')
+    for i in range(10):
+        mem.series_append('s1', series.pack([i, i + 0.5], 'float64'),
+                          size, 5)
+    assert mem.series_len('s1', size, 5) == 5
+    # Newest three samples, oldest first, like lget(key, 0, -2)
+    data = mem.series_range('s1', 0, -2, size, 5)
+    assert series.view(data, 'float64').tolist() == [8.5, 9.0, 9.5]
+    assert mem.series_range('missing', 0, -2, size, 5) == b''
+
+
+def test_persistent_series(tmp_path):
+    """Test typed series appended natively to the file and mmap memories."""
+    size = series.itemsize('int32')
+    for cls, path, kwargs in (
+            (file_mem.FilePersistentMem, 'derpme.log',
+             {'compact_size': 16 * 1024, 'fsync': False}),
+            (mmap_mem.MmapPersistentMem, 'derpme.mmap',
+             {'compact_min_size': 16 * 1024})):
+        path = str(tmp_path / path)
+        # Small enough to compact while appending
+        mem = cls(path=path, **kwargs)
+        mem.set('s1', 'value')
+        for i in range(3000):
+            mem.series_append('s1', series.pack([i], 'int32'), size, 100)
+        assert mem.series_len('s1', size, 100) == 100
+        data = mem.series_range('s1', 0, -2, size, 100)
+        assert series.view(data, 'int32').tolist() == [2997, 2998, 2999]
+        assert mem.get('s1') is None
+        mem.close()
+        # Appends write the new samples only
+        assert os.path.getsize(path) < 1024 * 1024
+        mem = cls(path=path)
+        data = mem.series_range('s1', 0, -99, size, 100)
+        assert series.view(data, 'int32').tolist() == list(range(2900, 3000))
+        mem.delete(['s1'])
+        assert mem.series_range('s1', 0, -2, size, 100) == b''
+        mem.close()
+
+
+def test_metrics_registry():
+    """Test histogram quantiles and the Prometheus rendering."""
+    registry = metrics.MetricsRegistry()
+    hist = registry.histogram('latency', op='get')
+    for _ in range(99):
+        hist.observe(0.0008)
+    hist.observe(0.2)
+    assert hist.quantile(0.5) == 0.001
+    assert hist.quantile(0.999) == 0.25
+    registry.counter('requests', op='get').inc(3)
+    assert registry.to_dict()['requests'][0]['value'] == 3
+    text = registry.to_prometheus()
+    assert 'requests{op="get"} 3' in text
+    assert 'latency_count{op="get"} 100' in text
+    assert 'latency_bucket{op="get",le="+Inf"} 100' in text
+
+
+def test_change_feed():
+    """Test coalescing and chunking of change events."""
+    sent = []
+    feed = changes.ChangeFeed(lambda msg, topic: sent.append((topic, msg)),
+                              'derpme.changes', max_events=2)
+    feed.set('k1', 1)
+    feed.set('k1', 2)
+    feed.lset('l1', [1])
+    feed.lset('l1', [2, 3])
+    assert feed.publish_pending() == 2
+    assert sent[0] == ('derpme.changes.k1', sent[0][1])
+    assert sent[0][1]['val'] == 2
+    assert sent[1][1]['vals'] == [1, 2, 3]
+    del sent[:]
+    # Three keys, beyond max_events: published in chunks
+    feed.mset(['a', 'b', 'c'], [1, 2, 3])
+    assert feed.publish_pending() == 2
+    assert [topic for topic, _ in sent] == ['derpme.changes'] * 2
+    assert len(sent[0][1]['events']) == 2
+    # Flush supersedes the queued runtime events
+    feed.set('d', 4)
+    feed.flush()
+    feed.publish_pending()
+    assert sent[2][1]['events'][0]['op'] == 'flush'
+    assert len(sent) == 3
+
+
+def test_change_watch():
+    """Test the client-side filtering of change events."""
+    subs = []
+
+    class _Subscriber(object):
+        def __init__(self, conn_params, topic, on_message):
+            self.topic = topic
+            self.on_message = on_message
+            subs.append(self)
+
+        def run(self):
+            pass
+
+        def stop(self):
+            pass
+
+    def _publish(msg, topic):
+        # The broker matches the topic patterns of PSubscribers
+        for sub in subs:
+            if fnmatchcase(topic, sub.topic):
+                sub.on_message(msg)
+
+    comm = types.SimpleNamespace(PSubscriber=_Subscriber,
+                                 Subscriber=_Subscriber)
+    events = []
+    watch = client.ChangeWatch(comm, None, 'derpme.changes', 'sensors.*',
+                               events.append)
+    watch.run()
+    feed = changes.ChangeFeed(_publish, 'derpme.changes', max_events=2)
+    feed.set('sensors.t1', 1)
+    feed.set('other', 2)
+    feed.publish_pending()
+    assert [event['key'] for event in events] == ['sensors.t1']
+    # Chunked events are filtered by the watch itself
+    feed.mset(['sensors.t2', 'other', 'sensors.t3'], [1, 2, 3])
+    feed.publish_pending()
+    feed.flush()
+    feed.publish_pending()
+    assert [event.get('key') for event in events] == \
+        ['sensors.t1', 'sensors.t2', 'sensors.t3', None]
+    assert events[-1]['op'] == 'flush'
+    watch.stop()
+
+
+def test_key_index_scan():
+    """Test prefix and glob scans of the sorted key index."""
+    index = keyindex.KeyIndex()
+    index.update(['r1.s.{}'.format(i) for i in range(10)] + ['r2.s.0'])
+    index.add('r1.a')
+    index.discard('r1.s.9')
+    keys = []
+    cursor, found = index.scan(0, 'r1.s.*', 4)
+    keys.extend(found)
+    while cursor:
+        cursor, found = index.scan(cursor, 'r1.s.*', 4)
+        keys.extend(found)
+    assert keys == ['r1.s.{}'.format(i) for i in range(9)]
+    assert index.prefix('r1.', 2) == ['r1.a', 'r1.s.0']
+    assert index.prefix('r1.s.', skip=lambda k: k != 'r1.s.3') == ['r1.s.3']
+    assert keyindex.literal_prefix('r1.s*.[ab]') == 'r1.s'
+    # Redis glob semantics, matching escape_glob()
+    assert keyindex.literal_prefix('a\\*b*') == 'a*b'
+    assert keyindex.glob_match(keyindex.escape_glob('a*[b]') + '*', 'a*[b]c')
+    assert not keyindex.glob_match('a\\*', 'ab')
+    assert keyindex.glob_match('[^a]x', 'bx')
+    assert not keyindex.glob_match('[!a]x', 'bx')
+    # Inserts split chunks, deletes empty them
+    index = keyindex.KeyIndex()
+    keys = ['k{:04d}'.format(i) for i in range(2000)]
+    for key in reversed(keys):
+        index.add(key)
+    for key in keys[::2]:
+        index.discard(key)
+    assert index.prefix('k') == keys[1::2]
+    assert len(index) == 1000
+
+
+def test_load_redis_settings(tmp_path):
+    """Test Redis settings from a config file overridden by environment."""
+    path = tmp_path / 'config.ini'
+    path.write_text('[redis]\nhost = db.local\nport = 6380\npassword =\n')
+    settings = redis_pool.load_redis_settings(
+        str(path), env={'DERPME_REDIS_SOCKET': '/tmp/redis.sock',
+                        'DERPME_REDIS_MAX_CONNECTIONS': '4'})
+    assert settings == {'host': 'db.local', 'port': 6380,
+                        'unix_socket': '/tmp/redis.sock',
+                        'max_connections': 4}
+    pool = redis_pool.RedisPool(**settings)
+    assert pool.stats()['endpoint'] == '/tmp/redis.sock'
+
+
+def test_sharded_memory_rebalance():
+    """Test sharded mget/mset and moving keys to an added shard."""
+    mem = sharding.ShardedMemory({'a': derp_me.InProcessRuntimeMem(),
+                                  'b': derp_me.InProcessRuntimeMem()})
+    keys = ['k{}'.format(i) for i in range(200)]
+    mem.mset(keys, keys)
+    mem.lset('list', ['1', '2', '3'], ttl=60)
+    names = ['s{}'.format(i) for i in range(20)]
+    for name in names:
+        mem.series_append(name, series.pack([1, 2], 'int16'), 2, 10)
+    assert mem.mget(keys) == keys
+    before = {key: mem.ring.node(key) for key in keys}
+    moved = mem.add_shard('c', derp_me.InProcessRuntimeMem())
+    owned = [key for key in keys if mem.ring.node(key) == 'c']
+    assert all(before[key] == mem.ring.node(key)
+               for key in keys if key not in owned)
+    assert moved == len(owned) + (mem.ring.node('list') == 'c') + \
+        sum(mem.ring.node(name) == 'c' for name in names)
+    assert mem.shards['c'].mget(owned) == owned
+    assert mem.mget(keys) == keys
+    assert mem.lget('list', 0, -2) == ['3', '2', '1']
+    assert 0 < mem.ttl('list') <= 60
+    # Typed series are moved too
+    for name in names:
+        data = mem.series_range(name, 0, -1, 2, 10)
+        assert series.view(data, 'int16').tolist() == [1, 2]
+
+
+def test_shared_store(tmp_path):
+    """Test memories served by the shared store of multi-process mode."""
+    store = supervisor.start_shared_store({
+        'runtime_mem': derp_me.LocalMemType.INPROCESS,
+        'persistent_mem': derp_me.LocalMemType.FILE,
+        'list_size': 10,
+        'runtime_max_memory': None,
+        'eviction_policy': eviction.EvictionPolicy.LRU,
+        'storage_path': str(tmp_path / 'derpme.log'),
+        'snapshot_interval': 1.0,
+        'snapshot_max_dirty': 100
+    })
+    try:
+        mem = store.memory(False)
+        mem.mset(['k1', 'k2'], ['1', '2'])
+        mem.lset('l', ['1', '2'])
+        assert store.memory(False).mget(['k1', 'k2']) == ['1', '2']
+        assert mem.llen_range('l', 0, -1) == (2, ['2', '1'])
+        assert not hasattr(mem, 'close')
+        store.memory(True).set('p', '3')
+        assert store.memory(True).get('p') == '3'
+    finally:
+        store.store().close()
+        store.shutdown()
+
+
+def test_supervisor_ready(tmp_path, monkeypatch):
+    """Test READY=1 sent by the supervisor once every worker is ready."""
+    path = str(tmp_path / 'notify.sock')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.settimeout(1.0)
+    monkeypatch.setenv('NOTIFY_SOCKET', path)
+    sup = supervisor.Supervisor(
+        workers=2,
+        runtime_mem=derp_me.LocalMemType.REDIS,
+        persistent_mem=derp_me.LocalMemType.REDIS)
+    try:
+        sup._ready[0] = 1
+        sup._check_ready()
+        assert not sup.wait_ready(0)
+        sup._ready[1] = 1
+        sup._check_ready()
+        assert sup.wait_ready(0)
+        assert sock.recv(64) == b'READY=1'
+        sup._check_ready()
+        with pytest.raises(socket.timeout):
+            sock.settimeout(0.05)
+            sock.recv(64)
+    finally:
+        sock.close()
+
+
+def test_replication_log():
+    """Test logging writes of a memory and applying them to a follower."""
+    batches = []
+    log = replication.ReplicationLog(batches.append, max_entries=3)
+    mem = replication.ReplicatedMemory(derp_me.InProcessRuntimeMem(), log)
+    mem.set('a', 1)
+    mem.execute([('lset', ('l', ['1', '2'], None)), ('get', ('a',))])
+    assert log.publish_pending() == 1
+    assert log.read(0, 10) == [[0, 'set', ['a', 1, None]],
+                               [1, 'lset', ['l', ['1', '2'], None]]]
+    replica = derp_me.InProcessRuntimeMem()
+    for offset, name, args in replication.decode_entries(batches[0]['data']):
+        replication.apply_entry(replica, name, args)
+    assert replica.get('a') == 1
+    assert replica.lget('l', 0, -1) == ['2', '1']
+    mem.mset(['b', 'c'], [2, 3])
+    mem.persist('a')
+    assert log.read(0, 10) is None
+    with pytest.raises(replication.ReadOnlyError):
+        replication.ReadOnlyMemory(replica).set('a', 2)
+    # Writes between two snapshot steps are applied once by the catch-up
+    log = replication.ReplicationLog(batches.append)
+    mem = replication.ReplicatedMemory(derp_me.InProcessRuntimeMem(), log)
+    mem.lset('a', ['1'])
+    mem.lset('b', ['1'])
+
+    def snapshot(req):
+        cursor, records, offset = mem.snapshot(req['cursor'], 1)
+        if not req['cursor']:
+            mem.lset('a', ['2'])
+            mem.lset('b', ['2'])
+        return {'status': 1, 'epoch': log.epoch, 'offset': offset,
+                'cursor': cursor,
+                'data': replication.encode_entries(records)}
+
+    def fetch(req):
+        return {'status': 1, 'next': log.next_offset,
+                'data': replication.encode_entries(
+                    log.read(req['offset'], req['limit']))}
+
+    rpcs = {'p.replication.fetch': fetch,
+            'p.replication.snapshot': snapshot}
+    node = types.SimpleNamespace(
+        create_subscriber=lambda **kw: None,
+        create_rpc_client=lambda rpc_name: types.SimpleNamespace(
+            call=rpcs[rpc_name]))
+    follower = replication.Follower(replica, node, 'p')
+    follower.resync()
+    follower.catch_up()
+    assert follower.offset == log.next_offset
+    for key in ('a', 'b'):
+        assert replica.lget(key, 0, -1) == mem.lget(key, 0, -1)
+    # A batch failing partway logs the state of its keys
+    offset = log.next_offset
+    with pytest.raises(TypeError):
+        mem.execute([('set', ('x', 1, None)), ('expire', ('x',))])
+    assert log.read(offset, 10) == [[offset, 'delete', [['x']]],
+                                    [offset + 1, 'set', ['x', 1, None]]]
+    # An entry failing to apply triggers a resync, then is skipped
+    log.append('rename', ['x', 'y'])
+    follower.catch_up()
+    assert follower.resyncs == 2
+    assert follower.offset == log.next_offset
+    assert replica.get('x') == 1
+    offset = follower.offset
+    follower._failed = (follower.epoch, offset)
+    follower._apply([[offset, 'rename', ['x', 'y']]])
+    assert follower.offset == offset + 1 and follower.resyncs == 2
+    with pytest.raises(ValueError):
+        supervisor.Supervisor(workers=2, replication=True,
+                              runtime_mem=derp_me.LocalMemType.REDIS,
+                              persistent_mem=derp_me.LocalMemType.REDIS)